@@ -0,0 +1,97 @@
+# ============================================
+# РАСПРЕДЕЛЕНИЕ ЗАДАЧ ПО МЕНЕДЖЕРАМ
+# ============================================
+# Раньше на каждый новый товар заново искался минимум загрузки и список
+# кандидатов по всем менеджерам (O(товары x менеджеры)). Теперь менеджеры
+# лежат в куче по приоритету "загрузка с учётом веса":
+#   приоритет = (открытых задач + 1) / вес
+# — задача уходит тому, у кого после неё относительная загрузка будет
+# меньше всего. Вес 2 — менеджер получает вдвое больше задач, чем вес 1.
+# Предел (cap) — максимум открытых задач: достигший его менеджер выходит
+# из кучи. Равные приоритеты разбиваются случайно (seed — для
+# воспроизводимых прогонов). Одна задача — O(log менеджеров).
+
+import heapq
+import random
+
+# managers.txt: "ФИО | вес | предел" — вес и предел необязательны
+SPEC_SEPARATOR = "|"
+DEFAULT_WEIGHT = 1.0
+
+
+def parse_manager_line(line):
+    """Строка managers.txt -> {"name", "weight", "cap"} (cap=None — без предела).
+
+    ValueError, если вес или предел не число либо не положительные.
+    """
+    parts = [part.strip() for part in line.split(SPEC_SEPARATOR)]
+    name = parts[0]
+    if not name:
+        raise ValueError(f"нет ФИО: {line!r}")
+    weight = DEFAULT_WEIGHT
+    cap = None
+    if len(parts) > 1 and parts[1]:
+        weight = float(parts[1].replace(",", "."))
+        if weight <= 0:
+            raise ValueError(f"вес должен быть больше 0: {line!r}")
+    if len(parts) > 2 and parts[2]:
+        cap = int(parts[2])
+        if cap < 0:
+            raise ValueError(f"предел не может быть отрицательным: {line!r}")
+    return {"name": name, "weight": weight, "cap": cap}
+
+
+class WeightedAllocator:
+    """Назначение задач по куче открытой загрузки.
+
+    specs: [{"name", "weight", "cap"}] (см. parse_manager_line)
+    loads: {менеджер: открытых задач} — текущая загрузка (SheetSnapshot.manager_loads)
+    seed:  зерно для разбиения равных приоритетов (None — случайно)
+    """
+
+    def __init__(self, specs, loads, seed=None):
+        self.rng = random.Random(seed)
+        self.specs = {spec["name"]: spec for spec in specs}
+        self.loads = {name: loads.get(name, 0) for name in self.specs}
+        self.assigned = {name: 0 for name in self.specs}
+        self.unassigned = 0
+        self._heap = []
+        for name in self.specs:
+            self._push(name)
+
+    def _push(self, name):
+        spec = self.specs[name]
+        load = self.loads[name]
+        if spec["cap"] is not None and load >= spec["cap"]:
+            return
+        # Случайное второе поле — равные приоритеты выбираются равновероятно
+        heapq.heappush(self._heap, ((load + 1) / spec["weight"], self.rng.random(), name))
+
+    def assign(self, count):
+        """Назначить count задач. Список ФИО; "" — все менеджеры на пределе"""
+        assigned = []
+        heap = self._heap
+        for _ in range(count):
+            if not heap:
+                self.unassigned += count - len(assigned)
+                assigned.extend([""] * (count - len(assigned)))
+                break
+            _, _, name = heapq.heappop(heap)
+            self.loads[name] += 1
+            self.assigned[name] += 1
+            assigned.append(name)
+            self._push(name)
+        return assigned
+
+    def report(self):
+        """Распределение для лога: строка на менеджера"""
+        lines = []
+        for name, spec in self.specs.items():
+            cap = spec["cap"]
+            limit = f"/{cap}" if cap is not None else ""
+            full = " [предел]" if cap is not None and self.loads[name] >= cap else ""
+            lines.append(
+                f"    {name}: +{self.assigned[name]}, открыто {self.loads[name]}{limit} "
+                f"(вес {spec['weight']:g}){full}"
+            )
+        return lines
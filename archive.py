@@ -0,0 +1,270 @@
+"""
+Архив закрытых задач: перенос из старых месячных листов в parquet.
+
+Месячные листы только растут, а каждый запуск читает их целиком. Команда
+переносит закрытые задачи (заполнена "Дата исчезновения") из месяцев
+старше горизонта (ARCHIVE_HORIZON_MONTHS) в сжатые столбцовые файлы:
+
+    archive/<месяц>/<кабинет>.parquet
+
+На листе остаются открытые задачи и одна итоговая строка "Архив"
+(сколько задач перенесено и куда). Дашборд (dashboard/app.py) читает
+архив вместе с листами. Файлы архива нужно хранить в репозитории (или
+там, откуда их видит дашборд) — это единственная копия перенесённых строк.
+Перед удалением строки перечитываются (A, B, G): если лист изменился после
+чтения, месяц пропускается, а файлы архива возвращаются к прежнему виду.
+
+Запуск:
+    python archive.py                 # месяцы старше горизонта из config
+    python archive.py --months 6      # свой горизонт, в месяцах
+    python archive.py --month 2026-01 # один месяц (если он старше горизонта)
+"""
+
+import os
+import re
+import sys
+from datetime import datetime
+
+from config import ARCHIVE_DIR, ARCHIVE_HORIZON_MONTHS, TASK_LEDGER_FILE
+from sheet_snapshot import COL_MERCHANT, COL_SKU, COL_NAME, COL_ADDED, COL_GONE, WIDTH
+
+# Столбец A итоговой строки листа
+ARCHIVE_MARK = "Архив"
+ARCHIVE_COMPRESSION = "zstd"
+
+MONTH_SHEET_RE = re.compile(r"\d{4}-\d{2}")
+
+
+def horizon_month(months=ARCHIVE_HORIZON_MONTHS, now=None):
+    """Первый месяц, который не архивируется: архивируются только листы раньше него"""
+    from dateutil.relativedelta import relativedelta
+
+    return ((now or datetime.now()) - relativedelta(months=months)).strftime("%Y-%m")
+
+
+def partition_path(month, merchant, archive_dir=ARCHIVE_DIR):
+    """Файл архива месяца и кабинета ("Sulpak+ARG" — отдельный кабинет)"""
+    safe = re.sub(r"[^\w+.-]", "_", merchant) or "_"
+    return os.path.join(archive_dir, month, f"{safe}.parquet")
+
+
+def _columns():
+    from google_sheets import COLUMNS
+    return COLUMNS[:WIDTH]
+
+
+def write_partition(path, frame):
+    """Дописать строки в файл архива (повторный перенос тех же строк не дублирует их).
+    Возвращает число строк в файле"""
+    import pandas as pd
+
+    if os.path.exists(path):
+        frame = pd.concat([pd.read_parquet(path), frame], ignore_index=True).drop_duplicates()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    frame.to_parquet(tmp_path, compression=ARCHIVE_COMPRESSION, index=False)
+    os.replace(tmp_path, path)
+    return len(frame)
+
+
+def read_archive(archive_dir=ARCHIVE_DIR, months=None):
+    """Все строки архива одним DataFrame (столбцы листа + "Месяц")"""
+    import pandas as pd
+
+    frames = []
+    if os.path.isdir(archive_dir):
+        for month in sorted(os.listdir(archive_dir)):
+            month_dir = os.path.join(archive_dir, month)
+            if not MONTH_SHEET_RE.fullmatch(month) or not os.path.isdir(month_dir):
+                continue
+            if months is not None and month not in months:
+                continue
+            for name in sorted(os.listdir(month_dir)):
+                if name.endswith(".parquet"):
+                    frame = pd.read_parquet(os.path.join(month_dir, name))
+                    frame["Месяц"] = month
+                    frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=_columns() + ["Месяц"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def summary_row(total, month, today):
+    """Итоговая строка листа: закрыта (G заполнена), поэтому не попадает в задачи"""
+    row = [""] * WIDTH
+    row[COL_MERCHANT] = ARCHIVE_MARK
+    row[COL_NAME] = f"Закрытых задач в архиве: {total} ({ARCHIVE_DIR}/{month}/)"
+    row[COL_ADDED] = today
+    row[COL_GONE] = today
+    return row
+
+
+def archived_total(row):
+    """Сколько задач уже перенесено — из итоговой строки прошлого архивирования"""
+    match = re.search(r"\d+", row[COL_NAME]) if len(row) > COL_NAME else None
+    return int(match.group()) if match else 0
+
+
+def verify_closed(sheet, values, closed):
+    """Перечитать столбцы A, B и G строк closed (один batch_get) и сравнить
+    с прочитанными раньше values. Список строк, которые изменились"""
+    from sheet_snapshot import row_runs
+
+    runs = row_runs(closed)
+    ranges = []
+    for first, last in runs:
+        ranges += [f"A{first}:B{last}", f"G{first}:G{last}"]
+    fresh = sheet.batch_get(ranges)
+
+    changed = []
+    for i, (first, last) in enumerate(runs):
+        merchant_sku, gone = fresh[2 * i], fresh[2 * i + 1]
+        for offset, row_num in enumerate(range(first, last + 1)):
+            ab = list(merchant_sku[offset]) if offset < len(merchant_sku) else []
+            g = list(gone[offset]) if offset < len(gone) else []
+            ab += [""] * (2 - len(ab))
+            cells = (ab[0], ab[1], g[0] if g else "")
+            row = values[row_num - 1]
+            if cells != (row[COL_MERCHANT], row[COL_SKU], row[COL_GONE]) or not cells[2]:
+                changed.append(row_num)
+    return changed
+
+
+def _restore_partitions(saved):
+    """Вернуть файлы архива к состоянию до записи ({путь: байты или None})"""
+    for path, content in saved.items():
+        if content is None:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            with open(path, "wb") as f:
+                f.write(content)
+
+
+def archive_month(sheet, ledger=None):
+    """Перенести закрытые задачи листа в архив. Возвращает число перенесённых строк"""
+    import pandas as pd
+    from sheet_snapshot import row_runs
+
+    month = sheet.title
+    values = [list(row) + [""] * (WIDTH - len(row)) for row in sheet.get_all_values()]
+    if len(values) < 2:
+        print(f"  [SKIP] {month}: лист пуст")
+        return 0
+
+    has_summary = values[1][COL_MERCHANT] == ARCHIVE_MARK
+    closed = [row_num for row_num in range(2, len(values) + 1)
+              if values[row_num - 1][COL_GONE]
+              and values[row_num - 1][COL_MERCHANT] != ARCHIVE_MARK]
+    if not closed:
+        print(f"  [SKIP] {month}: закрытых задач нет")
+        return 0
+
+    # 1. Сначала файлы архива — строки удаляются с листа только после записи
+    #    (прежнее содержимое файлов сохраняем — на случай отказа в шаге 2)
+    frame = pd.DataFrame([values[row_num - 1][:WIDTH] for row_num in closed], columns=_columns())
+    saved = {}
+    for merchant, part in frame.groupby(frame.columns[COL_MERCHANT], sort=True):
+        path = partition_path(month, merchant)
+        if path not in saved:
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    saved[path] = f.read()
+            else:
+                saved[path] = None
+        stored = write_partition(path, part.reset_index(drop=True))
+        print(f"    [OK] {path}: +{len(part)} (всего {stored})")
+    archived = read_archive(months={month})
+    if len(archived) < len(frame.drop_duplicates()):
+        _restore_partitions(saved)
+        raise RuntimeError(f"{month}: в архиве {len(archived)} строк, ожидалось не меньше {len(frame)}")
+
+    # Лист мог измениться после get_all_values (отчёт, ручные правки) — удаляем
+    # только если строки на прежних местах и по-прежнему закрыты
+    changed = verify_closed(sheet, values, closed)
+    if changed:
+        _restore_partitions(saved)
+        print(f"  [FAIL] {month}: строки изменились после чтения ({len(changed)}, напр. {changed[:5]}) "
+              f"— лист не тронут, архив возвращён. Запустите архивацию ещё раз")
+        return 0
+
+    # 2. Лист: удалить перенесённые строки (с конца — номера остальных не сдвигаются),
+    #    добавить/обновить итоговую строку — одним spreadsheet.batch_update
+    today = datetime.now().strftime("%d.%m.%Y")
+    total = len(closed) + (archived_total(values[1]) if has_summary else 0)
+    summary = summary_row(total, month, today)
+    requests = [
+        {"deleteDimension": {"range": {
+            "sheetId": sheet.id, "dimension": "ROWS", "startIndex": first - 1, "endIndex": last,
+        }}}
+        for first, last in reversed(row_runs(closed))
+    ]
+    if not has_summary:
+        requests.append({"insertDimension": {
+            "range": {"sheetId": sheet.id, "dimension": "ROWS", "startIndex": 1, "endIndex": 2},
+            "inheritFromBefore": False,
+        }})
+    requests.append({"updateCells": {
+        "range": {"sheetId": sheet.id, "startRowIndex": 1, "endRowIndex": 2,
+                  "startColumnIndex": 0, "endColumnIndex": WIDTH},
+        "rows": [{"values": [{"userEnteredValue": {"stringValue": v}} for v in summary]}],
+        "fields": "userEnteredValue",
+    }})
+    sheet.spreadsheet.batch_update({"requests": requests})
+
+    # 3. Реестр задач — по новому виду листа (номера строк изменились)
+    if ledger:
+        closed_set = set(closed)
+        remaining = [values[row_num - 1] for row_num in range(3 if has_summary else 2, len(values) + 1)
+                     if row_num not in closed_set]
+        ledger.import_month(month, [values[0], summary] + remaining)
+
+    left = len(values) - 1 - len(closed) - (1 if has_summary else 0)
+    print(f"  [OK] {month}: перенесено {len(closed)}, на листе осталось задач: {left} (+ итоговая строка)")
+    return len(closed)
+
+
+def _arg(argv, name, default):
+    if name in argv:
+        idx = argv.index(name)
+        if idx + 1 < len(argv):
+            return argv[idx + 1]
+    return default
+
+
+def main():
+    from google_sheets import get_sheet
+    from task_ledger import TaskLedger
+
+    horizon = int(_arg(sys.argv, "--months", ARCHIVE_HORIZON_MONTHS))
+    only = _arg(sys.argv, "--month", None)
+    border = horizon_month(horizon)
+
+    print("=" * 50)
+    print(f"АРХИВ ЗАКРЫТЫХ ЗАДАЧ (листы раньше {border}) -> {ARCHIVE_DIR}")
+    print("=" * 50)
+
+    spreadsheet = get_sheet()
+    sheets = sorted(
+        (ws for ws in spreadsheet.worksheets()
+         if MONTH_SHEET_RE.fullmatch(ws.title) and ws.title < border and (only is None or ws.title == only)),
+        key=lambda ws: ws.title,
+    )
+    if not sheets:
+        print("[INFO] Нет листов старше горизонта")
+        return
+
+    ledger = TaskLedger() if TASK_LEDGER_FILE else None
+    total = 0
+    try:
+        for sheet in sheets:
+            print(f"[{sheet.title}]")
+            total += archive_month(sheet, ledger)
+    finally:
+        if ledger:
+            ledger.close()
+    print(f"\n[OK] Перенесено в архив: {total}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# ============================================
+# ПАКЕТНАЯ ЗАПИСЬ В GOOGLE SHEETS ЧАСТЯМИ
+# ============================================
+# Один batch_update на весь лист упирается в лимит размера запроса на
+# листах в десятки тысяч строк — и тогда падает весь мерчант. BatchWriter
+# режет список элементов (строки append, диапазоны значений, запросы
+# оформления) на пакеты не больше SHEETS_BATCH_MAX_BYTES байт и
+# SHEETS_BATCH_MAX_ROWS строк и отправляет их по очереди:
+#   - упавший пакет повторяется сам по себе (SHEETS_CHUNK_RETRIES раз;
+#     у append — retries=0, см. SheetSnapshot); временные ошибки (429/5xx)
+#     ещё раньше повторяет sheets_client;
+#   - ответ 400/413 на пакет из нескольких элементов (слишком большой
+#     запрос) — пакет делится пополам, половины отправляются отдельно;
+#   - ordered=True (append): после неудачного пакета следующие не
+#     отправляются — порядок строк важен.
+# В лог — число пакетов, строк и скорость записи (строк/с).
+
+import json
+import time
+
+from config import SHEETS_BATCH_MAX_BYTES, SHEETS_BATCH_MAX_ROWS, SHEETS_CHUNK_RETRIES
+
+# Коды ответа, при которых пакет делится, а не повторяется как есть
+SPLIT_STATUSES = {400, 413}
+
+
+def payload_bytes(body):
+    """Размер тела запроса в байтах — как его сериализует requests (json=...)"""
+    return len(json.dumps(body).encode("utf-8"))
+
+
+def split_batches(items, rows_of, max_bytes=SHEETS_BATCH_MAX_BYTES, max_rows=SHEETS_BATCH_MAX_ROWS):
+    """Разбить элементы на пакеты по размеру (байты JSON) и числу строк.
+    Элемент больше лимита сам по себе уходит отдельным пакетом."""
+    batches = []
+    current, size, rows = [], 0, 0
+    for item in items:
+        item_size = payload_bytes(item) + 2  # ", " между элементами
+        item_rows = rows_of(item)
+        if current and (size + item_size > max_bytes or rows + item_rows > max_rows):
+            batches.append(current)
+            current, size, rows = [], 0, 0
+        current.append(item)
+        size += item_size
+        rows += item_rows
+    if current:
+        batches.append(current)
+    return batches
+
+
+def response_status(error):
+    """HTTP-код ошибки gspread/requests или None"""
+    code = getattr(error, "code", None)
+    if code is None:
+        response = getattr(error, "response", None)
+        code = getattr(response, "status_code", None)
+    return code
+
+
+class BatchWriter:
+    """Отправка элементов пакетами: send(пакет) — один вызов API.
+
+    label  — название для лога ("append", "значения", ...)
+    rows_of(элемент) — сколько строк листа в элементе (для лимита и скорости)
+    unit   — единица в логе ("строк", "запросов")
+    """
+
+    def __init__(self, label, send, rows_of, ordered=False, unit="строк",
+                 max_bytes=SHEETS_BATCH_MAX_BYTES, max_rows=SHEETS_BATCH_MAX_ROWS,
+                 retries=SHEETS_CHUNK_RETRIES):
+        self.label = label
+        self.send = send
+        self.rows_of = rows_of
+        self.ordered = ordered
+        self.unit = unit
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.retries = retries
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def batches(self, items):
+        return split_batches(items, self.rows_of, self.max_bytes, self.max_rows)
+
+    def write(self, items):
+        """Отправить все элементы. Возвращает неотправленные (после всех повторов)"""
+        start = time.perf_counter()
+        failed = []
+        batches = self.batches(items)
+        for i, batch in enumerate(batches):
+            failed_here = self._send(batch)
+            failed.extend(failed_here)
+            if failed_here and self.ordered:
+                for rest in batches[i + 1:]:
+                    failed.extend(rest)
+                break
+        self.seconds += time.perf_counter() - start
+        self.report(len(batches), failed)
+        return failed
+
+    def _send(self, batch):
+        """Отправить пакет с повторами; при "слишком большом" запросе — половинами"""
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                self.calls += 1
+                self.send(batch)
+                self.rows += sum(self.rows_of(item) for item in batch)
+                return []
+            except Exception as e:
+                error = e
+                if response_status(e) in SPLIT_STATUSES and len(batch) > 1:
+                    break
+                if attempt < self.retries:
+                    print(f"  [WARN] {self.label}: пакет из {len(batch)} не записан ({e}) — повтор")
+
+        if len(batch) > 1 and response_status(error) in SPLIT_STATUSES:
+            print(f"  [INFO] {self.label}: пакет из {len(batch)} отклонён ({response_status(error)}) — делим пополам")
+            middle = len(batch) // 2
+            failed = self._send(batch[:middle])
+            if failed and self.ordered:
+                return failed + batch[middle:]
+            return failed + self._send(batch[middle:])
+
+        print(f"  [WARN] {self.label}: пакет из {len(batch)} не записан: {error}")
+        return list(batch)
+
+    def report(self, batches, failed):
+        rate = self.rows / self.seconds if self.seconds > 0 else 0
+        line = (f"  [OK] Запись ({self.label}): {self.rows} {self.unit}, пакетов {batches}, "
+                f"вызовов {self.calls}, {self.seconds:.1f} с ({rate:.0f} {self.unit}/с)")
+        if failed:
+            line += f", не записано: {len(failed)}"
+        print(line)
@@ -0,0 +1,197 @@
+"""
+Бенчмарк конвейера Kaspi Reporter на локальной заглушке Merchant Center.
+
+Поднимает mock_kaspi.py в том же процессе, направляет на него test_steps и
+price_monitor через переменные окружения и прогоняет этапы для каждой
+комбинации "число мерчантов x размер выгрузки". Google Sheets и Telegram
+не вызываются.
+
+Запуск:
+    python benchmark.py --merchants 1,5,50 --rows 10,1000,100000
+Опции:
+    --concurrency N   мерчантов параллельно (как test_steps.py --concurrency)
+    --http            выгрузка по HTTP без браузера (KASPI_HTTP_EXPORT_URL)
+    --latency MS      задержка ответов API заглушки (по умолчанию 200)
+    --port PORT       порт заглушки (по умолчанию 8765)
+    --headed          показать окно браузера
+    --verbose         не глушить вывод этапов
+    --excel           только разбор Excel: pandas.read_excel против
+                      потокового чтения excel_export (браузер не нужен)
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from mock_kaspi import MockState, start_mock, mock_env, mock_http_export_url, mock_http_counts_url, _arg
+
+PORT = int(_arg(sys.argv, "--port", "8765"))
+WORK_DIR = tempfile.mkdtemp(prefix="kaspi_bench_")
+
+# Окружение выставляется ДО импорта config/test_steps — поэтому
+# импорт модулей проекта ниже, а не в начале файла
+os.environ.update(mock_env(PORT))
+os.environ["KASPI_SESSION_CACHE"] = ""  # каждый сценарий — полный вход
+os.environ["KASPI_DOWNLOADS_PATH"] = os.path.join(WORK_DIR, "downloads")
+os.environ["KASPI_EXPORT_CACHE_DIR"] = os.path.join(WORK_DIR, "cache")
+if "--headed" not in sys.argv:
+    os.environ["CI"] = "true"  # config.HEADLESS
+if "--http" in sys.argv:
+    os.environ["KASPI_HTTP_EXPORT_URL"] = mock_http_export_url(PORT)
+    os.environ["KASPI_HTTP_COUNTS_URL"] = mock_http_counts_url(PORT)
+
+import excel_export
+import export_cache
+import price_monitor
+import readiness
+import test_steps
+
+STAGES = ["login", "scrape", "parse", "report", "monitor"]
+
+
+@contextlib.contextmanager
+def stage(timings, name, verbose):
+    """Замер этапа; вывод этапа глушится, если не --verbose"""
+    out = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    try:
+        with out:
+            yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def bench_merchants(count):
+    """Мерчанты сценария: Sulpak (нужен монитору) + числовые ID"""
+    merchants = [{"id": "Sulpak", "name": "Sulpak", "sheet_name": "Sulpak"}]
+    for i in range(1, count):
+        merchant_id = str(30400000 + i)
+        merchants.append({"id": merchant_id, "name": f"M{i}", "sheet_name": f"M{i}"})
+    return merchants
+
+
+async def run_scenario(state, merchant_count, rows, concurrency, verbose):
+    merchants = bench_merchants(merchant_count)
+    state.merchant_ids = [m["id"] for m in merchants]
+    state.rows = rows
+
+    # Чистый запуск: без кэша выгрузок и со свежей статистикой ожиданий
+    readiness.WAIT_STATS.clear()
+    export_cache._index = {}
+
+    timings = {}
+    with stage(timings, "login", verbose):
+        browser, context, page = await test_steps.test_step1_login()
+    if not page:
+        raise RuntimeError("вход в заглушку не удался")
+
+    try:
+        with stage(timings, "scrape", verbose):
+            all_results, all_files = await test_steps.collect_merchant_data(
+                browser, context, page, merchants, test_steps.CATEGORIES, concurrency,
+                force_refresh=True,
+            )
+
+        # Отдельно — только разбор Excel по уже скачанным файлам
+        files = [path for per_merchant in all_files.values() for path in per_merchant.values() if path]
+        with stage(timings, "parse", verbose):
+            for path in files:
+                await test_steps.test_step3_parse_excel(path)
+
+        with stage(timings, "report", verbose):
+            test_steps.build_report_message(all_results)
+
+        with stage(timings, "monitor", verbose):
+            row = None
+            if await price_monitor.open_history(page) and await price_monitor.ensure_sulpak(page):
+                row = await price_monitor.parse_latest_row(page)
+    finally:
+        await browser.close()
+
+    # Проверка, что данные дошли целиком (а не просто "быстро упало") и от своего
+    # кабинета: у каждого кабинета заглушки своё количество товаров
+    merchant_ids = {m["name"]: m["id"] for m in merchants}
+    wrong = [name for name, results in all_results.items()
+             if (results.get("без_привязки") or {}).get("total") != state.count("CHECK", merchant_ids.get(name))]
+    if wrong:
+        print(f"  [WARN] Неверное количество 'Без привязки' у: {', '.join(wrong[:5])}")
+    if not row:
+        print("  [WARN] Монитор не нашёл строку истории загрузок")
+
+    timings["waits"] = sum(s["total"] for s in readiness.WAIT_STATS.values())
+    return timings
+
+
+def print_row(merchants, rows, timings):
+    per_merchant = timings["scrape"] / merchants
+    total = sum(timings[s] for s in STAGES)
+    cells = "".join(f"{timings[s]:>9.2f}" for s in STAGES)
+    print(f"{merchants:>9}{rows:>9}{cells}{per_merchant:>11.2f}{total:>9.2f}{timings['waits']:>9.2f}")
+
+
+def bench_excel(state, row_counts):
+    """Разбор одного файла "Без привязки": прежний путь против потокового"""
+    import pandas as pd
+
+    def timed(fn):
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+
+    print(f"{'строк':>9}{'размер':>10}{'read_excel':>12}{'поток+имена':>13}{'поток/счёт':>12}")
+    for rows in row_counts:
+        state.rows = rows
+        path = os.path.join(WORK_DIR, f"bench_{rows}.xlsx")
+        with open(path, "wb") as f:
+            f.write(state.xlsx("CHECK"))
+
+        old = timed(lambda: pd.read_excel(path))
+        parsed = timed(lambda: excel_export.ParsedExport.read(path))
+        stats = timed(lambda: excel_export.read_stats(path))
+        size_kb = os.path.getsize(path) // 1024
+        print(f"{rows:>9}{size_kb:>8}КБ{old:>12.2f}{parsed:>13.2f}{stats:>12.2f}")
+
+
+async def main():
+    merchant_counts = [int(x) for x in _arg(sys.argv, "--merchants", "1,5").split(",")]
+    row_counts = [int(x) for x in _arg(sys.argv, "--rows", "10,1000").split(",")]
+    concurrency = int(_arg(sys.argv, "--concurrency", "1"))
+    latency = int(_arg(sys.argv, "--latency", "200"))
+    verbose = "--verbose" in sys.argv
+
+    state = MockState(latency_ms=latency)
+    if "--excel" in sys.argv:
+        bench_excel(state, row_counts)
+        return
+    runner = await start_mock(state, PORT)
+
+    mode = "HTTP" if "--http" in sys.argv else "браузер"
+    print(f"Бенчмарк: заглушка http://127.0.0.1:{PORT}, выгрузка: {mode}, "
+          f"параллельно: {concurrency}, задержка API: {latency} мс")
+    print(f"Рабочая папка: {WORK_DIR}")
+    header = "".join(f"{s:>9}" for s in STAGES)
+    print(f"{'мерчанты':>9}{'строк':>9}{header}{'на мерч.':>11}{'итого':>9}{'ожид.':>9}")
+
+    try:
+        for rows in row_counts:
+            # Генерация xlsx не должна попадать в замер — готовим заранее
+            state.rows = rows
+            for status in ("CHECK", "IMPORTED", "PENDING"):
+                await asyncio.to_thread(state.xlsx, status)
+            for merchants in merchant_counts:
+                try:
+                    timings = await run_scenario(state, merchants, rows, concurrency, verbose)
+                except Exception as e:
+                    print(f"{merchants:>9}{rows:>9}  [FAIL] {e}")
+                    continue
+                print_row(merchants, rows, timings)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
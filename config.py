@@ -8,8 +8,11 @@ KASPI_LOGIN = os.environ.get("KASPI_LOGIN", "Aleksey.Rumyancev@sulpak.kz")
 KASPI_PASSWORD = os.environ.get("KASPI_PASSWORD", "resMy3002Kasp!")
 
 # URL-адреса Kaspi Магазин (Merchant Center)
-KASPI_LOGIN_URL = "https://idmc.shop.kaspi.kz/login"
-KASPI_PRODUCTS_BASE_URL = "https://kaspi.kz/mc/#/products/pending"
+# Переопределяются через окружение — например, для локальной заглушки (mock_kaspi.py)
+KASPI_LOGIN_URL = os.environ.get("KASPI_LOGIN_URL", "https://idmc.shop.kaspi.kz/login")
+KASPI_MC_URL = os.environ.get("KASPI_MC_URL", "https://kaspi.kz/mc")
+KASPI_PRODUCTS_BASE_URL = f"{KASPI_MC_URL}/#/products/pending"
+KASPI_HISTORY_URL = f"{KASPI_MC_URL}/#/history?tab=priceList&page=1"
 
 # Список мерчантов для обработки
 # id — текст в выпадающем списке после "ID - " (Sulpak, 30409770, 30382295)
@@ -23,10 +26,10 @@ MERCHANTS = [
 
 # URL для каждой категории нераспознанных товаров
 CATEGORY_URLS = {
-    "без_привязки": "https://kaspi.kz/mc/#/products/pending/CHECK/1",
-    "требуют_доработок": "https://kaspi.kz/mc/#/products/pending/IMPORTED/1",
-    "на_проверке": "https://kaspi.kz/mc/#/products/pending/PENDING/1",
-    "отклонены": "https://kaspi.kz/mc/#/products/pending/TRASH/1"
+    "без_привязки": f"{KASPI_PRODUCTS_BASE_URL}/CHECK/1",
+    "требуют_доработок": f"{KASPI_PRODUCTS_BASE_URL}/IMPORTED/1",
+    "на_проверке": f"{KASPI_PRODUCTS_BASE_URL}/PENDING/1",
+    "отклонены": f"{KASPI_PRODUCTS_BASE_URL}/TRASH/1"
 }
 
 # Telegram настройки (из переменных окружения или значения по умолчанию)
@@ -38,11 +41,100 @@ TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", "-1002158563605")
 HEADLESS = os.environ.get("CI", "") == "true"
 TIMEOUT = 30000  # Таймаут ожидания элементов (мс)
 
+# Блокировка лишних запросов браузера (картинки, шрифты, аналитика).
+# Страницы Merchant Center грузятся быстрее, в CI меньше трафика.
+BLOCK_REQUESTS = os.environ.get("KASPI_BLOCK_REQUESTS", "1") == "1"
+# Типы ресурсов Playwright, которые не нужны для работы скрипта
+BLOCKED_RESOURCE_TYPES = ["image", "media", "font"]
+# Домены аналитики и сторонних скриптов (совпадение по окончанию имени хоста)
+BLOCKED_DOMAINS = [
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "facebook.net",
+    "facebook.com",
+    "mc.yandex.ru",
+    "mc.yandex.kz",
+    "hotjar.com",
+    "criteo.com",
+    "tiktok.com",
+]
+# Никогда не блокируются (перекрывает правила выше): reCAPTCHA на странице входа
+ALLOWED_DOMAINS = [
+    "www.google.com",
+    "www.gstatic.com",
+    "www.recaptcha.net",
+]
+
+# Сколько мерчантов обрабатывать одновременно (каждый — в своём контексте браузера).
+# 1 — последовательно на одной странице, как раньше.
+MERCHANT_CONCURRENCY = int(os.environ.get("KASPI_MERCHANT_CONCURRENCY", "1"))
+
+# Кэш авторизованной сессии (Playwright storage_state) между запусками.
+# Файл создаётся с правами 0600; пустой путь — кэш отключён.
+SESSION_CACHE_FILE = os.environ.get("KASPI_SESSION_CACHE", "./.session/kaspi_state.json")
+SESSION_TTL_HOURS = float(os.environ.get("KASPI_SESSION_TTL_HOURS", "12"))
+
 # Путь для сохранения отчётов
 REPORTS_PATH = "./reports"
 
 # Путь для скачанных Excel-файлов от Kaspi
-DOWNLOADS_PATH = "./downloads"
+DOWNLOADS_PATH = os.environ.get("KASPI_DOWNLOADS_PATH", "./downloads")
+
+# Кэш выгрузок между запусками: последний счётчик, хэш файла и статистика
+# по каждой паре (мерчант, категория). Если счётчик не изменился, файл не
+# скачивается и не разбирается заново — кроме "Без привязки": по нему ведутся
+# задачи, а при том же счётчике могли смениться артикулы, поэтому он
+# скачивается всегда (разбор пропускается, если файл совпал по хэшу).
+# KASPI_FORCE_REFRESH=1 или --refresh — скачать всё заново.
+EXPORT_CACHE_DIR = os.environ.get("KASPI_EXPORT_CACHE_DIR", "./.cache/exports")
+FORCE_REFRESH = os.environ.get("KASPI_FORCE_REFRESH", "0") == "1"
 
 # Использовать встроенную выгрузку в Excel (рекомендуется)
 USE_BUILTIN_EXCEL_EXPORT = True
+
+# Скачивать 4 категории мерчанта параллельно — каждая в своей вкладке
+# того же (уже переключённого) контекста браузера
+PARALLEL_CATEGORIES = os.environ.get("KASPI_PARALLEL_CATEGORIES", "0") == "1"
+
+# Прямая выгрузка Excel по HTTP с cookies авторизованной сессии (без кликов
+# в браузере). Шаблон URL с подстановками {merchant_id} (поле "uid" мерчанта,
+# если задано, иначе "id") и {status} (CHECK / IMPORTED / PENDING / TRASH).
+# Пустая строка — режим выключен. Если HTTP-выгрузка мерчанта не удалась,
+# он обрабатывается через браузер, как обычно.
+HTTP_EXPORT_URL = os.environ.get("KASPI_HTTP_EXPORT_URL", "")
+# Счётчики вкладок для HTTP-режима — тот же ответ API, что перехватывает
+# pending_counts в браузере (шаблон URL с {merchant_id}). Их число, а не
+# строки файла, запоминается в кэше выгрузок, как и в браузерном режиме.
+# Пустая строка — счётчик в кэш не пишется (совпадение проверяется по хэшу).
+HTTP_COUNTS_URL = os.environ.get("KASPI_HTTP_COUNTS_URL", "")
+HTTP_EXPORT_CONCURRENCY = int(os.environ.get("KASPI_HTTP_EXPORT_CONCURRENCY", "4"))
+
+# Лимит Google Sheets API: запросов в минуту на пользователя (квота — 60).
+# Запросы сверх лимита ждут в очереди (token bucket), ответы 429/5xx
+# повторяются с экспоненциальной задержкой.
+SHEETS_REQUESTS_PER_MINUTE = int(os.environ.get("KASPI_SHEETS_RPM", "55"))
+SHEETS_MAX_RETRIES = int(os.environ.get("KASPI_SHEETS_MAX_RETRIES", "6"))
+
+# Локальный реестр задач (SQLite) — основная копия месячных листов, таблица
+# Google — её отображение. Пустая строка — реестр выключен (лист читается
+# целиком при каждой обработке).
+TASK_LEDGER_FILE = os.environ.get("KASPI_TASK_LEDGER", "./.cache/ledger/tasks.sqlite")
+
+# Зерно распределения задач по менеджерам (allocator.py): при равной
+# загрузке менеджер выбирается случайно. Пустая строка — каждый запуск
+# по-разному; число — воспроизводимое распределение.
+ALLOCATOR_SEED = os.environ.get("KASPI_ALLOCATOR_SEED", "") or None
+
+# Архив закрытых задач (python archive.py): из месячных листов старше
+# горизонта строки с датой исчезновения переносятся в parquet-файлы
+# ARCHIVE_DIR/<месяц>/<кабинет>.parquet. Дашборд читает их вместе с листами.
+ARCHIVE_DIR = os.environ.get("KASPI_ARCHIVE_DIR", "./archive")
+ARCHIVE_HORIZON_MONTHS = int(os.environ.get("KASPI_ARCHIVE_HORIZON", "3"))
+
+# Запись в Google Sheets пакетами (batch_writer.py): один запрос — не больше
+# SHEETS_BATCH_MAX_BYTES байт JSON и SHEETS_BATCH_MAX_ROWS строк листа.
+# Упавший пакет повторяется отдельно SHEETS_CHUNK_RETRIES раз.
+SHEETS_BATCH_MAX_BYTES = int(os.environ.get("KASPI_SHEETS_BATCH_BYTES", "1000000"))
+SHEETS_BATCH_MAX_ROWS = int(os.environ.get("KASPI_SHEETS_BATCH_ROWS", "5000"))
+SHEETS_CHUNK_RETRIES = int(os.environ.get("KASPI_SHEETS_CHUNK_RETRIES", "1"))
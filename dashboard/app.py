@@ -11,6 +11,7 @@ import gspread
 from google.oauth2.service_account import Credentials
 from datetime import datetime
 import json
+import os
 import re
 
 # ============================================
@@ -34,6 +35,14 @@ EXPECTED_COLUMNS = [
 ]
 
 
+# Архив закрытых задач (archive.py в корне репозитория): parquet-файлы
+# <месяц>/<кабинет>.parquet. Строки "Архив" на листах — только итог переноса.
+ARCHIVE_DIR = os.environ.get(
+    "KASPI_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "archive")
+)
+ARCHIVE_MARK = "Архив"
+
+
 @st.cache_resource
 def get_google_client():
     """Подключение к Google Sheets через сервисный аккаунт"""
@@ -46,6 +55,25 @@ def get_google_client():
     return gspread.authorize(creds)
 
 
+def load_archive():
+    """Перенесённые в архив закрытые задачи: список DataFrame по файлам"""
+    frames = []
+    if not os.path.isdir(ARCHIVE_DIR):
+        return frames
+    month_pattern = re.compile(r"^\d{4}-\d{2}$")
+    for month in sorted(os.listdir(ARCHIVE_DIR)):
+        month_dir = os.path.join(ARCHIVE_DIR, month)
+        if not month_pattern.match(month) or not os.path.isdir(month_dir):
+            continue
+        for name in sorted(os.listdir(month_dir)):
+            if not name.endswith(".parquet"):
+                continue
+            df = pd.read_parquet(os.path.join(month_dir, name))
+            df["Месяц"] = month
+            frames.append(df)
+    return frames
+
+
 @st.cache_data(ttl=300)  # кэш 5 минут
 def load_all_data():
     """Загрузка данных со всех месячных листов"""
@@ -100,10 +128,15 @@ def load_all_data():
     # Сохраняем предупреждения в session_state, чтобы показать после загрузки
     st.session_state["_header_warnings"] = duplicate_warnings
 
+    all_frames.extend(load_archive())
+
     if not all_frames:
         return pd.DataFrame()
 
     df = pd.concat(all_frames, ignore_index=True)
+    # Итоговые строки архива — не задачи
+    if "Кабинет" in df.columns:
+        df = df[df["Кабинет"] != ARCHIVE_MARK].reset_index(drop=True)
 
     # Парсинг дат (формат dd.mm.yyyy)
     for col in ["Дата добавления", "Отметка менеджера", "Дата исчезновения"]:
@@ -0,0 +1,349 @@
+# ============================================
+# РАЗОБРАННАЯ ВЫГРУЗКА EXCEL (ОДИН РАЗ НА ФАЙЛ)
+# ============================================
+# Файл "Без привязки" нужен и для отчёта (total / count_30000), и для
+# Google Sheets (список товаров). Раньше он читался дважды, и столбцы
+# артикула/названия искались по разным правилам. Теперь load(path)
+# разбирает файл один раз за запуск, а оба этапа получают один и тот же
+# ParsedExport.
+#
+# Чтение — потоково из XML листа (xlsx — это zip): из строк берутся только
+# столбцы артикула и названия, остальные ячейки не разбираются. Для
+# категорий, где нужна лишь статистика, read_stats() считает total /
+# count_30000 вообще без DataFrame и без названий. Если файл не читается
+# потоково (например, старый .xls), используется pandas.read_excel.
+
+import os
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+
+# Правила поиска столбцов (первое совпадение по подстроке, без учёта регистра)
+SKU_COLUMN_KEYS = ("артикул", "sku")
+NAME_COLUMN_KEYS = ("название", "наименование")
+
+SKU_PREFIX_30000 = "30000"
+
+# {абсолютный путь: ParsedExport} — разобранные в этом запуске файлы
+_parsed = {}
+
+NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+
+def find_column(columns, keys):
+    """Первый столбец, в названии которого есть одна из подстрок keys"""
+    for col in columns:
+        name = str(col).lower()
+        if any(key in name for key in keys):
+            return col
+    return None
+
+
+# ============================================
+# ПОТОКОВОЕ ЧТЕНИЕ XLSX
+# ============================================
+
+def _first_sheet_path(zf):
+    """Путь XML первого листа внутри архива"""
+    try:
+        workbook = ET.fromstring(zf.read("xl/workbook.xml"))
+        sheet = workbook.find(f"{NS_MAIN}sheets/{NS_MAIN}sheet")
+        rel_id = sheet.get(f"{NS_REL}id")
+        rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+        for rel in rels.iter(f"{NS_PKG_REL}Relationship"):
+            if rel.get("Id") == rel_id:
+                target = rel.get("Target")
+                if target.startswith("/"):
+                    return target.lstrip("/")
+                return posixpath.normpath(posixpath.join("xl", target))
+    except (KeyError, AttributeError, ET.ParseError):
+        pass
+    return "xl/worksheets/sheet1.xml"
+
+
+def _column_index(ref):
+    """Номер столбца (с 0) по адресу ячейки: "B12" -> 1"""
+    idx = 0
+    for ch in ref:
+        if ch.isalpha():
+            idx = idx * 26 + (ord(ch.upper()) - 64)
+        else:
+            break
+    return idx - 1
+
+
+def _number_text(raw):
+    """Число из ячейки как текст: "3.00000000001E+11" -> "300000000001" """
+    if "." in raw or "E" in raw or "e" in raw:
+        try:
+            value = float(raw)
+        except ValueError:
+            return raw
+        if value.is_integer():
+            return str(int(value))
+    return raw
+
+
+def _cell_value(cell):
+    """Значение ячейки: строка или ("s", индекс) для общей строки"""
+    cell_type = cell.get("t")
+    if cell_type == "inlineStr":
+        return "".join(t.text or "" for t in cell.iter(f"{NS_MAIN}t"))
+    v = cell.find(f"{NS_MAIN}v")
+    if v is None or v.text is None:
+        return ""
+    if cell_type == "s":
+        return ("s", int(v.text))
+    if cell_type in ("str", "b", "e"):
+        return v.text
+    return _number_text(v.text)
+
+
+def _shared_strings(zf, needed):
+    """Общие строки книги — только с индексами из needed"""
+    strings = {}
+    if not needed:
+        return strings
+    try:
+        source = zf.open("xl/sharedStrings.xml")
+    except KeyError:
+        return strings
+    with source:
+        idx = 0
+        for _, elem in ET.iterparse(source, events=("end",)):
+            if elem.tag != f"{NS_MAIN}si":
+                continue
+            if idx in needed:
+                # <si> — либо <t>, либо фрагменты <r><t>; фонетика <rPh> не нужна
+                parts = []
+                for child in elem:
+                    if child.tag == f"{NS_MAIN}t":
+                        parts.append(child.text or "")
+                    elif child.tag == f"{NS_MAIN}r":
+                        t = child.find(f"{NS_MAIN}t")
+                        parts.append(t.text or "" if t is not None else "")
+                strings[idx] = "".join(parts)
+            idx += 1
+            elem.clear()
+    return strings
+
+
+def stream_columns(file_path, with_names=True):
+    """Потоковое чтение первого листа: (заголовки, артикулы, названия).
+
+    Заголовки — первая строка; из остальных строк берутся только ячейки
+    столбцов артикула и названия (названия — если with_names). Значения —
+    строки без пробелов по краям. Строки без артикула остаются (""), как
+    строки DataFrame у pandas.read_excel: пропущенные в XML строки внутри
+    листа — пустые, пустые строки в конце отбрасываются.
+    ValueError, если нет столбца артикулов.
+    """
+    with zipfile.ZipFile(file_path) as zf:
+        header = {}
+        sku_idx = name_idx = None
+        sku_raw = []
+        name_raw = []
+        needed = set()
+        header_row = None
+        data_rows = 0  # строк данных до последней непустой включительно
+
+        with zf.open(_first_sheet_path(zf)) as sheet:
+            row_no = 0
+            for _, elem in ET.iterparse(sheet, events=("end",)):
+                if elem.tag != f"{NS_MAIN}row":
+                    continue
+                row_no += 1
+                if row_no == 1:
+                    header_row = int(elem.get("r") or 1)
+                    for pos, cell in enumerate(elem):
+                        ref = cell.get("r")
+                        value = _cell_value(cell)
+                        if isinstance(value, tuple):
+                            needed.add(value[1])
+                        header[_column_index(ref) if ref else pos] = value
+                    elem.clear()
+                    # Заголовки нужны сразу — общие строки читаем заранее
+                    strings = _shared_strings(zf, needed)
+                    header = {i: strings.get(v[1], "") if isinstance(v, tuple) else v
+                              for i, v in header.items()}
+                    needed.clear()
+                    order = sorted(header)
+                    columns = [header[i] for i in order]
+                    sku_col = find_column(columns, SKU_COLUMN_KEYS)
+                    if sku_col is None:
+                        raise ValueError(f"Колонка с артикулами не найдена. Есть: {columns}")
+                    sku_idx = order[columns.index(sku_col)]
+                    if with_names:
+                        name_col = find_column(columns, NAME_COLUMN_KEYS)
+                        if name_col is not None:
+                            name_idx = order[columns.index(name_col)]
+                    continue
+
+                # Строки, которых нет в XML (пустые внутри листа), — пустые значения
+                position = int(elem.get("r") or header_row + len(sku_raw) + 1) - header_row - 1
+                while len(sku_raw) < position:
+                    sku_raw.append("")
+                    if name_idx is not None:
+                        name_raw.append("")
+
+                sku = name = ""
+                for pos, cell in enumerate(elem):
+                    ref = cell.get("r")
+                    idx = _column_index(ref) if ref else pos
+                    if idx == sku_idx:
+                        sku = _cell_value(cell)
+                    elif idx == name_idx:
+                        name = _cell_value(cell)
+                # Остальные ячейки смотрим, только если артикула и названия нет
+                has_value = sku != "" or name != "" or any(_cell_value(cell) != "" for cell in elem)
+                elem.clear()
+
+                for value in (sku, name):
+                    if isinstance(value, tuple):
+                        needed.add(value[1])
+                sku_raw.append(sku)
+                if name_idx is not None:
+                    name_raw.append(name)
+                if has_value:
+                    data_rows = len(sku_raw)
+
+        if row_no == 0:
+            raise ValueError("Лист пуст — нет строки заголовков")
+
+        strings = _shared_strings(zf, needed)
+
+    # Пустые строки в конце листа (только оформление) — не данные
+    del sku_raw[data_rows:]
+    del name_raw[data_rows:]
+
+    def resolve(values):
+        return [(strings.get(v[1], "") if isinstance(v, tuple) else v).strip() for v in values]
+
+    skus = resolve(sku_raw)
+    names = resolve(name_raw) if name_idx is not None else [""] * len(skus)
+    return columns, skus, names
+
+
+def read_stats(file_path):
+    """{"total", "count_30000"} без DataFrame и без чтения названий.
+    total — все строки данных, включая строки без артикула (как в отчёте до
+    потокового чтения)"""
+    parsed = _parsed.get(os.path.abspath(file_path))
+    if parsed is not None:
+        return dict(parsed.stats)
+    try:
+        _, skus, _ = stream_columns(file_path, with_names=False)
+    except zipfile.BadZipFile:
+        return dict(ParsedExport.read(file_path).stats)
+    return {
+        "total": len(skus),
+        "count_30000": sum(1 for sku in skus if sku.startswith(SKU_PREFIX_30000)),
+    }
+
+
+class ParsedExport:
+    """Выгрузка Kaspi: нормализованные столбцы артикула и названия.
+
+    skus / names — pandas.Series строк одной длины. Артикулы читаются как
+    текст (без "123.0" от числовых ячеек), пробелы по краям убираются,
+    строки без артикула отбрасываются (rows — число строк данных вместе с
+    ними, оно идёт в stats["total"]). Производные значения (stats, sku_set)
+    считаются при первом обращении и запоминаются.
+    """
+
+    def __init__(self, file_path, columns, skus, names, rows=None):
+        self.file_path = file_path
+        self.columns = columns
+        self.skus = skus
+        self.names = names
+        self.rows = len(skus) if rows is None else rows
+        self._stats = None
+        self._sku_set = None
+
+    @classmethod
+    def read(cls, file_path):
+        """Прочитать файл. ValueError, если нет столбца артикулов"""
+        import pandas as pd
+
+        try:
+            columns, skus, names = stream_columns(file_path)
+        except zipfile.BadZipFile:
+            return cls.read_with_pandas(file_path)
+
+        rows = len(skus)
+        skus = pd.Series(skus, dtype=object)
+        names = pd.Series(names, dtype=object)
+        keep = skus != ""
+        if not keep.all():
+            skus = skus[keep].reset_index(drop=True)
+            names = names[keep].reset_index(drop=True)
+        return cls(file_path, columns, skus, names, rows)
+
+    @classmethod
+    def read_with_pandas(cls, file_path):
+        """Чтение через pandas.read_excel (для файлов, которые не xlsx)"""
+        import pandas as pd
+
+        df = pd.read_excel(file_path, dtype=str)
+        columns = [str(col) for col in df.columns]
+        sku_col = find_column(df.columns, SKU_COLUMN_KEYS)
+        if sku_col is None:
+            raise ValueError(f"Колонка с артикулами не найдена. Есть: {columns}")
+        name_col = find_column(df.columns, NAME_COLUMN_KEYS)
+
+        skus = df[sku_col].fillna("").str.strip()
+        if name_col is not None:
+            names = df[name_col].fillna("").str.strip()
+        else:
+            names = pd.Series("", index=df.index, dtype=object)
+
+        keep = skus != ""
+        skus = skus[keep].reset_index(drop=True)
+        names = names[keep].reset_index(drop=True)
+        return cls(file_path, columns, skus, names, len(df))
+
+    @property
+    def has_names(self):
+        return bool(len(self.names)) and bool((self.names != "").any())
+
+    def __len__(self):
+        return len(self.skus)
+
+    @property
+    def stats(self):
+        """{"total": N, "count_30000": M} — статистика для отчёта
+        (total — строки данных, включая строки без артикула)"""
+        if self._stats is None:
+            self._stats = {
+                "total": self.rows,
+                "count_30000": int(self.skus.str.startswith(SKU_PREFIX_30000).sum()),
+            }
+        return self._stats
+
+    @property
+    def sku_set(self):
+        """Множество артикулов файла (для поиска исчезнувших)"""
+        if self._sku_set is None:
+            self._sku_set = set(self.skus.tolist())
+        return self._sku_set
+
+    def head(self, n=5):
+        """Первые n пар (артикул, название) — для вывода в лог"""
+        return list(zip(self.skus.head(n).tolist(), self.names.head(n).tolist()))
+
+
+def load(file_path):
+    """ParsedExport для файла; повторный вызов с тем же путём не читает файл заново"""
+    key = os.path.abspath(file_path)
+    parsed = _parsed.get(key)
+    if parsed is None:
+        parsed = ParsedExport.read(file_path)
+        _parsed[key] = parsed
+    return parsed
+
+
+def forget(file_path):
+    """Освободить разобранный файл (после того как он больше не нужен)"""
+    _parsed.pop(os.path.abspath(file_path), None)
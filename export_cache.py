@@ -0,0 +1,103 @@
+# ============================================
+# КЭШ ВЫГРУЗОК EXCEL МЕЖДУ ЗАПУСКАМИ
+# ============================================
+# Для каждой пары (мерчант, категория) храним:
+#   count  — счётчик вкладки на момент выгрузки
+#   sha256 — хэш содержимого файла
+#   stats  — результат разбора {"total": N, "count_30000": M}
+#   file   — копия файла в EXPORT_CACHE_DIR (фиксированное имя, перезаписывается)
+#
+# Если счётчик совпал — файл не скачивается и не разбирается, берутся
+# сохранённые копия и статистика. Если файл скачан, но по содержимому
+# совпадает с прошлым (тот же хэш), повторно не разбирается.
+#
+# "Без привязки" скачивается всегда: по его артикулам ведутся задачи в
+# Google Sheets, а при том же количестве товаров состав может быть другим
+# (один ушёл, другой пришёл). Для него работает только проверка по хэшу.
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from config import EXPORT_CACHE_DIR
+
+INDEX_FILE = os.path.join(EXPORT_CACHE_DIR, "index.json")
+
+# Категории, для которых совпадения счётчика мало — файл скачивается всегда
+ALWAYS_DOWNLOAD = {"без_привязки"}
+
+_index = None
+
+
+def _load_index():
+    global _index
+    if _index is None:
+        try:
+            with open(INDEX_FILE, "r", encoding="utf-8") as f:
+                _index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _index = {}
+    return _index
+
+
+def _save_index():
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    tmp_path = INDEX_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(_index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, INDEX_FILE)
+
+
+def _key(merchant_name, category_key):
+    return f"{merchant_name}/{category_key}"
+
+
+def file_sha256(file_path):
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def lookup(merchant_name, category_key):
+    """Запись кэша, если её копия файла на месте и не изменена, иначе None.
+    Для категорий из ALWAYS_DOWNLOAD — всегда None"""
+    if category_key in ALWAYS_DOWNLOAD:
+        return None
+    entry = _load_index().get(_key(merchant_name, category_key))
+    if not entry:
+        return None
+    try:
+        if file_sha256(entry["file"]) != entry["sha256"]:
+            return None
+    except OSError:
+        return None
+    return entry
+
+
+def stats_if_unchanged(merchant_name, category_key, file_path):
+    """Статистика из кэша, если свежескачанный файл совпадает с прошлым по хэшу"""
+    entry = _load_index().get(_key(merchant_name, category_key))
+    if entry and file_sha256(file_path) == entry["sha256"]:
+        return entry["stats"]
+    return None
+
+
+def store(merchant_name, category_key, count, file_path, stats):
+    """Запомнить выгрузку: копия файла, хэш, счётчик и статистика"""
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    _, ext = os.path.splitext(file_path)
+    cached_file = os.path.join(EXPORT_CACHE_DIR, f"{merchant_name}_{category_key}{ext}")
+    shutil.copyfile(file_path, cached_file)
+
+    _load_index()[_key(merchant_name, category_key)] = {
+        "count": count,
+        "sha256": file_sha256(cached_file),
+        "stats": stats,
+        "file": cached_file,
+        "updated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    _save_index()
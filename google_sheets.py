@@ -4,8 +4,14 @@
 
 import os
 import re
-import random
 import gspread
+import excel_export
+from allocator import WeightedAllocator, parse_manager_line
+from sheets_client import RateLimitedHTTPClient
+from config import TASK_LEDGER_FILE, ALLOCATOR_SEED
+from task_ledger import TaskLedger
+from batch_writer import payload_bytes
+from sheet_snapshot import SheetSnapshot, COL_MERCHANT, COL_GONE, COL_DAYS, row_runs
 from datetime import datetime
 from google.oauth2.service_account import Credentials
 
@@ -13,12 +19,12 @@ from google.oauth2.service_account import Credentials
 CREDENTIALS_FILE = os.path.join(os.path.dirname(__file__), "google-credentials.json")
 SPREADSHEET_ID = "16NoTXUjutOw_anh_oSuufYEEfEu6FiHGm9OFnrSkdN8"
 
-# Список менеджеров — загружается из managers.txt (по одному на строку)
-# Если файл не найден, используется список по умолчанию
+# Список менеджеров — загружается из managers.txt (по одному на строку,
+# "ФИО | вес | предел" — вес и предел открытых задач необязательны)
 MANAGERS_FILE = os.path.join(os.path.dirname(__file__), "managers.txt")
 
 def load_managers():
-    """Загрузка списка менеджеров из файла managers.txt.
+    """Загрузка менеджеров из файла managers.txt: [{"name", "weight", "cap"}].
 
     Падает с понятной ошибкой, если файла нет или в нём не осталось
     активных строк — иначе исключённые менеджеры тихо вернулись бы
@@ -30,7 +36,13 @@ def load_managers():
             "Создайте его с одним ФИО на строку (# — комментарий)."
         )
     with open(MANAGERS_FILE, "r", encoding="utf-8") as f:
-        managers = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        lines = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    managers = []
+    for line in lines:
+        try:
+            managers.append(parse_manager_line(line))
+        except ValueError as e:
+            raise RuntimeError(f"Ошибка в {MANAGERS_FILE}: {e}") from e
     if not managers:
         raise RuntimeError(
             f"В {MANAGERS_FILE} нет активных менеджеров (все строки закомментированы или файл пуст). "
@@ -38,7 +50,8 @@ def load_managers():
         )
     return managers
 
-MANAGERS = load_managers()
+MANAGER_SPECS = load_managers()
+MANAGERS = [spec["name"] for spec in MANAGER_SPECS]
 
 # Цвета для подсветки (RGB от 0 до 1)
 COLOR_RED = {"red": 1.0, "green": 0.8, "blue": 0.8}      # Красный фон (ARG)
@@ -56,13 +69,45 @@ def get_sheet():
         "https://www.googleapis.com/auth/drive"
     ]
     creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=scopes)
-    client = gspread.authorize(creds)
+    # Все запросы — через клиент с бюджетом квоты и повторами (sheets_client)
+    client = gspread.authorize(creds, http_client=RateLimitedHTTPClient)
     spreadsheet = client.open_by_key(SPREADSHEET_ID)
     return spreadsheet
 
 
-def get_or_create_month_sheet(spreadsheet, month_name=None):
-    """Получить или создать лист для текущего месяца"""
+class PlannedSheet:
+    """Лист, который будет создан при применении (режим плана): пустой, без id"""
+
+    id = None
+
+    def __init__(self, spreadsheet, title):
+        self.spreadsheet = spreadsheet
+        self.title = title
+
+
+# Создание месячного листа: add_worksheet + append_row(COLUMNS) + format
+NEW_SHEET_CALLS = 3
+
+
+def migration_calls(sheet, row_count):
+    """Вызовы API миграции листа без столбца "Кабинет" (как в get_or_create_month_sheet):
+    [(метод, тело запроса)]. row_count — строк на листе вместе с заголовком"""
+    calls = [
+        ("spreadsheet.batch_update (insert_cols)", {"requests": [{"insertDimension": {
+            "range": {"sheetId": sheet.id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": 1},
+            "inheritFromBefore": False,
+        }}]}),
+        ("values_append (insert_cols)", {"majorDimension": "COLUMNS", "values": [["Кабинет"]]}),
+    ]
+    if row_count > 1:
+        calls.append((f"update A2:A{row_count}", {"values": [["Sulpak"] for _ in range(row_count - 1)]}))
+    return calls
+
+
+def get_or_create_month_sheet(spreadsheet, month_name=None, plan=False, totals=None):
+    """Получить или создать лист для текущего месяца.
+    plan=True — ничего не создавать и не мигрировать (для отсутствующего листа — PlannedSheet),
+    вызовы API, которые понадобились бы, печатаются и добавляются в totals (см. print_plan)"""
     if month_name is None:
         # Формат: "2026-02" для февраля 2026
         month_name = datetime.now().strftime("%Y-%m")
@@ -74,7 +119,10 @@ def get_or_create_month_sheet(spreadsheet, month_name=None):
 
         # Проверяем, есть ли столбец "Кабинет" (миграция старых листов)
         headers = sheet.row_values(1)
-        if headers and headers[0] != "Кабинет":
+        if headers and headers[0] != "Кабинет" and plan:
+            print("  [PLAN] Миграция листа: добавление столбца 'Кабинет'")
+            print_plan_calls(migration_calls(sheet, len(sheet.get_all_values())), totals)
+        elif headers and headers[0] != "Кабинет":
             print(f"  [INFO] Миграция листа: добавление столбца 'Кабинет'...")
             # Вставляем новый столбец A
             sheet.insert_cols([["Кабинет"]], col=1)
@@ -86,6 +134,11 @@ def get_or_create_month_sheet(spreadsheet, month_name=None):
             print(f"  [OK] Миграция завершена")
 
     except gspread.WorksheetNotFound:
+        if plan:
+            print(f"  [PLAN] Лист {month_name} будет создан ({NEW_SHEET_CALLS} вызова API)")
+            if totals is not None:
+                totals["calls"] += NEW_SHEET_CALLS
+            return PlannedSheet(spreadsheet, month_name)
         # Создаём новый лист с заголовками
         sheet = spreadsheet.add_worksheet(title=month_name, rows=1000, cols=10)
         sheet.append_row(COLUMNS)
@@ -103,224 +156,154 @@ def get_existing_skus(sheet):
     Если товар исчез и вернулся — он считается новым (не активным).
     """
     try:
-        # Получаем все значения из столбцов A (кабинет) и B (артикулы)
-        all_data = sheet.get_all_values()
-        # Создаём set кортежей (кабинет, артикул) для уникальности
-        skus = set()
-        for row in all_data[1:]:  # Пропускаем заголовок
-            if len(row) >= 2:
-                merchant = row[0]  # Столбец A — Кабинет
-                sku = row[1]       # Столбец B — Артикул
-                date_disappeared = row[6] if len(row) > 6 else ""
-                # Только активные записи (без даты исчезновения)
-                if not date_disappeared:
-                    skus.add((merchant, sku))
-        return skus
+        return set(SheetSnapshot(sheet).active)
     except Exception as e:
         print(f"  [WARN] Ошибка получения артикулов: {e}")
         return set()
 
 
-def get_sku_rows(sheet):
-    """
-    Получить словарь активных артикулов с номерами строк и кабинетами.
-    Учитываются только записи с пустым столбцом G (Дата исчезновения),
-    чтобы вернувшийся после исчезновения товар добавлялся заново.
-    """
-    try:
-        all_data = sheet.get_all_values()
-        sku_map = {}
-        for i, row in enumerate(all_data[1:], start=2):
-            if len(row) >= 2:
-                sku = row[1]       # Столбец B — Артикул
-                merchant = row[0]  # Столбец A — Кабинет
-                date_disappeared = row[6] if len(row) > 6 else ""
-                # Только активные записи (без даты исчезновения)
-                if not date_disappeared:
-                    sku_map[sku] = {"row": i, "merchant": merchant}
-        return sku_map
-    except Exception as e:
-        print(f"  [WARN] Ошибка получения артикулов: {e}")
-        return {}
-
-
-def get_manager_loads(sheet):
-    """Получить загрузку всех менеджеров одним запросом"""
-    try:
-        all_data = sheet.get_all_values()
-        loads = {manager: 0 for manager in MANAGERS}
+# Коды цвета строки (индекс в ROW_COLORS)
+COLOR_CODE_WHITE, COLOR_CODE_RED, COLOR_CODE_GREEN = 0, 1, 2
+ROW_COLORS = [COLOR_WHITE, COLOR_RED, COLOR_GREEN]
 
-        for row in all_data[1:]:  # Пропускаем заголовок
-            # Столбец E (индекс 4) — Менеджер
-            # Столбец F (индекс 5) — Отметка менеджера (пусто = не завершено)
-            if len(row) > 5 and row[4] in loads and not row[5]:
-                loads[row[4]] += 1
+# Бренд ARG — слово отдельно (не как часть другого слова)
+ARG_PATTERN = r'\bARG\b'
 
-        return loads
-    except Exception as e:
-        print(f"  [WARN] Ошибка подсчёта задач: {e}")
-        return {manager: 0 for manager in MANAGERS}
 
+def row_color_codes(skus, names):
+    """Коды цвета для столбцов артикулов и названий целиком (pandas.Series).
 
-def get_least_loaded_manager(loads):
-    """Найти менеджера с минимальной загрузкой"""
-    return min(loads, key=loads.get)
+    ARG в названии — красный, иначе артикул не на 30000 — зелёный,
+    остальные — белый.
+    """
+    import numpy as np
 
+    is_arg = names.str.contains(ARG_PATTERN, case=False, regex=True).to_numpy(dtype=bool)
+    not_30000 = ~skus.str.startswith(excel_export.SKU_PREFIX_30000).to_numpy(dtype=bool)
+    return np.select([is_arg, not_30000], [COLOR_CODE_RED, COLOR_CODE_GREEN], COLOR_CODE_WHITE)
 
-def is_arg_product(product_name):
-    """Проверить, содержит ли название бренд ARG"""
-    # Ищем слово ARG отдельно (не как часть другого слова)
-    return bool(re.search(r'\bARG\b', product_name, re.IGNORECASE))
 
+def product_columns(products):
+    """(skus, names) как pandas.Series строк из ParsedExport или списка словарей"""
+    import pandas as pd
 
-def is_not_30000(sku):
-    """Проверить, что артикул НЕ начинается на 30000"""
-    return not str(sku).startswith("30000")
+    if hasattr(products, "skus"):
+        return products.skus, products.names
+    skus = pd.Series([str(p["sku"]) for p in products], dtype=object)
+    names = pd.Series([p["name"] for p in products], dtype=object)
+    return skus, names
 
 
-def add_products_to_sheet(sheet, products, merchant_name="Sulpak"):
+def add_products_to_sheet(snapshot, products, merchant_name="Sulpak"):
     """
     Добавить товары в таблицу
-    products: список словарей {"sku": "123", "name": "Товар..."}
+    snapshot: SheetSnapshot месячного листа (изменения уходят при snapshot.flush())
+    products: ParsedExport (excel_export) или список словарей {"sku": "123", "name": "Товар..."}
     merchant_name: название кабинета (Sulpak, ARG и т.д.)
     Если артикул уже есть в другом кабинете — добавляем кабинет через "+"
     Возвращает количество добавленных
+
+    Отбор новых артикулов и цвета строк считаются по столбцам целиком,
+    без цикла по товарам.
     """
-    existing_skus = get_existing_skus(sheet)  # set of (merchant, sku)
-    sku_rows = get_sku_rows(sheet)  # {sku: {"row": N, "merchant": "Sulpak"}}
     today = datetime.now().strftime("%d.%m.%Y")
 
-    # Получаем загрузку всех менеджеров одним запросом
-    loads = get_manager_loads(sheet)
+    # Загрузка менеджеров — из индекса снимка
+    loads = snapshot.manager_loads(MANAGERS)
 
-    added_count = 0
-    merged_count = 0
-    rows_to_add = []
-    row_colors = []
-
-    for product in products:
-        sku = str(product["sku"])
-        name = product["name"]
-
-        # Пропускаем если уже есть именно в этом кабинете
-        if (merchant_name, sku) in existing_skus:
-            continue
-
-        # Если артикул есть в другом кабинете — обновляем столбец "Кабинет" через "+"
-        if sku in sku_rows:
-            info = sku_rows[sku]
-            current_merchant = info["merchant"]
-            row_num = info["row"]
-            # Проверяем что наш кабинет ещё не в списке
-            if merchant_name not in current_merchant:
-                new_merchant = f"{current_merchant}+{merchant_name}"
-                sheet.update_cell(row_num, 1, new_merchant)
-                # Обновляем локальный кэш
-                sku_rows[sku]["merchant"] = new_merchant
-                merged_count += 1
-            existing_skus.add((merchant_name, sku))
-            continue
-
-        # Случайный выбор менеджера с минимальной загрузкой
-        min_load = min(loads.values())
-        candidates = [m for m, load in loads.items() if load == min_load]
-        manager = random.choice(candidates)
-        loads[manager] += 1
-
-        # Добавляем строку (с кабинетом в первом столбце)
-        row = [merchant_name, sku, name, today, manager, "", ""]
-        rows_to_add.append(row)
-
-        # Определяем цвет
-        if is_arg_product(name):
-            row_colors.append(COLOR_RED)
-        elif is_not_30000(sku):
-            row_colors.append(COLOR_GREEN)
-        else:
-            row_colors.append(COLOR_WHITE)
-
-        existing_skus.add((merchant_name, sku))
-        sku_rows[sku] = {"row": -1, "merchant": merchant_name}  # -1 т.к. ещё не записана
-        added_count += 1
-
-    # Пакетное добавление строк
-    if rows_to_add:
-        sheet.append_rows(rows_to_add, value_input_option="USER_ENTERED")
-        print(f"  [OK] Добавлено строк: {len(rows_to_add)}")
-
-        # Применяем цвета пакетно через Sheets API
-        all_values = sheet.get_all_values()
-        start_row = len(all_values) - len(rows_to_add) + 1
-
-        color_requests = []
-        for i, color in enumerate(row_colors):
-            if color != COLOR_WHITE:
-                row_idx = start_row + i - 1  # 0-based для API
-                color_requests.append({
-                    "repeatCell": {
-                        "range": {
-                            "sheetId": sheet.id,
-                            "startRowIndex": row_idx,
-                            "endRowIndex": row_idx + 1,
-                            "startColumnIndex": 0,
-                            "endColumnIndex": 8
-                        },
-                        "cell": {
-                            "userEnteredFormat": {"backgroundColor": color}
-                        },
-                        "fields": "userEnteredFormat.backgroundColor"
-                    }
-                })
-
-        if color_requests:
-            sheet.spreadsheet.batch_update({"requests": color_requests})
-            print(f"  [OK] Цвета применены ({len(color_requests)} строк)")
+    skus, names = product_columns(products)
 
+    # Повтор артикула внутри файла учитывается один раз (первое вхождение)
+    first = ~skus.duplicated()
+    skus, names = skus[first], names[first]
+
+    # Пропускаем те, что уже есть именно в этом кабинете
+    is_new = ~skus.isin(snapshot.active_skus(merchant_name))
+    in_other = skus.isin(snapshot.sku_rows.keys())
+
+    # Если артикул есть в другом кабинете — обновляем столбец "Кабинет" через "+"
+    merged_count = 0
+    for sku in skus[is_new & in_other].tolist():
+        row_num = snapshot.sku_rows[sku]
+        current_merchant = snapshot.get(row_num, COL_MERCHANT)
+        # Проверяем что наш кабинет ещё не в списке
+        if merchant_name not in current_merchant:
+            # В очередь — уйдёт одним batch_update вместе с остальными значениями
+            snapshot.add_merchant(row_num, merchant_name)
+            merged_count += 1
+
+    # Новые строки (с кабинетом в первом столбце) и их цвета
+    to_add = is_new & ~in_other
+    add_skus = skus[to_add]
+    add_names = names[to_add]
+    row_colors = row_color_codes(add_skus, add_names)
+    allocator = WeightedAllocator(MANAGER_SPECS, loads, seed=ALLOCATOR_SEED)
+    managers = allocator.assign(len(add_skus))
+
+    # Номера новых строк — предварительные; flush() уточнит их по ответу append
+    row_nums = [
+        snapshot.append_row([merchant_name, sku, name, today, manager, "", ""])
+        for sku, name, manager in zip(add_skus.tolist(), add_names.tolist(), managers)
+    ]
+    added_count = len(row_nums)
+
+    # Фон новых строк — по фактическим номерам после append (см. SheetSnapshot.flush)
+    colored = 0
+    for i in (row_colors != COLOR_CODE_WHITE).nonzero()[0].tolist():
+        snapshot.set_background(row_nums[i], ROW_COLORS[row_colors[i]])
+        colored += 1
+
+    if added_count:
+        print(f"  [OK] Подготовлено строк: {added_count} (цветных: {colored})")
+        print("  [INFO] Распределение задач по менеджерам:")
+        for line in allocator.report():
+            print(line)
+    if allocator.unassigned:
+        print(f"  [WARN] Все менеджеры на пределе — без менеджера: {allocator.unassigned}")
     if merged_count > 0:
         print(f"  [INFO] Объединено кабинетов (артикул в нескольких): {merged_count}")
 
     return added_count
 
 
-def check_disappeared_products(sheet, current_skus, merchant_name="Sulpak"):
+def check_disappeared_products(snapshot, current_skus, merchant_name="Sulpak", row_nums=None):
     """
     Проверить исчезнувшие товары и поставить дату исчезновения (пакетно)
+    snapshot: SheetSnapshot листа (даты уходят при snapshot.flush())
     current_skus: set артикулов из текущего файла "Без привязки"
     merchant_name: проверяем только для конкретного кабинета
+    row_nums: проверить только эти строки (по умолчанию — все строки кабинета)
     """
     today = datetime.now().strftime("%d.%m.%Y")
     current_skus_set = set(str(s) for s in current_skus)
 
-    all_data = sheet.get_all_values()
-    updates = []
-
-    for i, row in enumerate(all_data[1:], start=2):
-        if len(row) < 7:
-            continue
-
-        merchant = row[0]           # Столбец A — Кабинет
+    marked = 0
+    # Только строки нужного кабинета (индекс снимка); копия — set_value меняет индекс
+    if row_nums is None:
+        row_nums = snapshot.merchant_rows.get(merchant_name, ())
+    for row_num in sorted(row_nums):
+        if row_num > snapshot.stored_rows:
+            continue  # только что добавленные в этом запуске
+        row = snapshot.row(row_num)
         sku = row[1]                # Столбец B — Артикул
         date_disappeared = row[6]   # Столбец G — Дата исчезновения
 
-        # Проверяем только для нужного кабинета
-        if merchant != merchant_name:
-            continue
-
         # Если артикул исчез и дата ещё не проставлена
         if sku not in current_skus_set and not date_disappeared:
-            updates.append({"range": f"G{i}", "values": [[today]]})
+            snapshot.set_value(row_num, COL_GONE, today)
+            marked += 1
 
-    if updates:
-        sheet.batch_update(updates, value_input_option="USER_ENTERED")
-        print(f"  [OK] Отмечено исчезнувших ({merchant_name}): {len(updates)}")
+    if marked:
+        print(f"  [OK] Отмечено исчезнувших ({merchant_name}): {marked}")
 
-    return len(updates)
+    return marked
 
 
-def check_previous_month(spreadsheet, current_skus, merchant_name="Sulpak"):
+def check_previous_month(spreadsheet, current_skus, merchant_name="Sulpak", plan=None):
     """
     Проверить предыдущий месяц на незакрытые записи (без даты исчезновения).
     Если товар исчез из текущего файла — проставить дату исчезновения.
+    plan: итоги плана (см. print_plan) — изменения не отправляются
     """
     from dateutil.relativedelta import relativedelta
 
@@ -332,56 +315,229 @@ def check_previous_month(spreadsheet, current_skus, merchant_name="Sulpak"):
         print(f"    [INFO] Лист {prev_month} не найден, пропускаем")
         return 0
 
-    updated = check_disappeared_products(prev_sheet, current_skus, merchant_name)
+    prev_snapshot = SheetSnapshot(prev_sheet)
+    updated = check_disappeared_products(prev_snapshot, current_skus, merchant_name)
 
     # Обновляем формулы столбца H в предыдущем месяце тоже
     if updated > 0:
-        setup_days_column(prev_sheet)
+        setup_days_column(prev_snapshot)
+    if plan is not None:
+        print_plan(prev_snapshot, plan)
+    else:
+        prev_snapshot.flush()
 
     return updated
 
 
-def setup_days_column(sheet):
+# Правила условного форматирования столбца H: (условие, формат).
+# Индекс правила на листе — позиция в списке (ОБМАН важнее чисел).
+DAYS_RULES = [
+    # Красный жирный для "ОБМАН" (отметка менеджера есть, а товар не исчез)
+    (
+        {"type": "TEXT_EQ", "values": [{"userEnteredValue": "ОБМАН"}]},
+        {"backgroundColor": {"red": 1.0, "green": 0.6, "blue": 0.6}, "textFormat": {"bold": True}},
+    ),
+    # Красный для значений > 3
+    (
+        {"type": "NUMBER_GREATER", "values": [{"userEnteredValue": "3"}]},
+        {"backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.8}},
+    ),
+    # Зелёный для значений 1-3
+    (
+        {"type": "NUMBER_BETWEEN", "values": [{"userEnteredValue": "1"}, {"userEnteredValue": "3"}]},
+        {"backgroundColor": {"red": 0.8, "green": 1.0, "blue": 0.8}},
+    ),
+]
+
+
+# Формат чисел столбца H (иначе разность дат показывается как дата)
+DAYS_NUMBER_FORMAT = {"type": "NUMBER", "pattern": "0"}
+
+
+def days_formula(i):
+    """Формула "Дней до решения" для строки i.
+    Приоритет: ОБМАН (F заполнена, G пустая) > G-D (если G есть) > пусто
+    """
+    return f'=ЕСЛИ(И(F{i}<>"";G{i}="");"ОБМАН";ЕСЛИ(G{i}<>"";ЦЕЛОЕ(G{i}-D{i});""))'
+
+
+def rule_signature(condition):
+    """Условие правила в сравнимом виде: (тип, значения)"""
+    values = tuple(v.get("userEnteredValue", "") for v in condition.get("values", []))
+    return condition.get("type"), values
+
+
+def fetch_days_column_state(snapshot):
+    """Одно чтение метаданных листа: что из настройки столбца H уже есть.
+
+    Возвращает {"rules": {подпись: [индексы правил]}, "validation": bool,
+    "formula_rows": set номеров строк, где в H уже стоит формула}.
+    """
+    sheet = snapshot.sheet
+    if sheet.id is None:
+        # Лист ещё не создан (план) — настроек нет
+        return {"rules": {}, "rule_count": 0, "validation": False, "formula_rows": set()}
+    title = sheet.title.replace("'", "''")
+    ranges = [f"'{title}'!F2"]
+    if snapshot.stored_rows >= 2:
+        ranges.append(f"'{title}'!H2:H{snapshot.stored_rows}")
+    metadata = sheet.spreadsheet.fetch_sheet_metadata(params={
+        "ranges": ranges,
+        "fields": "sheets(properties(sheetId),conditionalFormats,"
+                  "data(startRow,startColumn,rowData(values(userEnteredValue,dataValidation))))",
+    })
+    snapshot.api_calls += 1
+    snapshot.reads += 1
+
+    state = {"rules": {}, "rule_count": 0, "validation": False, "formula_rows": set()}
+    sheet_meta = next((sm for sm in metadata.get("sheets", [])
+                       if sm.get("properties", {}).get("sheetId") == sheet.id), {})
+
+    rules = sheet_meta.get("conditionalFormats", [])
+    state["rule_count"] = len(rules)
+    for index, rule in enumerate(rules):
+        on_h = any(r.get("startColumnIndex", 0) <= 7 < r.get("endColumnIndex", 8)
+                   for r in rule.get("ranges", []))
+        condition = rule.get("booleanRule", {}).get("condition")
+        if on_h and condition:
+            state["rules"].setdefault(rule_signature(condition), []).append(index)
+
+    for grid in sheet_meta.get("data", []):
+        start_row = grid.get("startRow", 0)
+        column = grid.get("startColumn", 0)
+        for offset, row_data in enumerate(grid.get("rowData", [])):
+            cell = (row_data.get("values") or [{}])[0]
+            if column == 5:
+                condition = cell.get("dataValidation", {}).get("condition", {})
+                state["validation"] = condition.get("type") == "DATE_IS_VALID"
+            elif column == 7 and "formulaValue" in cell.get("userEnteredValue", {}):
+                state["formula_rows"].add(start_row + offset + 1)
+    return state
+
+
+MONTH_SHEET_RE = re.compile(r"\d{4}-\d{2}")
+
+
+def index_month_sheets(spreadsheet, ledger):
+    """Листы "YYYY-MM" таблицы: {месяц: лист}. Месяцы, которых ещё нет
+    в реестре, читаются один раз целиком и попадают в индекс открытых задач."""
+    sheets = {ws.title: ws for ws in spreadsheet.worksheets() if MONTH_SHEET_RE.fullmatch(ws.title)}
+    known = ledger.months()
+    for month in sorted(set(sheets) - known):
+        ledger.import_month(month, sheets[month].get_all_values())
+        print(f"    [OK] Реестр задач: лист {month} добавлен в индекс")
+    return sheets
+
+
+def close_disappeared_across_months(spreadsheet, ledger, current_skus, merchant_name, current_month,
+                                    plan=None):
+    """
+    Закрыть открытые задачи кабинета во всех прошлых месяцах, чьих артикулов
+    нет в текущем файле. Кандидаты — из индекса открытых задач реестра
+    (проверка каждого артикула по множеству), запись — только в листы,
+    где что-то исчезло. Перед записью лист сверяется с реестром по столбцу B.
+    Возвращает количество закрытых задач.
+    plan: итоги плана (см. print_plan) — изменения не отправляются и не пишутся в реестр
+    """
+    current_skus_set = set(str(s) for s in current_skus)
+    sheets = index_month_sheets(spreadsheet, ledger)
+
+    stale = {}
+    for month, row_num, sku in ledger.open_tasks(merchant_name, exclude_month=current_month):
+        if sku not in current_skus_set:
+            stale.setdefault(month, []).append(row_num)
+    if not stale:
+        return 0
+
+    closed = 0
+    for month, row_nums in sorted(stale.items()):
+        sheet = sheets.get(month)
+        if sheet is None:
+            continue  # лист удалён из таблицы
+        values = ledger.load_month(month)
+        if ledger.pull_marks(sheet, values) is None:
+            # Строки сдвинули вручную — пересобираем месяц и ищем заново
+            print(f"    [INFO] Лист {month} расходится с реестром — читаем целиком")
+            values = sheet.get_all_values()
+            ledger.import_month(month, values)
+            row_nums = [row_num for m, row_num, sku in ledger.open_tasks(merchant_name)
+                        if m == month and sku not in current_skus_set]
+
+        snapshot = SheetSnapshot(sheet, values=values)
+        marked = check_disappeared_products(snapshot, current_skus_set, merchant_name, row_nums)
+        if marked:
+            setup_days_column(snapshot)
+        if plan is not None:
+            print_plan(snapshot, plan)
+        else:
+            snapshot.flush()
+            ledger.save_rows(month, snapshot, snapshot.touched)
+        print(f"    {month}: закрыто {marked}")
+        closed += marked
+    return closed
+
+
+def setup_days_column(snapshot):
     """
     Настройка столбца H (Дней до решения):
     - Если F (отметка) есть, а G (исчезновение) нет — "ОБМАН"
     - Если G заполнена — G - D (дата исчезновения - дата добавления)
     - Зелёный: 1-3 дня (норма)
     - Красный: > 3 дней (долго), ОБМАН
+    Идемпотентно: по одному чтению метаданных дописывается только то, чего
+    нет — формулы и числовой формат для строк без формулы (в т.ч. новых),
+    недостающие правила; дубли правил от прошлых запусков удаляются.
+    Все изменения ставятся в очередь snapshot и уходят при snapshot.flush().
     """
-    all_data = sheet.get_all_values()
-    if len(all_data) <= 1:
+    row_count = snapshot.row_count
+    if row_count <= 1:
         return  # Только заголовок
+    sheet = snapshot.sheet
 
     # Проверяем, есть ли столбец H
-    headers = all_data[0]
-    if len(headers) < 8 or headers[7] != "Дней до решения":
-        sheet.update_cell(1, 8, "Дней до решения")
-        sheet.format("H1", {"textFormat": {"bold": True}})
-
-    # Обновляем формулы для всех строк
-    # Приоритет: ОБМАН (F заполнена, G пустая) > G-D (если G есть) > пусто
-    updates = []
-    for i in range(2, len(all_data) + 1):
-        formula = f'=ЕСЛИ(И(F{i}<>"";G{i}="");"ОБМАН";ЕСЛИ(G{i}<>"";ЦЕЛОЕ(G{i}-D{i});""))'
-        updates.append({"range": f"H{i}", "values": [[formula]]})
-
-    if updates:
-        sheet.batch_update(updates, value_input_option="USER_ENTERED")
-
-    # Принудительно задаём числовой формат для столбца H (чтобы не показывало дату)
-    try:
-        sheet.format(f"H2:H{len(all_data)}", {"numberFormat": {"type": "NUMBER", "pattern": "0"}})
-    except Exception:
-        pass
+    headers = snapshot.header
+    if headers[7] != "Дней до решения":
+        snapshot.set_value(1, COL_DAYS, "Дней до решения")
+        snapshot.queue_format(column_h_format_request(sheet.id, 0, 1, {"textFormat": {"bold": True}}))
 
-    # Условное форматирование и валидация
     try:
-        spreadsheet = sheet.spreadsheet
+        state = fetch_days_column_state(snapshot)
+    except Exception as e:
+        # Без метаданных не трогаем правила — только формулы новых строк
+        print(f"  [WARN] Не удалось прочитать настройки листа: {e}")
+        state = None
+
+    # Формулы — только там, где их ещё нет. Новые строки — после append,
+    # по фактическим номерам и вместе с числовым форматом (set_formula)
+    new_rows = range(snapshot.stored_rows + 1, row_count + 1)
+    for i in new_rows:
+        snapshot.set_formula(i, COL_DAYS, days_formula, number_format=DAYS_NUMBER_FORMAT)
+    stored_missing = [] if state is None else [
+        i for i in range(2, snapshot.stored_rows + 1) if i not in state["formula_rows"]
+    ]
+    for i in stored_missing:
+        snapshot.set_value(i, COL_DAYS, days_formula(i))
+    missing = stored_missing + list(new_rows)
+
+    # Числовой формат для столбца H (чтобы не показывало дату) — тем же строкам
+    for first, last in row_runs(stored_missing):
+        snapshot.queue_format(column_h_format_request(
+            sheet.id, first - 1, last, {"numberFormat": DAYS_NUMBER_FORMAT}
+        ))
+
+    if state is None:
+        return
 
-        requests = [
-            # Красный жирный для "ОБМАН" (отметка менеджера есть, а товар не исчез)
-            {
+    # Условное форматирование: недостающие правила добавляем, лишние копии удаляем
+    deletions = []
+    additions = []
+    for condition, _ in DAYS_RULES:
+        indexes = state["rules"].get(rule_signature(condition), [])
+        deletions.extend(indexes[1:])
+    rule_count = state["rule_count"] - len(deletions)
+    for position, (condition, fmt) in enumerate(DAYS_RULES):
+        if not state["rules"].get(rule_signature(condition)):
+            additions.append({
                 "addConditionalFormatRule": {
                     "rule": {
                         "ranges": [{
@@ -390,163 +546,208 @@ def setup_days_column(sheet):
                             "endColumnIndex": 8,
                             "startRowIndex": 1
                         }],
-                        "booleanRule": {
-                            "condition": {
-                                "type": "TEXT_EQ",
-                                "values": [{"userEnteredValue": "ОБМАН"}]
-                            },
-                            "format": {
-                                "backgroundColor": {"red": 1.0, "green": 0.6, "blue": 0.6},
-                                "textFormat": {"bold": True}
-                            }
-                        }
-                    },
-                    "index": 0
-                }
-            },
-            # Красный для значений > 3
-            {
-                "addConditionalFormatRule": {
-                    "rule": {
-                        "ranges": [{
-                            "sheetId": sheet.id,
-                            "startColumnIndex": 7,
-                            "endColumnIndex": 8,
-                            "startRowIndex": 1
-                        }],
-                        "booleanRule": {
-                            "condition": {
-                                "type": "NUMBER_GREATER",
-                                "values": [{"userEnteredValue": "3"}]
-                            },
-                            "format": {
-                                "backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.8}
-                            }
-                        }
+                        "booleanRule": {"condition": condition, "format": fmt}
                     },
-                    "index": 1
+                    "index": min(position, rule_count)
                 }
-            },
-            # Зелёный для значений 1-3
-            {
-                "addConditionalFormatRule": {
-                    "rule": {
-                        "ranges": [{
-                            "sheetId": sheet.id,
-                            "startColumnIndex": 7,
-                            "endColumnIndex": 8,
-                            "startRowIndex": 1
-                        }],
-                        "booleanRule": {
-                            "condition": {
-                                "type": "NUMBER_BETWEEN",
-                                "values": [
-                                    {"userEnteredValue": "1"},
-                                    {"userEnteredValue": "3"}
-                                ]
-                            },
-                            "format": {
-                                "backgroundColor": {"red": 0.8, "green": 1.0, "blue": 0.8}
-                            }
-                        }
+            })
+            rule_count += 1
+    # Удаляем с конца, чтобы индексы остальных правил не сдвигались
+    for index in sorted(deletions, reverse=True):
+        snapshot.queue_format({"deleteConditionalFormatRule": {"sheetId": sheet.id, "index": index}})
+    for request in additions:
+        snapshot.queue_format(request)
+
+    # Data Validation для столбца F (Отметка менеджера) — только дата.
+    # Новые строки могут выйти за сетку листа — тогда задаём заново (перезапись, не дубль)
+    if not state["validation"] or row_count > snapshot.stored_rows:
+        snapshot.queue_format({
+            "setDataValidation": {
+                "range": {
+                    "sheetId": sheet.id,
+                    "startColumnIndex": 5,  # F = индекс 5
+                    "endColumnIndex": 6,
+                    "startRowIndex": 1
+                },
+                "rule": {
+                    "condition": {
+                        "type": "DATE_IS_VALID"
                     },
-                    "index": 2
-                }
-            },
-            # Data Validation для столбца F (Отметка менеджера) — только дата
-            {
-                "setDataValidation": {
-                    "range": {
-                        "sheetId": sheet.id,
-                        "startColumnIndex": 5,  # F = индекс 5
-                        "endColumnIndex": 6,
-                        "startRowIndex": 1
-                    },
-                    "rule": {
-                        "condition": {
-                            "type": "DATE_IS_VALID"
-                        },
-                        "strict": True,
-                        "showCustomUi": True
-                    }
+                    "strict": True,
+                    "showCustomUi": True
                 }
             }
-        ]
-
-        spreadsheet.batch_update({"requests": requests})
-        print("  [OK] Столбец 'Дней до решения' настроен (G-D, зелёный 1-3, красный >3)")
-
-    except Exception as e:
-        print(f"  [WARN] Ошибка настройки условного форматирования: {e}")
-
-
-def process_products_file(excel_path, merchant_name="Sulpak"):
+        })
+
+    if missing or deletions or additions:
+        print(f"  [OK] Столбец 'Дней до решения': формул {len(missing)}, "
+              f"правил добавлено {len(additions)}, дублей удалено {len(deletions)}")
+    else:
+        print("  [OK] Столбец 'Дней до решения' уже настроен — изменений нет")
+
+
+def column_h_format_request(sheet_id, start_row_idx, end_row_idx, fmt):
+    """repeatCell для столбца H в строках [start_row_idx, end_row_idx) (с 0)"""
+    fields = ",".join(f"userEnteredFormat.{key}" for key in fmt)
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": start_row_idx,
+                "endRowIndex": end_row_idx,
+                "startColumnIndex": 7,
+                "endColumnIndex": 8
+            },
+            "cell": {"userEnteredFormat": fmt},
+            "fields": fields
+        }
+    }
+
+
+def print_plan(snapshot, totals):
+    """Режим плана (--plan): изменения листа в виде diff и вызовы API, которые
+    сделал бы snapshot.flush(), — с размером тела каждого. Ничего не отправляется.
+    totals — {"calls", "bytes"}, куда добавляются вызовы этого листа."""
+    calls = snapshot.plan()
+    print(f"  [PLAN] Лист {snapshot.sheet.title}:")
+    for line in snapshot.plan_diff():
+        print(line)
+    if not calls:
+        print("    Изменений нет")
+    return print_plan_calls(calls, totals)
+
+
+def print_plan_calls(calls, totals=None):
+    """Вызовы API плана с размером тела каждого; итог добавляется в totals"""
+    size_total = 0
+    for method, body in calls:
+        size = payload_bytes(body)
+        size_total += size
+        print(f"    {method}: {size} байт")
+    if totals is not None:
+        totals["calls"] += len(calls)
+        totals["bytes"] += size_total
+    return len(calls), size_total
+
+
+def load_snapshot(sheet, ledger):
+    """SheetSnapshot листа: из реестра задач, если он совпадает с таблицей.
+
+    Из таблицы читаются только артикулы (B) и отметки менеджеров (F).
+    Если реестра нет или строки не совпали — лист читается целиком,
+    и месяц в реестре пересобирается.
+    """
+    if ledger:
+        values = ledger.load_month(sheet.title)
+        if values is not None:
+            pulled = ledger.pull_marks(sheet, values)
+            if pulled is not None:
+                print(f"  [OK] Реестр задач: {len(values) - 1} строк, отметок из таблицы: {pulled}")
+                snapshot = SheetSnapshot(sheet, values=values)
+                snapshot.reads = 1
+                snapshot.api_calls = 1
+                return snapshot
+            print("  [INFO] Реестр задач расходится с таблицей — читаем лист целиком")
+
+    snapshot = SheetSnapshot(sheet)
+    if ledger:
+        ledger.import_month(sheet.title, snapshot.values)
+        print(f"  [OK] Реестр задач: месяц {sheet.title} загружен из таблицы")
+    return snapshot
+
+
+def process_products_file(excel_path, merchant_name="Sulpak", plan=False):
     """
     Основная функция: обработать файл "Без привязки"
     - Добавить новые товары в таблицу
     - Отметить исчезнувшие
     merchant_name: название кабинета (Sulpak, ARG и т.д.)
+    plan: только показать изменения и число вызовов API (--plan), ничего не записывая
     """
-    import pandas as pd
-
     print("\n" + "="*50)
     print(f"ОБРАБОТКА GOOGLE SHEETS ({merchant_name})")
     print("="*50)
 
-    # Читаем Excel
+    # Файл уже разобран на этапе отчёта — берём тот же ParsedExport
     print(f"[1] Чтение файла: {excel_path}")
-    df = pd.read_excel(excel_path)
-
-    # Находим столбцы
-    sku_col = None
-    name_col = None
-    for col in df.columns:
-        if 'артикул' in col.lower():
-            sku_col = col
-        if 'название' in col.lower():
-            name_col = col
-
-    if not sku_col or not name_col:
-        print(f"  [FAIL] Не найдены столбцы. Есть: {list(df.columns)}")
+    try:
+        parsed = excel_export.load(excel_path)
+    except ValueError as e:
+        print(f"  [FAIL] {e}")
+        return
+    if not parsed.has_names:
+        print(f"  [FAIL] Не найден столбец названий. Есть: {parsed.columns}")
         return
 
-    # Формируем список товаров
-    products = []
-    current_skus = set()
-    for _, row in df.iterrows():
-        sku = str(row[sku_col])
-        name = str(row[name_col])
-        products.append({"sku": sku, "name": name})
-        current_skus.add(sku)
+    current_skus = parsed.sku_set
 
-    print(f"[2] Всего товаров в файле: {len(products)}")
+    print(f"[2] Всего товаров в файле: {len(parsed)}")
 
     # Подключаемся к Google Sheets
     print("[3] Подключение к Google Sheets...")
     spreadsheet = get_sheet()
-    sheet = get_or_create_month_sheet(spreadsheet)
-
-    # Добавляем новые товары
-    print("[4] Добавление новых товаров...")
-    added = add_products_to_sheet(sheet, products, merchant_name)
-    print(f"    Новых добавлено: {added}")
-
-    # Проверяем исчезнувшие (только для данного кабинета)
-    print("[5] Проверка исчезнувших товаров...")
-    disappeared = check_disappeared_products(sheet, current_skus, merchant_name)
-    print(f"    Исчезло: {disappeared}")
-
-    # Проверяем исчезнувшие в предыдущем месяце (незакрытые записи)
-    print("[6] Проверка предыдущего месяца...")
-    prev_disappeared = check_previous_month(spreadsheet, current_skus, merchant_name)
-    print(f"    Исчезло (пред. месяц): {prev_disappeared}")
+    totals = {"calls": 0, "bytes": 0} if plan else None
+    sheet = get_or_create_month_sheet(spreadsheet, plan=plan, totals=totals)
 
-    # Настраиваем столбец "Дней до решения"
-    print("[7] Настройка столбца 'Дней до решения'...")
-    setup_days_column(sheet)
-
-    print(f"\n[OK] Google Sheets обработан для {merchant_name}!")
-    return {"added": added, "disappeared": disappeared + prev_disappeared}
+    # Снимок листа — из реестра задач (сверка по столбцам B/F) или одним чтением.
+    # В плане реестр — копия в памяти: пересборка месяцев не попадает в файл
+    ledger = TaskLedger(scratch=plan) if TASK_LEDGER_FILE else None
+    try:
+        if isinstance(sheet, PlannedSheet):
+            snapshot = SheetSnapshot(sheet, values=[COLUMNS])
+        else:
+            snapshot = load_snapshot(sheet, ledger)
+        print(f"    Строк в листе: {snapshot.row_count - 1}")
+
+        # Добавляем новые товары
+        print("[4] Добавление новых товаров...")
+        added = add_products_to_sheet(snapshot, parsed, merchant_name)
+        print(f"    Новых добавлено: {added}")
+
+        # Проверяем исчезнувшие (только для данного кабинета)
+        print("[5] Проверка исчезнувших товаров...")
+        disappeared = check_disappeared_products(snapshot, current_skus, merchant_name)
+        print(f"    Исчезло: {disappeared}")
+
+        # Настраиваем столбец "Дней до решения"
+        print("[6] Настройка столбца 'Дней до решения'...")
+        setup_days_column(snapshot)
+
+        # Все изменения текущего месяца — пакетами
+        if plan:
+            print("[7] План изменений (--plan, без записи)...")
+            print_plan(snapshot, totals)
+        else:
+            print("[7] Запись изменений...")
+            snapshot.flush()
+            if ledger:
+                ledger.save_rows(sheet.title, snapshot, snapshot.touched)
+        print(f"    Чтений листа: {snapshot.reads}, вызовов API: {snapshot.api_calls}, "
+              f"сэкономлено: {snapshot.calls_saved}")
+
+        if ledger:
+            # Незакрытые задачи всех прошлых месяцев — по индексу реестра
+            print("[8] Проверка прошлых месяцев...")
+            prev_disappeared = close_disappeared_across_months(
+                spreadsheet, ledger, current_skus, merchant_name, sheet.title, plan=totals
+            )
+            print(f"    Исчезло (прошлые месяцы): {prev_disappeared}")
+        else:
+            # Без реестра — только предыдущий месяц, полным чтением листа
+            print("[8] Проверка предыдущего месяца...")
+            prev_disappeared = check_previous_month(spreadsheet, current_skus, merchant_name, plan=totals)
+            print(f"    Исчезло (пред. месяц): {prev_disappeared}")
+
+        if plan:
+            print(f"\n[PLAN] {merchant_name}: при применении — вызовов API на запись {totals['calls']}, "
+                  f"тело запросов {totals['bytes']} байт ({totals['bytes'] / 1024:.1f} КБ). Ничего не записано.")
+            return {"added": added, "disappeared": disappeared + prev_disappeared, "plan": totals}
+
+        print(f"\n[OK] Google Sheets обработан для {merchant_name}!")
+        return {"added": added, "disappeared": disappeared + prev_disappeared}
+    finally:
+        if ledger:
+            ledger.close()
 
 
 # Тест при прямом запуске
@@ -0,0 +1,162 @@
+# ============================================
+# ВЫГРУЗКА EXCEL НАПРЯМУЮ ПО HTTP (БЕЗ БРАУЗЕРА)
+# ============================================
+# После входа всё, что делает navigate_and_download, — клики по вкладкам
+# ради одного запроса на выгрузку. Здесь этот запрос делается напрямую:
+# cookies авторизованного контекста Playwright переносятся в общий
+# aiohttp-сеанс (пул соединений), и выгрузки всех мерчантов и категорий
+# скачиваются параллельно.
+#
+# URL выгрузки задаётся в config.HTTP_EXPORT_URL. Ответ, который не похож
+# на Excel (например, HTML страницы входа), считается ошибкой — вызывающий
+# код обрабатывает такого мерчанта через браузер. Счётчики вкладок (для
+# кэша выгрузок) берутся из того же API, что и в браузере, — config.HTTP_COUNTS_URL.
+
+import asyncio
+import os
+import re
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import unquote
+
+import aiohttp
+from yarl import URL
+
+from config import (
+    CATEGORY_URLS,
+    DOWNLOADS_PATH,
+    HTTP_EXPORT_URL,
+    HTTP_EXPORT_CONCURRENCY,
+    HTTP_COUNTS_URL,
+    KASPI_PRODUCTS_BASE_URL,
+)
+from pending_counts import category_status, extract_counts, payload_merchant
+
+# Первые байты xlsx — это zip-архив
+XLSX_MAGIC = b"PK\x03\x04"
+
+
+def download_file_path(orig_name, merchant_name):
+    """Путь для сохранения выгрузки: <имя>_<мерчант>_<время>.<расширение>"""
+    name_base, name_ext = os.path.splitext(orig_name or "kaspi_export.xlsx")
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(DOWNLOADS_PATH, f"{name_base}_{merchant_name}_{timestamp}{name_ext}")
+
+
+def export_url(merchant, category_key):
+    """URL выгрузки категории для мерчанта по шаблону из config"""
+    return HTTP_EXPORT_URL.format(
+        merchant_id=merchant_url_id(merchant),
+        status=category_status(CATEGORY_URLS[category_key]),
+    )
+
+
+def merchant_url_id(merchant):
+    """ID мерчанта для шаблонов URL: поле "uid", если задано, иначе "id" """
+    return merchant.get("uid", merchant["id"])
+
+
+def filename_from_disposition(header):
+    """Имя файла из Content-Disposition (поддерживает filename*=UTF-8'')"""
+    if not header:
+        return None
+    m = re.search(r"filename\*=(?:UTF-8'')?([^;]+)", header, re.IGNORECASE)
+    if m:
+        return unquote(m.group(1).strip('" '))
+    m = re.search(r'filename="?([^";]+)"?', header, re.IGNORECASE)
+    return m.group(1).strip() if m else None
+
+
+def cookie_jar_from_playwright(cookies):
+    """Перенос cookies из context.cookies() в aiohttp.CookieJar"""
+    # unsafe=True — чтобы cookies принимались и для IP-адреса (локальная заглушка mock_kaspi.py)
+    jar = aiohttp.CookieJar(unsafe=True)
+    for c in cookies:
+        morsel = SimpleCookie()
+        morsel[c["name"]] = c["value"]
+        morsel[c["name"]]["domain"] = c["domain"]
+        morsel[c["name"]]["path"] = c.get("path", "/")
+        jar.update_cookies(morsel, response_url=URL(f"https://{c['domain'].lstrip('.')}/"))
+    return jar
+
+
+async def export_category(session, merchant, category_key, semaphore):
+    """Скачать выгрузку одной категории. Возвращает путь к файлу или None"""
+    merchant_name = merchant["name"]
+    url = export_url(merchant, category_key)
+    async with semaphore:
+        try:
+            async with session.get(url) as resp:
+                body = await resp.read()
+                if resp.status != 200 or not body.startswith(XLSX_MAGIC):
+                    print(f"  [WARN] HTTP-выгрузка {merchant_name}/{category_key}: "
+                          f"HTTP {resp.status}, {resp.content_type} — не Excel")
+                    return None
+                orig_name = filename_from_disposition(resp.headers.get("Content-Disposition"))
+        except Exception as e:
+            err_msg = str(e).encode('ascii', errors='replace').decode('ascii')
+            print(f"  [WARN] HTTP-выгрузка {merchant_name}/{category_key}: {err_msg}")
+            return None
+
+    file_path = download_file_path(orig_name, merchant_name)
+    with open(file_path, "wb") as f:
+        f.write(body)
+    print(f"  [OK] {merchant_name}/{category_key}: {os.path.basename(file_path)} ({len(body)} байт)")
+    return file_path
+
+
+async def fetch_counts(session, merchant, semaphore):
+    """Счётчики вкладок мерчанта из API ({категория: N}) или {} — если
+    HTTP_COUNTS_URL не задан или ответ не подошёл"""
+    if not HTTP_COUNTS_URL:
+        return {}
+    merchant_name = merchant["name"]
+    url = HTTP_COUNTS_URL.format(merchant_id=merchant_url_id(merchant))
+    async with semaphore:
+        try:
+            async with session.get(url) as resp:
+                payload = await resp.json(content_type=None)
+        except Exception as e:
+            err_msg = str(e).encode('ascii', errors='replace').decode('ascii')
+            print(f"  [WARN] Счётчики {merchant_name}: {err_msg}")
+            return {}
+    merchant_id = payload_merchant(payload)
+    if merchant_id is not None and merchant_id != str(merchant_url_id(merchant)):
+        print(f"  [WARN] Счётчики {merchant_name}: ответ другого кабинета ({merchant_id})")
+        return {}
+    return extract_counts(payload)
+
+
+async def export_all(context, merchants, category_keys):
+    """Параллельная выгрузка всех мерчантов и категорий по HTTP.
+
+    Возвращает (files, counts): files — {merchant_name: {category_key:
+    file_path или None}}, None — выгрузка не удалась (нужен браузерный
+    fallback); counts — {merchant_name: {category_key: N}} из API счётчиков.
+    """
+    user_agent = None
+    if context.pages:
+        user_agent = await context.pages[0].evaluate("navigator.userAgent")
+
+    headers = {"Referer": KASPI_PRODUCTS_BASE_URL}
+    if user_agent:
+        headers["User-Agent"] = user_agent
+
+    jar = cookie_jar_from_playwright(await context.cookies())
+    connector = aiohttp.TCPConnector(limit=HTTP_EXPORT_CONCURRENCY)
+    semaphore = asyncio.Semaphore(HTTP_EXPORT_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=120)
+
+    async with aiohttp.ClientSession(cookie_jar=jar, connector=connector,
+                                     headers=headers, timeout=timeout) as session:
+        jobs = [(m, key) for m in merchants for key in category_keys]
+        paths, merchant_counts = await asyncio.gather(
+            asyncio.gather(*(export_category(session, m, key, semaphore) for m, key in jobs)),
+            asyncio.gather(*(fetch_counts(session, m, semaphore) for m in merchants)),
+        )
+
+    files = {m["name"]: {} for m in merchants}
+    for (merchant, key), path in zip(jobs, paths):
+        files[merchant["name"]][key] = path
+    counts = {m["name"]: c for m, c in zip(merchants, merchant_counts)}
+    return files, counts
@@ -0,0 +1,354 @@
+"""
+Локальная заглушка Kaspi Merchant Center для замеров и проверки без kaspi.kz.
+
+Повторяет то, с чем работают test_steps.py и price_monitor.py:
+  - страница входа (вкладки Телефон/Email, email -> "Продолжить" -> пароль -> "Войти")
+  - SPA /mc/ с hash-роутингом:
+      #/products/pending[/STATUS/1] — вкладки "Без привязки (N)" и т.д.,
+                                      кнопка "Выгрузить в EXCEL"
+      #/history?tab=priceList       — таблица истории загрузок прайс-листов
+  - переключатель кабинетов "ID - ..." в правом верхнем углу
+  - API: счётчики вкладок, выгрузка xlsx, история, смена кабинета
+
+Активный кабинет хранится в cookie (как и сессия), поэтому у каждого
+контекста браузера он свой. Количество товаров и артикулы зависят от
+кабинета (у каждого следующего на товар больше), так что данные, снятые
+не с того кабинета, видны по счётчикам.
+
+Запуск отдельно:  python mock_kaspi.py --port 8765 --merchants 3 --rows 1000
+Затем, например:  KASPI_LOGIN_URL=http://127.0.0.1:8765/login KASPI_MC_URL=http://127.0.0.1:8765/mc py test_steps.py
+"""
+
+import asyncio
+import io
+import json
+import sys
+import uuid
+
+from aiohttp import web
+
+# Статусы вкладок и доли товаров от --rows (TRASH = 0, чтобы проверять пропуск пустых)
+STATUS_SHARE = {"CHECK": 1.0, "IMPORTED": 0.1, "PENDING": 0.05, "TRASH": 0.0}
+STATUS_LABELS = {
+    "CHECK": "Без привязки",
+    "IMPORTED": "Требуют доработок",
+    "PENDING": "На проверке",
+    "TRASH": "Отклонены",
+}
+
+# Сколько сгенерированных xlsx держать в памяти (на 100000 строк файл — несколько МБ)
+XLSX_CACHE_SIZE = 16
+
+
+class MockState:
+    """Настройки заглушки (меняются между сценариями бенчмарка)"""
+
+    def __init__(self, merchant_ids=("Sulpak",), rows=100, latency_ms=200, history_status="Загружен"):
+        self.merchant_ids = list(merchant_ids)
+        self.rows = rows
+        self.latency_ms = latency_ms
+        self.history_status = history_status
+        self.sessions = set()
+        self._xlsx_cache = {}
+
+    def merchant_index(self, merchant):
+        """Порядковый номер кабинета (неизвестный — как первый)"""
+        return self.merchant_ids.index(merchant) if merchant in self.merchant_ids else 0
+
+    def count(self, status, merchant=None):
+        """Товаров в статусе у кабинета: у каждого следующего кабинета на один больше,
+        чтобы чужие счётчики и выгрузки не совпадали со своими"""
+        share = STATUS_SHARE[status]
+        rows = self.rows + self.merchant_index(merchant)
+        return max(1, int(rows * share)) if share else 0
+
+    def xlsx(self, status, merchant=None):
+        """Выгрузка в формате Kaspi: Артикул, Название товара и служебные столбцы.
+
+        Артикулы зависят от кабинета и статуса (у категорий с одинаковым числом
+        товаров разные файлы); файл кабинета и статуса генерируется один раз
+        (в кэше не больше XLSX_CACHE_SIZE файлов).
+        """
+        index = self.merchant_index(merchant)
+        status_index = list(STATUS_SHARE).index(status)
+        rows = self.count(status, merchant)
+        key = (index, status, rows)
+        if key not in self._xlsx_cache:
+            from openpyxl import Workbook
+
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("Товары")
+            ws.append(["Артикул", "Название товара", "Бренд", "Категория", "Цена", "Статус"])
+            for i in range(rows):
+                # Примерно 3/4 артикулов на 30000*, каждый 7-й товар — бренд ARG
+                if i % 4:
+                    sku = f"30000{index:03d}{status_index}{i:06d}"
+                else:
+                    sku = f"{100000 + index * 10_000_000 + status_index * 1_000_000 + i}"
+                brand = "ARG" if i % 7 == 0 else "Brand"
+                ws.append([sku, f"Товар {brand} №{i}", brand, "Электроника", 1000 + i, "Нераспознан"])
+            buf = io.BytesIO()
+            wb.save(buf)
+            if len(self._xlsx_cache) >= XLSX_CACHE_SIZE:
+                self._xlsx_cache.pop(next(iter(self._xlsx_cache)))
+            self._xlsx_cache[key] = buf.getvalue()
+        return self._xlsx_cache[key]
+
+
+LOGIN_HTML = """<!doctype html>
+<html><head><meta charset="utf-8"><title>Вход</title>
+<style>
+  .columns { position: relative; width: 420px; height: 260px; }
+  .panel { position: absolute; inset: 0; background: #fff; padding: 20px; }
+  .hidden { display: none; }
+</style></head>
+<body>
+  <div class="tabs"><a href="#" id="tab-phone">Телефон</a> | <a href="#" id="tab-email">Email</a></div>
+  <div class="columns">
+    <div class="panel" id="panel-phone">
+      <input class="text-field" name="phone" placeholder="Телефон">
+      <button type="submit">Продолжить</button>
+    </div>
+    <div class="panel hidden" id="panel-email">
+      <div id="step-email">
+        <input id="user_email_field" name="username" placeholder="Email">
+        <button type="button" id="continue">Продолжить</button>
+      </div>
+      <div id="step-password" class="hidden">
+        <input type="password" name="password">
+        <button type="button" id="login">Войти</button>
+      </div>
+    </div>
+  </div>
+<script>
+  const show = (id, on) => document.getElementById(id).classList.toggle('hidden', !on);
+  document.getElementById('tab-email').onclick = e => { e.preventDefault(); show('panel-phone', false); show('panel-email', true); };
+  document.getElementById('tab-phone').onclick = e => { e.preventDefault(); show('panel-phone', true); show('panel-email', false); };
+  document.getElementById('continue').onclick = () => setTimeout(() => { show('step-email', false); show('step-password', true); }, 150);
+  document.getElementById('login').onclick = async () => {
+    const r = await fetch('/login', {method: 'POST', body: JSON.stringify({
+      username: document.getElementById('user_email_field').value,
+      password: document.querySelector('input[type=password]').value})});
+    if (r.ok) location.href = '/mc/#/orders';
+  };
+</script></body></html>"""
+
+SPA_HTML = """<!doctype html>
+<html><head><meta charset="utf-8"><title>Kaspi Merchant Center (mock)</title>
+<style>
+  body { margin: 0; font-family: sans-serif; }
+  .navbar { position: fixed; top: 0; left: 0; right: 0; height: 52px; background: #eee; }
+  .navbar-link { position: absolute; right: 24px; top: 16px; }
+  .dropdown { position: absolute; right: 24px; top: 56px; width: 720px; background: #fff;
+              border: 1px solid #ccc; display: grid; grid-template-columns: repeat(5, 1fr); }
+  .dropdown a { display: block; padding: 4px; height: 20px; }
+  .hidden { display: none; }
+  main { margin-top: 80px; padding: 0 24px; }
+</style></head>
+<body>
+  <div class="navbar"><a class="navbar-link" href="#" id="switcher">ID - ...</a></div>
+  <div class="dropdown hidden" id="dropdown"></div>
+  <main id="app"></main>
+<script>
+  const LABELS = __LABELS__;
+  const MERCHANTS = __MERCHANTS__;
+  const cookie = name => (document.cookie.match('(?:^|; )' + name + '=([^;]*)') || [])[1];
+  const app = document.getElementById('app');
+  const switcher = document.getElementById('switcher');
+  const dropdown = document.getElementById('dropdown');
+
+  switcher.textContent = 'ID - ' + decodeURIComponent(cookie('mc_merchant') || MERCHANTS[0]);
+  switcher.onclick = e => { e.preventDefault(); dropdown.classList.toggle('hidden'); };
+  for (const id of MERCHANTS) {
+    const a = document.createElement('a');
+    a.href = '#'; a.textContent = 'ID - ' + id;
+    a.onclick = async e => {
+      e.preventDefault();
+      await fetch('/mc/api/merchant', {method: 'POST', body: JSON.stringify({id})});
+      location.reload();
+    };
+    dropdown.appendChild(a);
+  }
+
+  let counts = null;
+  async function loadCounts() {
+    const r = await fetch('/mc/api/pending/counts');
+    counts = {};
+    for (const item of (await r.json()).data) counts[item.status] = item.count;
+  }
+
+  async function renderPending(status) {
+    const tabs = Object.entries(LABELS).map(([s, label]) =>
+      `<a href="#/products/pending/${s}/1" data-status="${s}">${label} (${counts ? counts[s] : 0})</a>`).join(' | ');
+    app.innerHTML = `<nav id="tabs">${tabs}</nav><section id="content"></section>`;
+    if (!counts) { await loadCounts(); return route(); }
+    if (!status) return;
+    await new Promise(r => setTimeout(r, 100));
+    const content = document.getElementById('content');
+    if (!counts[status]) { content.innerHTML = '<p>Нет товаров</p>'; return; }
+    content.innerHTML = `<button id="export">Выгрузить в EXCEL</button>
+      <table><tr><th>Артикул</th><th>Название</th></tr></table>`;
+    document.getElementById('export').onclick = () => { location.href = '/mc/api/export?status=' + status; };
+  }
+
+  async function renderHistory() {
+    const rows = await (await fetch('/mc/api/history')).json();
+    app.innerHTML = `<table><tr><th>Название файла</th><th>Статус</th><th>Загружено предложений</th><th>Дата загрузки</th></tr>` +
+      rows.map(r => `<tr><td>${r.file}</td><td>${r.status}</td><td>${r.offers}</td><td>${r.date}</td></tr>`).join('') +
+      `</table>`;
+  }
+
+  function route() {
+    const hash = location.hash.slice(1);
+    const m = hash.match(/^\\/products\\/pending(?:\\/(\\w+)\\/\\d+)?/);
+    if (m) return renderPending(m[1]);
+    if (hash.startsWith('/history')) return renderHistory();
+    app.innerHTML = '<h1>Заказы</h1>';
+  }
+  window.addEventListener('hashchange', route);
+  route();
+</script></body></html>"""
+
+
+def create_app(state):
+    """aiohttp-приложение заглушки"""
+
+    async def delay():
+        if state.latency_ms:
+            await asyncio.sleep(state.latency_ms / 1000)
+
+    def authorized(request):
+        return request.cookies.get("mc_session") in state.sessions
+
+    def active_merchant(request):
+        merchant = request.cookies.get("mc_merchant")
+        return merchant if merchant in state.merchant_ids else state.merchant_ids[0]
+
+    async def login_page(request):
+        return web.Response(text=LOGIN_HTML, content_type="text/html")
+
+    async def login_submit(request):
+        await delay()
+        data = json.loads(await request.text() or "{}")
+        if not data.get("username") or not data.get("password"):
+            return web.json_response({"error": "bad credentials"}, status=401)
+        token = uuid.uuid4().hex
+        state.sessions.add(token)
+        resp = web.json_response({"ok": True})
+        resp.set_cookie("mc_session", token, path="/")
+        return resp
+
+    async def spa(request):
+        if not authorized(request):
+            raise web.HTTPFound("/login")
+        html = (SPA_HTML
+                .replace("__LABELS__", json.dumps(STATUS_LABELS, ensure_ascii=False))
+                .replace("__MERCHANTS__", json.dumps(state.merchant_ids, ensure_ascii=False)))
+        return web.Response(text=html, content_type="text/html")
+
+    async def set_merchant(request):
+        if not authorized(request):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        await delay()
+        merchant_id = json.loads(await request.text())["id"]
+        resp = web.json_response({"ok": True})
+        resp.set_cookie("mc_merchant", merchant_id, path="/")
+        return resp
+
+    async def pending_counts(request):
+        if not authorized(request):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        await delay()
+        # HTTP-режим указывает кабинет в запросе, браузер — через cookie
+        merchant = request.query.get("merchant") or active_merchant(request)
+        if merchant not in state.merchant_ids:
+            merchant = state.merchant_ids[0]
+        return web.json_response({
+            "merchant": merchant,
+            "data": [{"status": s, "count": state.count(s, merchant)} for s in STATUS_LABELS],
+        })
+
+    async def export(request):
+        if not authorized(request):
+            return web.Response(text=LOGIN_HTML, content_type="text/html", status=401)
+        await delay()
+        status = request.query.get("status", "CHECK")
+        # HTTP-выгрузка указывает кабинет в запросе, браузер — через cookie
+        merchant = request.query.get("merchant") or active_merchant(request)
+        body = await asyncio.to_thread(state.xlsx, status, merchant)
+        return web.Response(
+            body=body,
+            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={"Content-Disposition": f'attachment; filename="products_{status}.xlsx"'},
+        )
+
+    async def history(request):
+        if not authorized(request):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        await delay()
+        return web.json_response([
+            {"file": "price.xml", "status": state.history_status, "offers": "1520", "date": "18.10.2026 09:00"},
+            {"file": "price.xml", "status": "Загружен", "offers": "1518", "date": "18.10.2026 08:30"},
+        ])
+
+    app = web.Application()
+    app.router.add_get("/login", login_page)
+    app.router.add_post("/login", login_submit)
+    app.router.add_get("/mc", spa)
+    app.router.add_get("/mc/", spa)
+    app.router.add_post("/mc/api/merchant", set_merchant)
+    app.router.add_get("/mc/api/pending/counts", pending_counts)
+    app.router.add_get("/mc/api/export", export)
+    app.router.add_get("/mc/api/history", history)
+    return app
+
+
+async def start_mock(state, port=8765):
+    """Запустить заглушку в текущем event loop. Возвращает runner (для cleanup)"""
+    runner = web.AppRunner(create_app(state))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def mock_env(port=8765):
+    """Переменные окружения, которые направляют test_steps/price_monitor на заглушку"""
+    base = f"http://127.0.0.1:{port}"
+    return {
+        "KASPI_LOGIN_URL": f"{base}/login",
+        "KASPI_MC_URL": f"{base}/mc",
+    }
+
+
+def mock_http_export_url(port=8765):
+    """Шаблон KASPI_HTTP_EXPORT_URL для заглушки"""
+    return f"http://127.0.0.1:{port}/mc/api/export?merchant={{merchant_id}}&status={{status}}"
+
+
+def mock_http_counts_url(port=8765):
+    """Шаблон KASPI_HTTP_COUNTS_URL для заглушки"""
+    return f"http://127.0.0.1:{port}/mc/api/pending/counts?merchant={{merchant_id}}"
+
+
+def _arg(argv, name, default):
+    if name in argv:
+        idx = argv.index(name)
+        if idx + 1 < len(argv):
+            return argv[idx + 1]
+    return default
+
+
+if __name__ == "__main__":
+    port = int(_arg(sys.argv, "--port", "8765"))
+    merchants = int(_arg(sys.argv, "--merchants", "3"))
+    state = MockState(
+        merchant_ids=["Sulpak"] + [str(30400000 + i) for i in range(1, merchants)],
+        rows=int(_arg(sys.argv, "--rows", "100")),
+        latency_ms=int(_arg(sys.argv, "--latency", "200")),
+    )
+    print(f"Заглушка Kaspi MC: http://127.0.0.1:{port}/login")
+    for key, value in mock_env(port).items():
+        print(f"  {key}={value}")
+    print(f"  KASPI_HTTP_EXPORT_URL={mock_http_export_url(port)}")
+    print(f"  KASPI_HTTP_COUNTS_URL={mock_http_counts_url(port)}")
+    web.run_app(create_app(state), host="127.0.0.1", port=port, print=None)
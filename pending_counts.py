@@ -0,0 +1,157 @@
+# ============================================
+# СЧЁТЧИКИ КАТЕГОРИЙ ИЗ ОТВЕТОВ API MERCHANT CENTER
+# ============================================
+# SPA сама запрашивает количество нераспознанных товаров по статусам
+# (CHECK / IMPORTED / PENDING / TRASH) и только потом рисует "(N)" во
+# вкладках. Перехватываем этот JSON через page.on("response") и берём все
+# четыре счётчика из одного ответа — без чтения текста вкладок и без
+# ложных "(0)", пока данные не подгрузились.
+#
+# Формат ответа Kaspi не документирован, поэтому ищем счётчики по
+# содержимому, а не по URL: словарь {"CHECK": 64, ...} или список
+# [{"status": "CHECK", "count": 64}, ...] на любой глубине JSON.
+# Если в ответе указан кабинет (поле merchant / merchantId), ответы
+# чужого кабинета отбрасываются.
+
+import asyncio
+import time
+
+from config import CATEGORY_URLS
+from readiness import record_wait
+
+
+def category_status(url):
+    """Статус категории из URL: .../products/pending/CHECK/1 -> CHECK"""
+    parts = url.split("#")[-1].strip("/").split("/")
+    return parts[2] if len(parts) > 2 else ""
+
+
+# {статус из URL: ключ категории}, напр. {"CHECK": "без_привязки"}
+STATUS_TO_CATEGORY = {category_status(url): key for key, url in CATEGORY_URLS.items()}
+
+# Поля со значением счётчика в элементах списка
+COUNT_FIELDS = ("count", "total", "totalcount", "size", "amount", "quantity")
+
+# Поля верхнего уровня ответа с ID кабинета
+MERCHANT_FIELDS = ("merchant", "merchantid", "merchantuid")
+
+
+def _as_count(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+def _counts_from_dict(obj):
+    """{"CHECK": 64, "imported": 2, ...} -> {"CHECK": 64, "IMPORTED": 2}"""
+    found = {}
+    for key, value in obj.items():
+        status = str(key).upper()
+        count = _as_count(value)
+        if status in STATUS_TO_CATEGORY and count is not None:
+            found[status] = count
+    return found
+
+
+def _counts_from_list(items):
+    """[{"status": "CHECK", "count": 64}, ...] -> {"CHECK": 64}"""
+    found = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        status = None
+        count = None
+        for key, value in item.items():
+            if isinstance(value, str) and value.upper() in STATUS_TO_CATEGORY:
+                status = value.upper()
+            elif str(key).lower() in COUNT_FIELDS:
+                count = _as_count(value)
+        if status and count is not None:
+            found[status] = count
+    return found
+
+
+def extract_counts(payload):
+    """Найти в JSON счётчики категорий. Возвращает {ключ_категории: N}.
+
+    Берётся первый фрагмент, где нашлось не меньше двух статусов —
+    одиночное совпадение слишком легко спутать со случайным полем.
+    """
+    stack = [payload]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            found = _counts_from_dict(node)
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            found = _counts_from_list(node)
+            stack.extend(node)
+        else:
+            continue
+        if len(found) >= 2:
+            return {STATUS_TO_CATEGORY[status]: count for status, count in found.items()}
+    return {}
+
+
+def payload_merchant(payload):
+    """ID кабинета из ответа API или None, если ответ его не указывает"""
+    if not isinstance(payload, dict):
+        return None
+    for key, value in payload.items():
+        if str(key).lower() in MERCHANT_FIELDS and isinstance(value, (str, int)) and not isinstance(value, bool):
+            return str(value)
+    return None
+
+
+class PendingCountsInterceptor:
+    """Слушает JSON-ответы страницы и запоминает последние счётчики категорий.
+
+    merchant_id — ожидаемый кабинет: ответы, где указан другой, пропускаются.
+    """
+
+    def __init__(self, page, merchant_id=None):
+        self.page = page
+        self.merchant_id = merchant_id
+        self.counts = {}
+        self._ready = asyncio.Event()
+        page.on("response", self._on_response)
+
+    def reset(self):
+        """Забыть счётчики (после переключения кабинета они уже чужие)"""
+        self.counts = {}
+        self._ready.clear()
+
+    def detach(self):
+        self.page.remove_listener("response", self._on_response)
+
+    async def _on_response(self, response):
+        try:
+            if response.request.resource_type not in ("xhr", "fetch"):
+                return
+            if "json" not in response.headers.get("content-type", ""):
+                return
+            payload = await response.json()
+            merchant = payload_merchant(payload)
+            if self.merchant_id is not None and merchant is not None and merchant != str(self.merchant_id):
+                return
+            counts = extract_counts(payload)
+        except Exception:
+            return
+        if counts:
+            self.counts.update(counts)
+            self._ready.set()
+
+    async def wait(self, timeout=5):
+        """Ждём ответ со счётчиками. Возвращает {категория: N} или {} по таймауту"""
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+            ok = True
+        except asyncio.TimeoutError:
+            ok = False
+        record_wait("counts: ответ API", time.monotonic() - start, ok)
+        return dict(self.counts)
@@ -14,9 +14,12 @@ import json
 import os
 import sys
 
-from test_steps import test_step1_login, switch_merchant, send_telegram
+from config import KASPI_HISTORY_URL
+from test_steps import test_step1_login, switch_merchant, read_active_merchant, send_telegram
+from readiness import wait_for_selector, wait_for_network_idle, print_wait_stats
+from request_filter import REQUEST_FILTER
 
-HISTORY_URL = "https://kaspi.kz/mc/#/history?tab=priceList&page=1"
+HISTORY_URL = KASPI_HISTORY_URL
 STATE_FILE = "monitor_state.json"
 MERCHANT_ID = "Sulpak"
 MERCHANT_NAME = "Sulpak"
@@ -40,16 +43,15 @@ async def open_history(page):
     """Переход на страницу истории загрузок и ожидание загрузки SPA.
 
     После холодного старта SPA игнорирует hash и уводит на страницу заказов,
-    поэтому при необходимости повторяем hash-навигацию.
+    поэтому при необходимости повторяем hash-навигацию. Готовность страницы —
+    появление таблицы с заголовком "Название файла".
     """
     print(f"[1] Переход на {HISTORY_URL}")
     for attempt in range(3):
         await page.goto(HISTORY_URL, timeout=60000)
-        await asyncio.sleep(5)
-        try:
-            await page.wait_for_load_state("networkidle", timeout=15000)
-        except Exception:
-            pass
+        table = await wait_for_selector(page, 'table:has-text("Название файла")', "history: таблица")
+        if not table:
+            await wait_for_network_idle(page, "history: networkidle")
         if "history" in page.url:
             return True
         print(f"    SPA увела на {page.url}, повторный переход ({attempt + 1})...")
@@ -62,8 +64,7 @@ async def ensure_sulpak(page):
     После логина по умолчанию активен Sulpak, поэтому обычно переключение не нужно.
     """
     try:
-        el = await page.query_selector('a.navbar-link:has-text("ID -")')
-        text = (await el.inner_text()).strip() if el else ""
+        text = await read_active_merchant(page)
     except Exception:
         text = ""
 
@@ -189,6 +190,8 @@ async def main(dry_run=False):
             sys.exit(1)
 
     finally:
+        print_wait_stats()
+        REQUEST_FILTER.print_stats()
         await browser.close()
 
 
@@ -0,0 +1,119 @@
+# ============================================
+# ОЖИДАНИЕ ГОТОВНОСТИ СТРАНИЦЫ (вместо фиксированных пауз)
+# ============================================
+# Вместо asyncio.sleep(N) ждём конкретное событие, которое нужно
+# следующему шагу: селектор, URL, счётчик во вкладке, тишину в сети.
+# Каждое ожидание ограничено таймаутом; при таймауте можно подстраховаться
+# короткой фиксированной паузой (fallback), как было раньше.
+#
+# Все ожидания замеряются — в конце запуска print_wait_stats() показывает,
+# сколько реально занимает каждый шаг SPA.
+
+import asyncio
+import time
+
+# {метка: {"count": N, "total": сек, "max": сек, "timeouts": N}}
+WAIT_STATS = {}
+
+
+def record_wait(label, elapsed, ok):
+    """Добавить замер ожидания в статистику"""
+    stats = WAIT_STATS.setdefault(label, {"count": 0, "total": 0.0, "max": 0.0, "timeouts": 0})
+    stats["count"] += 1
+    stats["total"] += elapsed
+    stats["max"] = max(stats["max"], elapsed)
+    if not ok:
+        stats["timeouts"] += 1
+
+
+async def timed_wait(label, awaitable, fallback_sleep=0):
+    """Дождаться awaitable с замером времени.
+
+    Возвращает результат или None, если ожидание не удалось (таймаут или
+    ошибка). В этом случае выполняется пауза fallback_sleep секунд.
+    """
+    start = time.monotonic()
+    try:
+        result = await awaitable
+        ok = True
+    except Exception:
+        result = None
+        ok = False
+    record_wait(label, time.monotonic() - start, ok)
+
+    if not ok and fallback_sleep:
+        await asyncio.sleep(fallback_sleep)
+    return result
+
+
+async def wait_for_selector(page, selector, label, timeout=15000, fallback_sleep=0):
+    """Ждём появления видимого элемента. Возвращает элемент или None"""
+    return await timed_wait(
+        label,
+        page.wait_for_selector(selector, state="visible", timeout=timeout),
+        fallback_sleep,
+    )
+
+
+async def wait_for_url(page, fragment, label, timeout=15000, fallback_sleep=0, present=True):
+    """Ждём, пока URL будет содержать (present=True) или перестанет
+    содержать (present=False) fragment, без учёта регистра.
+    Возвращает итоговое совпадение."""
+    needle = fragment.lower()
+
+    def matches(url):
+        return (needle in url.lower()) == present
+
+    await timed_wait(label, page.wait_for_url(matches, timeout=timeout), fallback_sleep)
+    return matches(page.url)
+
+
+async def wait_for_network_idle(page, label, timeout=15000):
+    """Ждём тишины в сети (SPA догрузила данные)"""
+    await timed_wait(label, page.wait_for_load_state("networkidle", timeout=timeout))
+
+
+async def wait_for_tab_count(tab, label, timeout=6000):
+    """Ждём, пока во вкладке появится ненулевой счётчик "(N)".
+
+    Kaspi сначала рендерит вкладки с "(0)" и подставляет реальное число
+    после ответа API. Ненулевое значение возвращаем сразу; если за timeout
+    так и осталось "(0)" — это настоящий ноль.
+    """
+    start = time.monotonic()
+    try:
+        ready = await tab.evaluate(
+            """(el, timeout) => new Promise(resolve => {
+                const ready = () => {
+                    const m = el.innerText.match(/\\((\\d+)\\)/);
+                    return !!m && +m[1] > 0;
+                };
+                if (ready()) return resolve(true);
+                const obs = new MutationObserver(() => {
+                    if (ready()) { obs.disconnect(); resolve(true); }
+                });
+                obs.observe(el, {childList: true, subtree: true, characterData: true});
+                setTimeout(() => { obs.disconnect(); resolve(false); }, timeout);
+            })""",
+            timeout,
+        )
+    except Exception:
+        ready = False
+    record_wait(label, time.monotonic() - start, ready)
+    return ready
+
+
+def print_wait_stats():
+    """Сводка по ожиданиям: сколько раз, среднее, максимум, таймауты"""
+    if not WAIT_STATS:
+        return
+    print("\n" + "="*50)
+    print("СТАТИСТИКА ОЖИДАНИЙ SPA")
+    print("="*50)
+    print(f"  {'Шаг':<32}{'раз':>5}{'сред, с':>9}{'макс, с':>9}{'тайм-ауты':>11}")
+    total = 0.0
+    for label, stats in sorted(WAIT_STATS.items(), key=lambda kv: -kv[1]["total"]):
+        avg = stats["total"] / stats["count"]
+        total += stats["total"]
+        print(f"  {label:<32}{stats['count']:>5}{avg:>9.2f}{stats['max']:>9.2f}{stats['timeouts']:>11}")
+    print(f"  Всего в ожиданиях: {total:.1f} с")
@@ -0,0 +1,98 @@
+# ============================================
+# БЛОКИРОВКА ЛИШНИХ ЗАПРОСОВ БРАУЗЕРА
+# ============================================
+# Merchant Center тянет картинки товаров, шрифты, счётчики аналитики и
+# сторонние скрипты — скрипту они не нужны. Фильтр вешается на контекст
+# браузера (context.route) и отменяет такие запросы до отправки.
+#
+# Правила (config.py):
+#   ALLOWED_DOMAINS        — никогда не блокируются
+#   BLOCKED_RESOURCE_TYPES — блокируются по типу ресурса (image, font, ...)
+#   BLOCKED_DOMAINS        — блокируются по домену (аналитика)
+#
+# Отменённый запрос не уходит в сеть, поэтому его размер неизвестен:
+# по ним считаем количество (по причинам), а байты — по реально
+# загруженному трафику, чтобы было видно, сколько осталось.
+
+from collections import Counter
+from urllib.parse import urlsplit
+
+from config import (
+    ALLOWED_DOMAINS,
+    BLOCKED_DOMAINS,
+    BLOCKED_RESOURCE_TYPES,
+)
+
+
+def host_matches(host, domains):
+    """host совпадает с доменом или является его поддоменом"""
+    return any(host == d or host.endswith("." + d) for d in domains)
+
+
+class RequestFilter:
+    """Фильтр запросов со счётчиками за запуск (общий для всех контекстов)"""
+
+    def __init__(self, blocked_types=BLOCKED_RESOURCE_TYPES,
+                 blocked_domains=BLOCKED_DOMAINS, allowed_domains=ALLOWED_DOMAINS):
+        self.blocked_types = set(blocked_types)
+        self.blocked_domains = list(blocked_domains)
+        self.allowed_domains = list(allowed_domains)
+        self.blocked = Counter()   # {причина: количество}
+        self.allowed = 0
+        self.bytes_loaded = 0
+
+    def block_reason(self, url, resource_type):
+        """Причина блокировки ("type:image", "domain:...") или None"""
+        host = urlsplit(url).hostname or ""
+        if host_matches(host, self.allowed_domains):
+            return None
+        if resource_type in self.blocked_types:
+            return f"type:{resource_type}"
+        if host_matches(host, self.blocked_domains):
+            return f"domain:{host}"
+        return None
+
+    async def _handle_route(self, route):
+        request = route.request
+        reason = self.block_reason(request.url, request.resource_type)
+        if reason:
+            self.blocked[reason] += 1
+            await route.abort("blockedbyclient")
+        else:
+            self.allowed += 1
+            await route.continue_()
+
+    async def _on_request_finished(self, request):
+        try:
+            sizes = await request.sizes()
+            self.bytes_loaded += sizes["responseBodySize"] + sizes["responseHeadersSize"]
+        except Exception:
+            pass
+
+    async def install(self, context):
+        """Подключить фильтр к контексту браузера"""
+        await context.route("**/*", self._handle_route)
+        context.on("requestfinished", self._on_request_finished)
+
+    def print_stats(self):
+        """Итог за запуск: сколько запросов отменено и сколько загружено"""
+        total_blocked = sum(self.blocked.values())
+        if not total_blocked and not self.allowed:
+            return
+        print("\n" + "="*50)
+        print("ФИЛЬТР ЗАПРОСОВ")
+        print("="*50)
+        print(f"  Пропущено запросов: {self.allowed} ({self.bytes_loaded / 1024 / 1024:.1f} МБ загружено)")
+        print(f"  Заблокировано запросов: {total_blocked}")
+
+        # Группируем: по типу ресурса и по домену (топ-10 доменов)
+        by_type = {r: n for r, n in self.blocked.items() if r.startswith("type:")}
+        by_domain = Counter({r: n for r, n in self.blocked.items() if r.startswith("domain:")})
+        for reason, count in sorted(by_type.items(), key=lambda kv: -kv[1]):
+            print(f"    {reason[5:]:<30}{count:>6}")
+        for reason, count in by_domain.most_common(10):
+            print(f"    {reason[7:]:<30}{count:>6}")
+
+
+# Один фильтр на весь запуск — счётчики суммируются по всем контекстам
+REQUEST_FILTER = RequestFilter()
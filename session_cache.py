@@ -0,0 +1,79 @@
+# ============================================
+# КЭШ АВТОРИЗОВАННОЙ СЕССИИ KASPI MC
+# ============================================
+# Сохраняем Playwright storage_state (cookies + localStorage) после
+# успешного входа, чтобы следующие запуски (отчёт, монитор каждые 30 мин)
+# не проходили полный вход по email/паролю.
+#
+# Файл содержит действующие cookies кабинета, поэтому пишется с правами
+# 0600 (только владелец), а папка — 0700.
+
+import json
+import os
+import time
+
+from config import KASPI_LOGIN, SESSION_CACHE_FILE, SESSION_TTL_HOURS
+
+
+def load_session():
+    """Прочитать сохранённую сессию. Возвращает storage_state или None.
+
+    None — если кэш отключён, файла нет, он повреждён, сохранён для
+    другого логина или старше SESSION_TTL_HOURS.
+    """
+    if not SESSION_CACHE_FILE:
+        return None
+    try:
+        with open(SESSION_CACHE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if data.get("login") != KASPI_LOGIN:
+        print("  [INFO] Сохранённая сессия от другого логина — игнорируем")
+        return None
+
+    age_hours = (time.time() - data.get("saved_at", 0)) / 3600
+    if age_hours > SESSION_TTL_HOURS:
+        print(f"  [INFO] Сохранённая сессия устарела ({age_hours:.1f} ч > {SESSION_TTL_HOURS:g} ч)")
+        return None
+
+    print(f"  [OK] Найдена сохранённая сессия (возраст {age_hours:.1f} ч)")
+    return data.get("storage_state")
+
+
+def save_session(storage_state):
+    """Сохранить storage_state на диск с правами 0600 (атомарно)"""
+    if not SESSION_CACHE_FILE:
+        return
+
+    folder = os.path.dirname(SESSION_CACHE_FILE)
+    if folder:
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+
+    data = {
+        "login": KASPI_LOGIN,
+        "saved_at": time.time(),
+        "storage_state": storage_state,
+    }
+
+    # Пишем во временный файл, сразу созданный с правами 0600,
+    # и подменяем — чтобы не оставить полузаписанную сессию
+    tmp_path = SESSION_CACHE_FILE + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, SESSION_CACHE_FILE)
+    os.chmod(SESSION_CACHE_FILE, 0o600)
+    print(f"  [OK] Сессия сохранена: {SESSION_CACHE_FILE}")
+
+
+def clear_session():
+    """Удалить сохранённую сессию (например, если сервер её отклонил)"""
+    if not SESSION_CACHE_FILE:
+        return
+    try:
+        os.remove(SESSION_CACHE_FILE)
+        print("  [INFO] Сохранённая сессия удалена")
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,599 @@
+# ============================================
+# СНИМОК МЕСЯЧНОГО ЛИСТА ЗАДАЧ
+# ============================================
+# Лист читается один раз (get_all_values) при создании SheetSnapshot.
+# Дальше все проверки идут по индексам в памяти, а изменения копятся
+# в очередях и уходят в таблицу одним flush():
+#   1. append_rows      — новые строки
+#   2. batch_update     — значения ячеек (смежные ячейки столбца — одним диапазоном)
+#   3. spreadsheet.batch_update — форматирование (цвета строк и т.п.), а также
+#      фон и формулы новых строк
+# Каждый шаг на больших листах делится на пакеты по размеру (batch_writer);
+# пакет, который так и не записался, откатывается в снимке, чтобы реестр
+# задач не разошёлся с таблицей.
+# Индексы обновляются сразу при постановке изменения в очередь, поэтому
+# следующие шаги видят лист уже "после" изменений.
+#
+# Номер новой строки до отправки — предположение (следующая за последней
+# известной). Фактические строки берутся из ответа append (updatedRange):
+# если лист успели дописать параллельно, новые строки в снимке сдвигаются,
+# а их фон и формулы (зависят от номера строки) строятся уже по факту.
+# Поэтому добавление строк стоит фиксированное число вызовов API — без
+# перечитывания листа, сколько бы строк в нём ни было.
+
+import re
+
+from batch_writer import BatchWriter, SHEETS_BATCH_MAX_ROWS, response_status
+
+# Столбцы листа (с 0): A..H, см. google_sheets.COLUMNS
+COL_MERCHANT, COL_SKU, COL_NAME, COL_ADDED, COL_MANAGER, COL_MARK, COL_GONE, COL_DAYS = range(8)
+WIDTH = 8
+
+# Столбцы, от которых зависят индексы
+INDEXED_COLUMNS = {COL_MERCHANT, COL_SKU, COL_MANAGER, COL_MARK, COL_GONE}
+
+# Режим плана (--plan): сколько строк каждого раздела показывать в логе
+PLAN_PREVIEW_LINES = 15
+
+# Диапазон одного столбца: "G4" или "G4:G10"
+A1_RANGE_RE = re.compile(r"^([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$")
+
+# Первая строка диапазона из ответа append: "'2026-02'!A101:G150" -> 101
+UPDATED_RANGE_RE = re.compile(r"![A-Z]+(\d+)")
+
+
+def row_runs(row_nums):
+    """Отсортированные номера строк -> [(первая, последняя)] смежных участков"""
+    runs = []
+    for row_num in row_nums:
+        if runs and row_num == runs[-1][1] + 1:
+            runs[-1][1] = row_num
+        else:
+            runs.append([row_num, row_num])
+    return [tuple(run) for run in runs]
+
+
+def column_letter(col):
+    """Буква столбца по номеру с 0: 0 -> A, 7 -> H"""
+    letters = ""
+    col += 1
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def column_index(letters):
+    """Номер столбца с 0 по букве: A -> 0, H -> 7"""
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - 64
+    return col - 1
+
+
+class SheetSnapshot:
+    """Лист задач в памяти: значения, индексы и очередь изменений.
+
+    Номера строк — как в таблице (с 1, строка 1 — заголовок).
+    Индексы:
+      active      — {(кабинет, артикул): строка} без даты исчезновения (G)
+      sku_rows    — {артикул: строка} без даты исчезновения (последняя строка артикула)
+      open_load   — {менеджер: число задач без отметки (F)}
+      merchant_rows — {кабинет: {строки}} по точному значению столбца A
+    """
+
+    def __init__(self, sheet, values=None):
+        """values — готовые значения листа (например, из task_ledger); иначе лист читается"""
+        self.sheet = sheet
+        self.reads = 0
+        self.api_calls = 0
+        if values is None:
+            values = sheet.get_all_values()
+            self.reads = 1
+            self.api_calls = 1
+        self.values = [self._pad(row) for row in values] or [[""] * WIDTH]
+        # Строк в таблице (остальные — ещё не отправленные append)
+        self.stored_rows = len(values)
+        # Вызовы API, которые сэкономлены пакетной записью (для лога)
+        self.calls_saved = 0
+
+        self.active = {}
+        self.sku_rows = {}
+        self.open_load = {}
+        self.merchant_rows = {}
+        for row_num in range(2, len(self.values) + 1):
+            self._index(row_num)
+
+        self._appended = []      # номера новых строк (по порядку)
+        self._updates = {}       # {(строка, столбец): значение} для существующих строк
+        self._formats = []       # запросы spreadsheet.batch_update
+        self._merges = set()     # ячейки "Кабинет", дописанные через "+" (раньше — update_cell на каждую)
+        self._backgrounds = {}   # {новая строка: цвет фона}
+        self._formulas = {}      # {(новая строка, столбец): (формула(строка), числовой формат)}
+        self._original = {}      # {(строка, столбец): значение до изменений} — для плана
+        self.touched = set()     # все изменённые за время жизни снимка строки (для реестра)
+
+    @staticmethod
+    def _pad(row):
+        row = list(row)
+        if len(row) < WIDTH:
+            row += [""] * (WIDTH - len(row))
+        return row
+
+    # ---------- индексы ----------
+
+    def _index(self, row_num):
+        row = self.values[row_num - 1]
+        merchant, sku = row[COL_MERCHANT], row[COL_SKU]
+        if not sku and not merchant:
+            return
+        self.merchant_rows.setdefault(merchant, set()).add(row_num)
+        if not row[COL_GONE]:
+            self.active[(merchant, sku)] = row_num
+            self.sku_rows[sku] = row_num
+        manager = row[COL_MANAGER]
+        if manager and not row[COL_MARK]:
+            self.open_load[manager] = self.open_load.get(manager, 0) + 1
+
+    def _unindex(self, row_num):
+        row = self.values[row_num - 1]
+        merchant, sku = row[COL_MERCHANT], row[COL_SKU]
+        if not sku and not merchant:
+            return
+        self.merchant_rows.get(merchant, set()).discard(row_num)
+        if self.active.get((merchant, sku)) == row_num:
+            del self.active[(merchant, sku)]
+        if self.sku_rows.get(sku) == row_num:
+            del self.sku_rows[sku]
+        manager = row[COL_MANAGER]
+        if manager and not row[COL_MARK] and self.open_load.get(manager):
+            self.open_load[manager] -= 1
+
+    # ---------- чтение ----------
+
+    @property
+    def row_count(self):
+        """Строк на листе вместе с заголовком и ещё не отправленными"""
+        return len(self.values)
+
+    @property
+    def header(self):
+        return self.values[0]
+
+    def get(self, row_num, col):
+        return self.values[row_num - 1][col]
+
+    def row(self, row_num):
+        return self.values[row_num - 1]
+
+    def active_skus(self, merchant_name):
+        """Артикулы кабинета без даты исчезновения"""
+        return {sku for merchant, sku in self.active if merchant == merchant_name}
+
+    def manager_loads(self, managers):
+        """{менеджер: открытых задач} для списка менеджеров"""
+        return {manager: self.open_load.get(manager, 0) for manager in managers}
+
+    # ---------- изменения ----------
+
+    def append_row(self, row):
+        """Поставить в очередь новую строку. Возвращает её номер"""
+        self.values.append(self._pad(row))
+        row_num = len(self.values)
+        self._appended.append((row_num, len(row)))
+        self.touched.add(row_num)
+        self._index(row_num)
+        return row_num
+
+    def set_value(self, row_num, col, value):
+        """Поставить в очередь запись значения в ячейку"""
+        reindex = col in INDEXED_COLUMNS
+        if row_num <= self.stored_rows:
+            self._original.setdefault((row_num, col), self.values[row_num - 1][col])
+        if reindex:
+            self._unindex(row_num)
+        self.values[row_num - 1][col] = value
+        self.touched.add(row_num)
+        if reindex:
+            self._index(row_num)
+        # Новые строки уйдут целиком через append — отдельная запись не нужна
+        if row_num <= self.stored_rows:
+            self._updates[(row_num, col)] = value
+
+    def add_merchant(self, row_num, merchant_name):
+        """Дописать кабинет в столбец A через "+" (в очередь, как и прочие значения)"""
+        current = self.get(row_num, COL_MERCHANT)
+        self.set_value(row_num, COL_MERCHANT, f"{current}+{merchant_name}")
+        if row_num <= self.stored_rows:
+            self._merges.add((row_num, COL_MERCHANT))
+
+    def set_background(self, row_num, color):
+        """Фон строки (столбцы A..H). Для новых строк — по фактическому номеру после append"""
+        if row_num > self.stored_rows:
+            self._backgrounds[row_num] = color
+            return
+        self.queue_format({
+            "repeatCell": {
+                "range": self._grid_range(row_num, row_num, 0, WIDTH),
+                "cell": {"userEnteredFormat": {"backgroundColor": color}},
+                "fields": "userEnteredFormat.backgroundColor",
+            }
+        })
+
+    def set_formula(self, row_num, col, formula, number_format=None):
+        """Формула, зависящая от номера строки: formula(номер) -> текст.
+
+        Существующие строки — обычная запись значения. Для новых строк
+        формула не уходит в append, а пишется после него по фактическому
+        номеру строки (updateCells в том же spreadsheet.batch_update, что
+        и оформление); number_format — числовой формат той же ячейки.
+        """
+        if row_num > self.stored_rows:
+            self.values[row_num - 1][col] = formula(row_num)
+            self._formulas[(row_num, col)] = (formula, number_format)
+            return
+        self.set_value(row_num, col, formula(row_num))
+
+    def queue_format(self, request):
+        """Поставить в очередь запрос форматирования (spreadsheet.batch_update)"""
+        self._formats.append(request)
+
+    @property
+    def pending(self):
+        return bool(self._appended or self._updates or self._formats)
+
+    # ---------- новые строки ----------
+
+    def _grid_range(self, first, last, start_col, end_col):
+        """GridRange строк first..last (номера с 1) и столбцов [start_col, end_col)"""
+        return {
+            "sheetId": self.sheet.id,
+            "startRowIndex": first - 1,
+            "endRowIndex": last,
+            "startColumnIndex": start_col,
+            "endColumnIndex": end_col,
+        }
+
+    def _append_payload(self):
+        """Строки для append: формулы новых строк не отправляются (см. set_formula)"""
+        rows = []
+        for row_num, width in self._appended:
+            row = list(self.values[row_num - 1])
+            for col in range(WIDTH):
+                if (row_num, col) in self._formulas:
+                    row[col] = ""
+            # Значения, записанные в новую строку после постановки в очередь, тоже уходят
+            used = max(width, max((i + 1 for i, v in enumerate(row) if v != ""), default=0))
+            rows.append(row[:used])
+        return rows
+
+    @staticmethod
+    def _appended_start(response):
+        """Первая строка, куда легли данные append (updates.updatedRange), или None"""
+        updated = ((response or {}).get("updates") or {}).get("updatedRange", "")
+        match = UPDATED_RANGE_RE.search(updated)
+        return int(match.group(1)) if match else None
+
+    def _relocate_new_rows(self, expected, actual):
+        """Новые строки легли не туда, где их ждали: перенести в снимке на фактические номера"""
+        count = len(self.values) - expected + 1
+        moved = self.values[expected - 1:]
+        for row_num in range(expected, len(self.values) + 1):
+            self._unindex(row_num)
+            self.touched.discard(row_num)
+        del self.values[expected - 1:]
+        # Чужие строки между нашими не известны снимку — пустые заглушки;
+        # реестр при следующем запуске не совпадёт с листом и перечитает его
+        if actual > expected:
+            self.values.extend([[""] * WIDTH for _ in range(actual - expected)])
+        else:
+            for row_num in range(actual, expected):
+                self._unindex(row_num)
+                self.touched.discard(row_num)
+            del self.values[actual - 1:]
+        self.values.extend(moved)
+
+        shift = actual - expected
+        for row_num in range(actual, actual + count):
+            self._index(row_num)
+            self.touched.add(row_num)
+        self._backgrounds = {self._moved(row_num, expected, shift): color
+                             for row_num, color in self._backgrounds.items()
+                             if not actual <= row_num < expected}
+        self._formulas = {(self._moved(row_num, expected, shift), col): value
+                          for (row_num, col), value in self._formulas.items()
+                          if not actual <= row_num < expected}
+        for (row_num, col), (formula, _) in self._formulas.items():
+            self.values[row_num - 1][col] = formula(row_num)
+
+    @staticmethod
+    def _moved(row_num, expected, shift):
+        """Номер строки после переноса: сдвигаются только строки с expected"""
+        return row_num + shift if row_num >= expected else row_num
+
+    def _drop_new_rows(self, count):
+        """Убрать из снимка последние count новых строк (append не удался)"""
+        first = len(self.values) - count + 1
+        for row_num in range(first, len(self.values) + 1):
+            self._unindex(row_num)
+            self.touched.discard(row_num)
+        del self.values[first - 1:]
+        self._backgrounds = {r: c for r, c in self._backgrounds.items() if r < first}
+        self._formulas = {(r, col): v for (r, col), v in self._formulas.items() if r < first}
+
+    def _revert_range(self, item):
+        """Вернуть в снимке прежние значения ячеек диапазона, который не записался"""
+        match = A1_RANGE_RE.search(item["range"].rsplit("!", 1)[-1])
+        if not match:
+            return
+        col = column_index(match.group(1))
+        first = int(match.group(2))
+        last = int(match.group(4) or first)
+        for row_num in range(first, last + 1):
+            if (row_num, col) not in self._original:
+                continue
+            reindex = col in INDEXED_COLUMNS
+            if reindex:
+                self._unindex(row_num)
+            self.values[row_num - 1][col] = self._original[(row_num, col)]
+            if reindex:
+                self._index(row_num)
+
+    def _new_row_requests(self):
+        """Фон и формулы новых строк (после append): запросы spreadsheet.batch_update"""
+        requests = []
+        # Фон — один repeatCell на участок подряд идущих строк одного цвета
+        run = None
+        for row_num in sorted(self._backgrounds):
+            color = self._backgrounds[row_num]
+            if run and row_num == run[1] + 1 and color == run[2]:
+                run[1] = row_num
+                continue
+            if run:
+                requests.append(self._background_request(*run))
+            run = [row_num, row_num, color]
+        if run:
+            requests.append(self._background_request(*run))
+
+        # Формулы — один updateCells на участок подряд идущих строк столбца
+        # (пропуски не заполняются: пустая ячейка с fields=userEnteredValue
+        # стёрла бы значение, которое там уже есть; на больших листах —
+        # частями не больше лимита пакета)
+        by_column = {}
+        for (row_num, col), value in self._formulas.items():
+            by_column.setdefault(col, {})[row_num] = value
+        for col in sorted(by_column):
+            cells = by_column[col]
+            with_format = any(number_format for _, number_format in cells.values())
+            fields = "userEnteredValue,userEnteredFormat.numberFormat" if with_format else "userEnteredValue"
+            chunks = [(first, min(first + SHEETS_BATCH_MAX_ROWS - 1, run_last))
+                      for run_first, run_last in row_runs(sorted(cells))
+                      for first in range(run_first, run_last + 1, SHEETS_BATCH_MAX_ROWS)]
+            for first, last in chunks:
+                rows = []
+                for row_num in range(first, last + 1):
+                    formula, number_format = cells[row_num]
+                    cell = {"userEnteredValue": {"formulaValue": formula(row_num)}}
+                    if number_format:
+                        cell["userEnteredFormat"] = {"numberFormat": number_format}
+                    rows.append({"values": [cell]})
+                requests.append({
+                    "updateCells": {
+                        "range": self._grid_range(first, last, col, col + 1),
+                        "rows": rows,
+                        "fields": fields,
+                    }
+                })
+        return requests
+
+    def _background_request(self, first, last, color):
+        return {
+            "repeatCell": {
+                "range": self._grid_range(first, last, 0, WIDTH),
+                "cell": {"userEnteredFormat": {"backgroundColor": color}},
+                "fields": "userEnteredFormat.backgroundColor",
+            }
+        }
+
+    def _value_ranges(self):
+        """Изменения значений, склеенные в диапазоны по смежным строкам столбца"""
+        ranges = []
+        by_column = {}
+        for (row_num, col), value in self._updates.items():
+            by_column.setdefault(col, []).append((row_num, value))
+        for col in sorted(by_column):
+            cells = sorted(by_column[col])
+            start = prev = cells[0][0]
+            block = [[cells[0][1]]]
+            for row_num, value in cells[1:]:
+                # Длинный столбец режется на диапазоны не больше лимита пакета
+                if row_num == prev + 1 and len(block) < SHEETS_BATCH_MAX_ROWS:
+                    block.append([value])
+                else:
+                    ranges.append(self._range(col, start, prev, block))
+                    start, block = row_num, [[value]]
+                prev = row_num
+            ranges.append(self._range(col, start, prev, block))
+        return ranges
+
+    @staticmethod
+    def _range(col, start, end, block):
+        letter = column_letter(col)
+        a1 = f"{letter}{start}" if start == end else f"{letter}{start}:{letter}{end}"
+        return {"range": a1, "values": block}
+
+    # ---------- запись ----------
+
+    def _append_batch(self, rows):
+        """Один append: новые строки пакета. Фактическое место — из ответа (updatedRange)"""
+        expected = self.stored_rows + 1
+        try:
+            response = self.sheet.append_rows(rows, value_input_option="USER_ENTERED")
+            actual = self._appended_start(response)
+        except Exception as e:
+            # Ответ мог потеряться после того, как строки уже записаны: повтор
+            # добавил бы их второй раз — сначала ищем их на листе
+            actual = self._find_appended(rows, expected, e)
+            if actual is None:
+                raise
+            print(f"  [WARN] append вернул ошибку ({e}), но строки уже на листе с {actual} — не повторяем")
+        if actual is not None and actual != expected:
+            print(f"  [WARN] Лист изменён параллельно: новые строки легли с {actual}, "
+                  f"ожидалось с {expected} — номера строк пересчитаны")
+            self._relocate_new_rows(expected, actual)
+            expected = actual
+        self.stored_rows = expected + len(rows) - 1
+
+    def _find_appended(self, rows, expected, error):
+        """Первая строка, с которой на листе уже лежат артикулы rows, или None.
+
+        Явный отказ (4xx, кроме 408) — строки точно не записаны, лист не читается.
+        """
+        status = response_status(error)
+        if status is not None and 400 <= status < 500 and status != 408:
+            return None
+        try:
+            column = self.sheet.col_values(COL_SKU + 1)
+        except Exception:
+            return None
+        skus = [row[COL_SKU] if len(row) > COL_SKU else "" for row in rows]
+        for start in range(expected - 1, len(column) - len(skus) + 1):
+            if column[start:start + len(skus)] == skus:
+                return start + 1
+        return None
+
+    def _values_batch(self, ranges):
+        # gspread дописывает к диапазонам имя листа на месте — отдаём копии (для повтора)
+        self.sheet.batch_update([dict(item) for item in ranges], value_input_option="USER_ENTERED")
+
+    def _formats_batch(self, requests):
+        self.sheet.spreadsheet.batch_update({"requests": requests})
+
+    @staticmethod
+    def _request_rows(request):
+        """Строк листа в запросе оформления: updateCells — по числу строк, прочие — 1"""
+        update = request.get("updateCells")
+        return len(update["rows"]) if update else 1
+
+    def _writers(self):
+        """Запись пакетами (batch_writer) для каждого шага flush()"""
+        return {
+            # Порядок строк важен: после неудачного append следующие не отправляются.
+            # Пакет append не переотправляется (retries=0) — повтор после потерянного
+            # ответа задвоил бы строки; деление пополам при 400/413 остаётся
+            "append": BatchWriter("новые строки", self._append_batch, lambda row: 1, ordered=True,
+                                  retries=0),
+            "values": BatchWriter("значения", self._values_batch, lambda item: len(item["values"])),
+            # Удаление правил по индексу и добавление новых зависят от порядка
+            "formats": BatchWriter("оформление", self._formats_batch, self._request_rows, ordered=True),
+        }
+
+    def flush(self):
+        """Отправить все накопленные изменения (пакетами). Возвращает число вызовов API"""
+        calls = 0
+        writers = self._writers()
+
+        if self._appended:
+            writer = writers["append"]
+            failed = writer.write(self._append_payload())
+            calls += writer.calls
+            if failed:
+                # Не записанные строки убираются из снимка (и не попадут в реестр) —
+                # товары добавятся при следующем запуске
+                self._drop_new_rows(len(failed))
+                print(f"  [WARN] Не добавлено строк: {len(failed)} — будут добавлены при следующем запуске")
+            self.stored_rows = len(self.values)
+            self._appended = []
+            # Фон и формулы новых строк — вместе с остальным оформлением
+            self._formats = self._new_row_requests() + self._formats
+            self._backgrounds = {}
+            self._formulas = {}
+
+        if self._updates:
+            writer = writers["values"]
+            failed = writer.write(self._value_ranges())
+            calls += writer.calls
+            # Не записанные ячейки — обратно к значениям листа, чтобы реестр не разошёлся с ним
+            for item in failed:
+                self._revert_range(item)
+            if self._merges and not failed:
+                # Каждое объединение было бы отдельным update_cell; пакет значений
+                # отправляется в любом случае, если в нём есть что-то кроме них
+                only_merges = all(key in self._merges for key in self._updates)
+                saved = len(self._merges) - (writer.calls if only_merges else 0)
+                self.calls_saved += saved
+                print(f"  [INFO] Объединения кабинетов: {len(self._merges)} ячеек пакетом, "
+                      f"сэкономлено вызовов API: {saved}")
+            self._updates = {}
+            self._merges = set()
+            self._original = {}
+
+        if self._formats:
+            # Ошибка оформления не отменяет уже записанные данные (пакет пропускается с [WARN])
+            writer = writers["formats"]
+            writer.write(self._formats)
+            calls += writer.calls
+            self._formats = []
+
+        self.api_calls += calls
+        return calls
+
+    # ---------- план (--plan) ----------
+
+    def plan(self):
+        """Вызовы API, которые сделает flush(), без отправки: [(метод, тело запроса)].
+
+        Тела — те же, что уйдут в gspread, с тем же делением на пакеты
+        (номера новых строк — ожидаемые, как если бы лист никто не
+        дописывал параллельно).
+        """
+        calls = []
+        writers = self._writers()
+        for batch in writers["append"].batches(self._append_payload()):
+            calls.append(("values.append", {"values": batch}))
+        title = self.sheet.title.replace("'", "''")
+        for batch in writers["values"].batches(self._value_ranges()):
+            calls.append(("values.batchUpdate", {
+                "valueInputOption": "USER_ENTERED",
+                "includeValuesInResponse": None,
+                "responseValueRenderOption": None,
+                "responseDateTimeRenderOption": None,
+                "data": [{"range": f"'{title}'!{r['range']}", "values": r["values"]} for r in batch],
+            }))
+        for batch in writers["formats"].batches(self._new_row_requests() + self._formats):
+            calls.append(("spreadsheets.batchUpdate", {"requests": batch}))
+        return calls
+
+    def plan_diff(self):
+        """Изменения листа в виде diff: [строка лога]"""
+        lines = []
+
+        def section(title, items, count=None):
+            if not items:
+                return
+            lines.append(f"    {title}: {len(items) if count is None else count}")
+            for item in items[:PLAN_PREVIEW_LINES]:
+                lines.append(f"      {item}")
+            if len(items) > PLAN_PREVIEW_LINES:
+                lines.append(f"      ... ещё {len(items) - PLAN_PREVIEW_LINES}")
+
+        section("Новые строки", [
+            f"+ {row_num}: " + " | ".join(self.values[row_num - 1][:COL_GONE])
+            for row_num, _ in self._appended
+        ])
+        section("Изменения ячеек", [
+            f"~ {column_letter(col)}{row_num}: {self._original.get((row_num, col), '')!r} -> {value!r}"
+            for (row_num, col), value in sorted(self._updates.items())
+        ])
+        section("Формулы новых строк", [
+            f"+ {column_letter(col)}{row_num}: {formula(row_num)}"
+            for (row_num, col), (formula, _) in sorted(self._formulas.items(), key=lambda item: item[0])
+        ])
+        kinds = {}
+        for request in self._new_row_requests() + self._formats:
+            kind = next(iter(request))
+            kinds[kind] = kinds.get(kind, 0) + 1
+        section("Оформление (запросы)", [f"{kind} x{count}" for kind, count in sorted(kinds.items())],
+                sum(kinds.values()))
+        return lines
+
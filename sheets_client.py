@@ -0,0 +1,142 @@
+# ============================================
+# КЛИЕНТ GOOGLE SHEETS С УЧЁТОМ КВОТЫ
+# ============================================
+# Все запросы gspread проходят через RateLimitedHTTPClient
+# (gspread.authorize(..., http_client=...)):
+#   - token bucket на SHEETS_REQUESTS_PER_MINUTE запросов в минуту —
+#     запрос сверх бюджета ждёт, а не получает 429;
+#   - 429 / 408 / 5xx / 403 usageLimits и обрывы соединения повторяются
+#     с экспоненциальной задержкой со случайным разбросом (учитывается
+#     Retry-After), не больше SHEETS_MAX_RETRIES раз;
+#   - values:append (не идемпотентный: повтор после потерянного ответа
+#     добавил бы строки второй раз) повторяется только при явном отказе —
+#     429 или 403 по квоте. Прочие ошибки уходят вызывающему коду, который
+#     сверяет лист перед повторной отправкой (см. SheetSnapshot);
+#   - SHEETS_STATS — счётчики за запуск: запросы, повторы, время ожидания.
+
+import random
+import threading
+import time
+
+import requests
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+
+from config import SHEETS_REQUESTS_PER_MINUTE, SHEETS_MAX_RETRIES
+
+BACKOFF_BASE = 2.0     # сек, первая задержка повтора
+BACKOFF_MAX = 64.0     # сек, потолок задержки
+
+RETRY_STATUSES = {408, 429}
+
+SHEETS_STATS = {
+    "calls": 0,        # отправлено запросов (включая повторы)
+    "retries": 0,      # повторов после ошибок
+    "throttled": 0.0,  # сек ожидания в token bucket
+    "backoff": 0.0,    # сек задержек перед повторами
+    "failed": 0,       # запросов, упавших после всех повторов
+}
+
+
+class TokenBucket:
+    """Не больше rate запросов в минуту; допускается всплеск до capacity"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Забрать один токен. Возвращает, сколько секунд пришлось ждать"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+BUCKET = TokenBucket(SHEETS_REQUESTS_PER_MINUTE)
+
+
+def is_rejected(error):
+    """Явный отказ по квоте (429, 403 usageLimits): запрос точно не выполнен"""
+    if not isinstance(error, APIError):
+        return False
+    code = error.code
+    if code == 429:
+        return True
+    # Drive API сообщает о превышении квоты кодом 403
+    details = error.error if isinstance(error.error, dict) else {}
+    reasons = [e.get("reason", "") for e in details.get("errors", [])]
+    return code == 403 and any("ratelimit" in r.lower() or "quota" in r.lower() for r in reasons)
+
+
+def is_retryable(error):
+    """Стоит ли повторять идемпотентный запрос после этой ошибки"""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if not isinstance(error, APIError):
+        return False
+    code = error.code
+    return code in RETRY_STATUSES or code >= 500 or is_rejected(error)
+
+
+def is_idempotent(method, endpoint):
+    """Повтор запроса безопасен: всё, кроме values:append (GET, values:batchUpdate,
+    batchUpdate повторно записывают те же значения)"""
+    return not (str(method).upper() == "POST" and ":append" in str(endpoint))
+
+
+def retry_delay(error, attempt):
+    """Задержка перед повтором: Retry-After, иначе base * 2^attempt с разбросом 50-150%"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.5)
+
+
+class RateLimitedHTTPClient(HTTPClient):
+    """HTTP-клиент gspread с бюджетом запросов и повторами"""
+
+    def request(self, *args, **kwargs):
+        method = kwargs.get("method", args[0] if args else "")
+        endpoint = kwargs.get("endpoint", args[1] if len(args) > 1 else "")
+        can_retry = is_retryable if is_idempotent(method, endpoint) else is_rejected
+        attempt = 0
+        while True:
+            SHEETS_STATS["throttled"] += BUCKET.acquire()
+            SHEETS_STATS["calls"] += 1
+            try:
+                return super().request(*args, **kwargs)
+            except (APIError, requests.exceptions.RequestException) as e:
+                if attempt >= SHEETS_MAX_RETRIES or not can_retry(e):
+                    SHEETS_STATS["failed"] += 1
+                    raise
+                delay = retry_delay(e, attempt)
+                code = getattr(e, "code", type(e).__name__)
+                print(f"  [WAIT] Google API {code}: повтор {attempt + 1}/{SHEETS_MAX_RETRIES} "
+                      f"через {delay:.1f} сек")
+                SHEETS_STATS["retries"] += 1
+                SHEETS_STATS["backoff"] += delay
+                time.sleep(delay)
+                attempt += 1
+
+
+def print_sheets_stats():
+    """Итог по запросам к Google Sheets за запуск"""
+    s = SHEETS_STATS
+    if not s["calls"]:
+        return
+    print(f"\n[INFO] Google Sheets API: запросов {s['calls']}, повторов {s['retries']}, "
+          f"ожидание квоты {s['throttled']:.1f} сек, задержки повторов {s['backoff']:.1f} сек"
+          + (f", ошибок {s['failed']}" if s["failed"] else ""))
@@ -0,0 +1,57 @@
+# ============================================
+# ФОНОВАЯ СИНХРОНИЗАЦИЯ С GOOGLE SHEETS
+# ============================================
+# process_products_file — синхронный код (gspread), поэтому он выполняется
+# в отдельном потоке, а event loop продолжает выгрузку следующих мерчантов.
+# Поток один: мерчанты пишут в один и тот же месячный лист (снимок ->
+# изменения -> flush), и параллельная запись привела бы к дублям строк
+# и неверной загрузке менеджеров. Задачи выполняются в порядке постановки.
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import excel_export
+
+
+def sync_merchant(merchant_name, file_path, plan=False):
+    """Обработка файла "Без привязки" одного мерчанта (в потоке синхронизации).
+    plan=True — только план изменений (--plan), без записи"""
+    try:
+        from google_sheets import process_products_file
+        print(f"\n[Google Sheets] Обработка {merchant_name}...")
+        return process_products_file(file_path, merchant_name=merchant_name, plan=plan)
+    except Exception as e:
+        err_msg = str(e).encode('ascii', errors='replace').decode('ascii')
+        print(f"[WARN] Ошибка Google Sheets для {merchant_name}: {err_msg}")
+        return None
+    finally:
+        excel_export.forget(file_path)
+
+
+class SheetsSync:
+    """Очередь синхронизации: submit() после выгрузки мерчанта, wait() в конце"""
+
+    def __init__(self, plan=False):
+        self.plan = plan
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets")
+        self.futures = {}  # {merchant_name: asyncio.Future}
+
+    def submit(self, merchant_name, files):
+        """Поставить мерчанта в очередь, если его файл "Без привязки" скачан"""
+        file_path = (files or {}).get("без_привязки")
+        if not file_path or not os.path.exists(file_path) or merchant_name in self.futures:
+            return
+        loop = asyncio.get_running_loop()
+        self.futures[merchant_name] = loop.run_in_executor(
+            self.executor, sync_merchant, merchant_name, file_path, self.plan
+        )
+        print(f"[INFO] {merchant_name}: Google Sheets — в очереди ({len(self.futures)})")
+
+    async def wait(self):
+        """Дождаться всех поставленных задач. Возвращает {merchant_name: результат}"""
+        try:
+            results = await asyncio.gather(*self.futures.values())
+        finally:
+            self.executor.shutdown(wait=True)
+        return dict(zip(self.futures.keys(), results))
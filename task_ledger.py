@@ -0,0 +1,171 @@
+# ============================================
+# ЛОКАЛЬНЫЙ РЕЕСТР ЗАДАЧ (SQLite)
+# ============================================
+# Реестр — основная копия месячных листов задач: по строке на задачу
+# (месяц, номер строки на листе, кабинет, артикул, ... , открыта ли).
+# Google-таблица — её отображение для менеджеров:
+#   - перед обработкой из таблицы читаются только столбцы B и F
+#     (один batch_get): B — проверка, что строки не сдвигали вручную,
+#     F — отметки менеджеров, единственное, что правят в таблице;
+#   - снимок листа (SheetSnapshot) строится из реестра, без get_all_values;
+#   - после flush() в реестр записываются только изменённые строки.
+# Если реестра нет или он расходится с таблицей (удалили/пересортировали
+# строки, миграция столбцов) — лист один раз читается целиком и реестр
+# пересобирается.
+#
+# В режиме плана (--plan) реестр открывается копией в памяти (scratch=True):
+# сверка и пересборка месяцев работают как обычно, но файл не меняется.
+
+import os
+import sqlite3
+import time
+
+from config import TASK_LEDGER_FILE
+from sheet_snapshot import (
+    COL_MERCHANT, COL_SKU, COL_NAME, COL_ADDED, COL_MANAGER, COL_MARK, COL_GONE, WIDTH,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    month    TEXT NOT NULL,            -- лист "YYYY-MM"
+    row_num  INTEGER NOT NULL,         -- строка на листе (с 2)
+    merchant TEXT NOT NULL,            -- A: кабинет ("Sulpak+ARG" для общих)
+    sku      TEXT NOT NULL,            -- B
+    name     TEXT NOT NULL DEFAULT '', -- C
+    added    TEXT NOT NULL DEFAULT '', -- D
+    manager  TEXT NOT NULL DEFAULT '', -- E
+    mark     TEXT NOT NULL DEFAULT '', -- F: отметка менеджера (из таблицы)
+    gone     TEXT NOT NULL DEFAULT '', -- G: дата исчезновения
+    open     INTEGER NOT NULL,         -- 1, пока G пустая
+    PRIMARY KEY (month, row_num)
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_open ON tasks (merchant, sku, open);
+-- Открытые задачи всех месяцев: поиск исчезнувших не зависит от объёма истории
+CREATE INDEX IF NOT EXISTS idx_tasks_open_only ON tasks (merchant, month) WHERE open = 1;
+CREATE TABLE IF NOT EXISTS months (
+    month     TEXT PRIMARY KEY,
+    header    TEXT NOT NULL,           -- заголовки листа через \\t
+    synced_at TEXT NOT NULL
+);
+"""
+
+ROW_COLUMNS = (COL_MERCHANT, COL_SKU, COL_NAME, COL_ADDED, COL_MANAGER, COL_MARK, COL_GONE)
+
+
+class TaskLedger:
+    """Реестр задач в SQLite (файл TASK_LEDGER_FILE).
+
+    scratch=True — работать с копией файла в памяти: записи не сохраняются.
+    """
+
+    def __init__(self, path=TASK_LEDGER_FILE, scratch=False):
+        self.path = path
+        if scratch:
+            self.db = sqlite3.connect(":memory:")
+            if os.path.exists(path):
+                source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+                try:
+                    source.backup(self.db)
+                finally:
+                    source.close()
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    # ---------- месяц целиком ----------
+
+    def load_month(self, month):
+        """Значения листа (как get_all_values) из реестра или None, если месяца нет"""
+        header = self.db.execute("SELECT header FROM months WHERE month = ?", (month,)).fetchone()
+        if not header:
+            return None
+        values = [header[0].split("\t")]
+        rows = self.db.execute(
+            "SELECT row_num, merchant, sku, name, added, manager, mark, gone "
+            "FROM tasks WHERE month = ? ORDER BY row_num", (month,)
+        )
+        for row_num, *cells in rows:
+            # Пустые строки листа в реестр не пишутся — восстанавливаем нумерацию
+            while len(values) < row_num - 1:
+                values.append([""] * WIDTH)
+            values.append(list(cells) + [""])
+        return values
+
+    def import_month(self, month, values):
+        """Пересобрать месяц по значениям листа (get_all_values)"""
+        with self.db:
+            self.db.execute("DELETE FROM tasks WHERE month = ?", (month,))
+            self.db.executemany(
+                "INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._record(month, row_num, row)
+                 for row_num, row in enumerate(values[1:], start=2) if row[COL_SKU] or row[COL_MERCHANT]),
+            )
+            self._save_header(month, values[0] if values else [])
+
+    def save_rows(self, month, snapshot, row_nums):
+        """Записать в реестр изменённые строки снимка (после flush)"""
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._record(month, row_num, snapshot.row(row_num))
+                 for row_num in sorted(row_nums) if row_num > 1),
+            )
+            self._save_header(month, snapshot.header)
+
+    @staticmethod
+    def _record(month, row_num, row):
+        cells = [row[col] if col < len(row) else "" for col in ROW_COLUMNS]
+        return (month, row_num, *cells, 0 if cells[-1] else 1)
+
+    def _save_header(self, month, header):
+        self.db.execute(
+            "INSERT OR REPLACE INTO months VALUES (?, ?, ?)",
+            (month, "\t".join(header), time.strftime("%Y-%m-%d %H:%M:%S")),
+        )
+
+    # ---------- открытые задачи всех месяцев ----------
+
+    def months(self):
+        """Месяцы, которые есть в реестре"""
+        return {row[0] for row in self.db.execute("SELECT month FROM months")}
+
+    def open_tasks(self, merchant, exclude_month=None):
+        """Открытые задачи кабинета во всех месяцах: [(месяц, строка, артикул)]"""
+        return self.db.execute(
+            "SELECT month, row_num, sku FROM tasks WHERE merchant = ? AND open = 1 AND month <> ? "
+            "ORDER BY month, row_num", (merchant, exclude_month or "")
+        ).fetchall()
+
+    # ---------- сверка с таблицей ----------
+
+    def pull_marks(self, sheet, values):
+        """Сверить реестр с листом и забрать отметки менеджеров (столбец F).
+
+        Один batch_get по столбцам B и F. Возвращает число обновлённых
+        отметок или None, если артикулы по строкам не совпали (реестр
+        устарел — лист нужно прочитать целиком). values обновляется на месте.
+        """
+        sku_range, mark_range = sheet.batch_get(["B2:B", "F2:F"])
+        sheet_skus = [r[0] if r else "" for r in sku_range]
+        ledger_skus = [row[COL_SKU] for row in values[1:]]
+        if sheet_skus != ledger_skus:
+            return None
+
+        marks = [r[0] if r else "" for r in mark_range]
+        marks += [""] * (len(sheet_skus) - len(marks))
+        changed = []
+        for row_num, mark in enumerate(marks, start=2):
+            row = values[row_num - 1]
+            if row[COL_MARK] != mark:
+                row[COL_MARK] = mark
+                changed.append((mark, sheet.title, row_num))
+        if changed:
+            with self.db:
+                self.db.executemany("UPDATE tasks SET mark = ? WHERE month = ? AND row_num = ?", changed)
+        return len(changed)
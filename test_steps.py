@@ -2,6 +2,8 @@
 Kaspi Reporter - ежедневный отчёт по нераспознанным товарам
 Запуск вручную: python test_steps.py
 Запуск по расписанию (9:00): python test_steps.py --schedule
+Без кэша выгрузок: python test_steps.py --refresh
+План изменений Google Sheets без записи: python test_steps.py --plan
 """
 
 import asyncio
@@ -10,16 +12,36 @@ import sys
 import aiohttp
 from datetime import datetime
 from playwright.async_api import async_playwright
+from session_cache import load_session, save_session, clear_session
+from pending_counts import PendingCountsInterceptor
+from request_filter import REQUEST_FILTER
+from http_export import download_file_path, export_all
+from sheets_sync import SheetsSync
+import excel_export
+import export_cache
+from readiness import (
+    wait_for_selector,
+    wait_for_url,
+    wait_for_network_idle,
+    wait_for_tab_count,
+    print_wait_stats,
+)
 from config import (
     KASPI_LOGIN,
     KASPI_PASSWORD,
     KASPI_LOGIN_URL,
+    KASPI_PRODUCTS_BASE_URL,
     CATEGORY_URLS,
     DOWNLOADS_PATH,
     TELEGRAM_BOT_TOKEN,
     TELEGRAM_CHAT_ID,
     HEADLESS,
-    MERCHANTS
+    MERCHANTS,
+    MERCHANT_CONCURRENCY,
+    BLOCK_REQUESTS,
+    HTTP_EXPORT_URL,
+    PARALLEL_CATEGORIES,
+    FORCE_REFRESH
 )
 
 # Создаём папку для загрузок
@@ -51,76 +73,134 @@ async def pick_clickable(page, selector):
     return None
 
 
-async def test_step1_login():
-    """ЭТАП 1: Авторизация"""
-    print("\n" + "="*50)
-    print("ЭТАП 1: АВТОРИЗАЦИЯ")
-    print("="*50)
+async def new_browser_context(browser, storage_state=None):
+    """Новый контекст браузера с общими настройками (загрузки, локаль).
 
-    playwright = await async_playwright().start()
-    browser = await playwright.chromium.launch(headless=HEADLESS)
-    context = await browser.new_context(accept_downloads=True, locale='ru-RU')
-    page = await context.new_page()
-    page.set_default_timeout(60000)
+    storage_state — cookies/localStorage уже авторизованного контекста:
+    так новый контекст работает без повторного логина.
+    При BLOCK_REQUESTS подключается фильтр лишних запросов (request_filter).
+    """
+    context = await browser.new_context(
+        accept_downloads=True,
+        locale='ru-RU',
+        storage_state=storage_state,
+    )
+    if BLOCK_REQUESTS:
+        await REQUEST_FILTER.install(context)
+    return context
 
+
+async def check_session(page):
+    """Проверка, что сохранённая сессия ещё принимается сервером.
+
+    При протухших cookies SPA уводит на страницу входа и переключатель
+    кабинетов ("ID - ...") в header так и не появляется.
+    """
     try:
-        # Переход на страницу входа
-        print(f"[1] Переход на {KASPI_LOGIN_URL}")
-        await page.goto(KASPI_LOGIN_URL)
-        await asyncio.sleep(3)
-        print(f"    Текущий URL: {page.url}")
-
-        # Клик на вкладку Email
-        email_tab = await page.query_selector('a:has-text("Email"), button:has-text("Email"), [role="tab"]:has-text("Email")')
-        if email_tab:
-            await email_tab.click()
-            await asyncio.sleep(1)
-            print("[2] Выбрана вкладка Email")
-
-        # Ввод email (берём кликабельное поле — скрытая панель "Телефон" перекрыта)
-        # id user_email_field стоит и на DIV-обёртке, и на input — берём только input
-        login_input = await pick_clickable(page, 'input#user_email_field, input[name="username"], input[placeholder="Email"], input.text-field')
-        if login_input:
-            await login_input.fill(KASPI_LOGIN)
-            print(f"[3] Email введён: {KASPI_LOGIN}")
-        else:
-            print("[!] ОШИБКА: Поле email не найдено!")
-            await browser.close()
-            return None, None, None
+        await page.goto(KASPI_PRODUCTS_BASE_URL, timeout=60000)
+        await page.wait_for_selector('a.navbar-link:has-text("ID -")', timeout=20000)
+    except Exception:
+        return False
+    return "login" not in page.url.lower()
+
+
+async def login_with_password(page):
+    """Полный вход по email и паролю. Возвращает True при успехе."""
+    # Переход на страницу входа
+    print(f"[1] Переход на {KASPI_LOGIN_URL}")
+    await page.goto(KASPI_LOGIN_URL)
+    await wait_for_selector(page, 'input:visible', "login: форма входа", fallback_sleep=3)
+    print(f"    Текущий URL: {page.url}")
+
+    # Клик на вкладку Email
+    email_tab = await page.query_selector('a:has-text("Email"), button:has-text("Email"), [role="tab"]:has-text("Email")')
+    if email_tab:
+        await email_tab.click()
+        await wait_for_selector(
+            page, 'input#user_email_field:visible, input[name="username"]:visible, input[placeholder="Email"]:visible',
+            "login: поле email", timeout=5000, fallback_sleep=1
+        )
+        print("[2] Выбрана вкладка Email")
+
+    # Ввод email (берём кликабельное поле — скрытая панель "Телефон" перекрыта)
+    # id user_email_field стоит и на DIV-обёртке, и на input — берём только input
+    login_input = await pick_clickable(page, 'input#user_email_field, input[name="username"], input[placeholder="Email"], input.text-field')
+    if login_input:
+        await login_input.fill(KASPI_LOGIN)
+        print(f"[3] Email введён: {KASPI_LOGIN}")
+    else:
+        print("[!] ОШИБКА: Поле email не найдено!")
+        return False
 
-        # Кнопка "Продолжить" (в DOM их две — берём реально кликабельную)
-        continue_btn = await pick_clickable(
+    # Кнопка "Продолжить" (в DOM их две — берём реально кликабельную)
+    continue_btn = await pick_clickable(
+        page,
+        'button:has-text("Продолжить"), button:has-text("Continue"), button[type="submit"]'
+    )
+    if continue_btn:
+        await continue_btn.click()
+        print("[4] Нажата кнопка 'Продолжить'")
+    await wait_for_selector(page, 'input[type="password"]:visible', "login: поле пароля", fallback_sleep=3)
+
+    # Ввод пароля
+    password_input = await pick_clickable(page, 'input[type="password"], input[name="password"]')
+    if password_input:
+        await password_input.fill(KASPI_PASSWORD)
+        print("[5] Пароль введён")
+
+        login_btn = await pick_clickable(
             page,
-            'button:has-text("Продолжить"), button:has-text("Continue"), button[type="submit"]'
+            'button:has-text("Войти"), button:has-text("Продолжить"), button[type="submit"]'
         )
-        if continue_btn:
-            await continue_btn.click()
-            print("[4] Нажата кнопка 'Продолжить'")
-        await asyncio.sleep(3)
-
-        # Ввод пароля
-        password_input = await pick_clickable(page, 'input[type="password"], input[name="password"]')
-        if password_input:
-            await password_input.fill(KASPI_PASSWORD)
-            print("[5] Пароль введён")
-
-            login_btn = await pick_clickable(
-                page,
-                'button:has-text("Войти"), button:has-text("Продолжить"), button[type="submit"]'
-            )
-            if login_btn:
-                await login_btn.click()
-                print("[6] Нажата кнопка входа")
+        if login_btn:
+            await login_btn.click()
+            print("[6] Нажата кнопка входа")
 
-            await asyncio.sleep(5)
-        else:
-            print("[!] Поле пароля не найдено")
+        await wait_for_url(page, "login", "login: уход со страницы входа",
+                           timeout=20000, present=False)
+    else:
+        print("[!] Поле пароля не найдено")
+
+    print(f"[7] Текущий URL после входа: {page.url}")
+
+    # Проверка успеха
+    return "login" not in page.url.lower()
 
-        print(f"[7] Текущий URL после входа: {page.url}")
 
-        # Проверка успеха
-        if "login" not in page.url.lower():
+async def test_step1_login():
+    """ЭТАП 1: Авторизация (сохранённая сессия или полный вход)"""
+    print("\n" + "="*50)
+    print("ЭТАП 1: АВТОРИЗАЦИЯ")
+    print("="*50)
+
+    playwright = await async_playwright().start()
+    browser = await playwright.chromium.launch(headless=HEADLESS)
+
+    try:
+        # Сначала пробуем сессию из прошлого запуска — без ввода логина/пароля
+        storage_state = load_session()
+        if storage_state:
+            context = await new_browser_context(browser, storage_state)
+            page = await context.new_page()
+            page.set_default_timeout(60000)
+            print("[0] Проверка сохранённой сессии...")
+            if await check_session(page):
+                print("\n[OK] ЭТАП 1 УСПЕШЕН: Вход по сохранённой сессии")
+                return browser, context, page
+            print("    [!] Сессия отклонена сервером — выполняем полный вход")
+            clear_session()
+            await context.close()
+
+        context = await new_browser_context(browser)
+        page = await context.new_page()
+        page.set_default_timeout(60000)
+
+        if await login_with_password(page):
             print("\n[OK] ЭТАП 1 УСПЕШЕН: Авторизация прошла!")
+            try:
+                save_session(await context.storage_state())
+            except Exception as e:
+                print(f"  [WARN] Не удалось сохранить сессию: {e}")
             return browser, context, page
         else:
             print("\n[FAIL] ЭТАП 1 ПРОВАЛЕН: Остались на странице входа")
@@ -135,6 +215,50 @@ async def test_step1_login():
         return None, None, None
 
 
+# Поиск переключателя кабинетов в header — целиком внутри страницы, одним
+# вызовом: элемент справа вверху (y <= 80, x >= 800) с коротким текстом "ID - ...".
+# Обход в том же порядке, что и query_selector_all('*'), первый подходящий.
+FIND_SWITCHER_JS = """() => {
+    for (const el of document.querySelectorAll('body *')) {
+        const r = el.getBoundingClientRect();
+        if (!r.width || !r.height || r.y > 80 || r.x < 800) continue;
+        const text = (el.innerText || '').trim();
+        if (text.includes('ID -') && text.length < 50) return el;
+    }
+    return null;
+}"""
+
+# Вариант в открытом списке: видимый элемент с текстом target в зоне
+# выпадающего списка; из подходящих — с самым коротким текстом, чтобы не
+# кликнуть по контейнеру со всеми опциями.
+FIND_OPTION_JS = """(target) => {
+    let best = null;
+    let bestLen = Infinity;
+    for (const el of document.querySelectorAll('div, li, a, span')) {
+        const text = (el.innerText || '').trim();
+        if (!text.includes(target) || text.length >= bestLen) continue;
+        const r = el.getBoundingClientRect();
+        if (r.height < 10 || r.y < 50 || r.y > 400) continue;
+        best = el;
+        bestLen = text.length;
+    }
+    return best;
+}"""
+
+
+async def find_merchant_switcher(page):
+    """Элемент переключателя кабинетов ("ID - ...") или None"""
+    handle = await page.evaluate_handle(FIND_SWITCHER_JS)
+    return handle.as_element()
+
+
+async def read_active_merchant(page):
+    """Текст переключателя кабинетов, напр. "ID - Sulpak" ("" если не найден)"""
+    return await page.evaluate(
+        f"() => {{ const el = ({FIND_SWITCHER_JS})(); return el ? el.innerText.trim() : ''; }}"
+    )
+
+
 async def switch_merchant(page, merchant_id, merchant_name):
     """Переключение на другого мерчанта через выпадающий список"""
     print("\n" + "="*50)
@@ -143,118 +267,57 @@ async def switch_merchant(page, merchant_id, merchant_name):
 
     try:
         # Сначала переходим на базовую страницу (чтобы обновить состояние)
-        await page.goto("https://kaspi.kz/mc/#/products/pending", timeout=60000)
-        await asyncio.sleep(3)
+        await page.goto(KASPI_PRODUCTS_BASE_URL, timeout=60000)
+        await wait_for_selector(page, 'a.navbar-link:has-text("ID -")', "switch: header кабинета",
+                                fallback_sleep=3)
 
         # Ищем кнопку переключения мерчанта в header
         # На скрине это элемент "ID - 30409770" с иконкой стрелки вниз
-        # Ищем в верхней части страницы (y < 80, x > 800 — справа)
-
-        dropdown_button = None
-        all_elements = await page.query_selector_all('*')
-
-        for elem in all_elements:
-            try:
-                box = await elem.bounding_box()
-                if not box or box['y'] > 80 or box['x'] < 800:
-                    continue
-
-                text = await elem.inner_text()
-                # Ищем элемент с текстом "ID - " (текущий мерчант)
-                if text and "ID -" in text and len(text) < 50:
-                    dropdown_button = elem
-                    current_text = text.strip()
-                    print(f"[1] Найден переключатель: '{current_text}'")
-
-                    # Проверяем, уже ли на нужном мерчанте
-                    if f"ID - {merchant_id}" in current_text:
-                        print(f"[OK] Уже на мерчанте {merchant_name}")
-                        return True
-                    break
-            except:
-                continue
-
+        dropdown_button = await find_merchant_switcher(page)
         if not dropdown_button:
             print("[!] Переключатель мерчантов не найден")
             return False
 
-        # Кликаем чтобы открыть список
-        await dropdown_button.click()
-        await asyncio.sleep(2)
-        print("[2] Список открыт")
+        current_text = (await dropdown_button.inner_text()).strip()
+        print(f"[1] Найден переключатель: '{current_text}'")
+
+        # Проверяем, уже ли на нужном мерчанте
+        if f"ID - {merchant_id}" in current_text:
+            print(f"[OK] Уже на мерчанте {merchant_name}")
+            return True
 
         # Ищем нужный вариант в выпадающем списке
         target_text = f"ID - {merchant_id}"
 
-        print(f"    Ищем вариант: '{target_text}'")
-
-        # Ищем элемент списка с ТОЧНЫМ текстом (не контейнер со всеми опциями)
-        options = await page.query_selector_all('div, li, a, span')
-        target_option = None
-        best_match = None
-        best_match_len = 1000  # Ищем элемент с самым коротким текстом (самый точный)
-
-        for opt in options:
-            try:
-                text = await opt.inner_text()
-                if not text:
-                    continue
-                text_clean = text.strip()
-
-                # Должен содержать наш ID
-                if target_text not in text_clean:
-                    continue
-
-                box = await opt.bounding_box()
-                # Элемент должен быть видимым и в выпадающем списке
-                if not box or box['height'] < 10 or box['y'] < 50 or box['y'] > 400:
-                    continue
-
-                # Предпочитаем элемент с самым коротким текстом (точное совпадение)
-                # чтобы не кликать по контейнеру со всеми опциями
-                if len(text_clean) < best_match_len:
-                    best_match = opt
-                    best_match_len = len(text_clean)
-                    print(f"    Кандидат: '{text_clean}' (len={len(text_clean)}, y={box['y']:.0f})")
-            except:
-                continue
+        # Кликаем чтобы открыть список и ждём появления нужного варианта
+        await dropdown_button.click()
+        await wait_for_selector(page, f':text("{target_text}")', "switch: открытие списка",
+                                timeout=5000, fallback_sleep=2)
+        print("[2] Список открыт")
 
-        target_option = best_match
+        print(f"    Ищем вариант: '{target_text}'")
+        target_option = (await page.evaluate_handle(FIND_OPTION_JS, target_text)).as_element()
 
         if target_option:
+            print(f"    Вариант: '{(await target_option.inner_text()).strip()}'")
             await target_option.click()
             print(f"[3] Клик по {merchant_name}...")
 
-            # Ждём перезагрузку — дольше чтобы данные обновились
-            await asyncio.sleep(7)
-
-            # Принудительно ждём networkidle
-            try:
-                await page.wait_for_load_state('networkidle', timeout=15000)
-            except:
-                pass
-
-            # Проверяем что переключение успешно
-            await asyncio.sleep(2)
+            # Ждём, пока header покажет новый кабинет, и догрузку данных
+            await wait_for_selector(page, f'a.navbar-link:has-text("{target_text}")',
+                                    "switch: смена кабинета", timeout=20000, fallback_sleep=5)
+            await wait_for_network_idle(page, "switch: networkidle")
 
             # Повторно проверяем текущего мерчанта
-            all_elements = await page.query_selector_all('*')
-            for elem in all_elements:
-                try:
-                    box = await elem.bounding_box()
-                    if not box or box['y'] > 80 or box['x'] < 800:
-                        continue
-                    text = await elem.inner_text()
-                    if text and "ID -" in text and len(text) < 50:
-                        print(f"[4] Текущий мерчант: '{text.strip()}'")
-                        if f"ID - {merchant_id}" in text:
-                            print(f"[OK] Успешно переключились на {merchant_name}")
-                            return True
-                        else:
-                            print(f"[!] Переключение не сработало! Остались на другом мерчанте")
-                            return False
-                except:
-                    continue
+            text = await read_active_merchant(page)
+            if text:
+                print(f"[4] Текущий мерчант: '{text}'")
+                if target_text in text:
+                    print(f"[OK] Успешно переключились на {merchant_name}")
+                    return True
+                else:
+                    print(f"[!] Переключение не сработало! Остались на другом мерчанте")
+                    return False
 
             print(f"    Текущий URL: {page.url}")
             return True
@@ -270,8 +333,18 @@ async def switch_merchant(page, merchant_id, merchant_name):
         return False
 
 
-async def navigate_and_download(page, category_key, step_label="", merchant_name=""):
-    """Переход в раздел и скачивание Excel"""
+async def navigate_and_download(page, category_key, step_label="", merchant_name="", api_count=None,
+                                cached_count=None):
+    """Переход в раздел и скачивание Excel.
+
+    api_count — количество товаров из перехваченного ответа API
+    (см. pending_counts). Если передано, текст вкладки не читается.
+    cached_count — счётчик прошлой выгрузки из export_cache: если во вкладке
+    то же число, файл не скачивается.
+
+    Возвращает (file_path, count); file_path None — скачивание не нужно
+    (0 товаров или счётчик не изменился) или не удалось.
+    """
     print("\n" + "="*50)
     print(f"СКАЧИВАНИЕ EXCEL: {step_label} ({merchant_name})")
     print("="*50)
@@ -287,76 +360,79 @@ async def navigate_and_download(page, category_key, step_label="", merchant_name
     try:
         url = CATEGORY_URLS[category_key]
         print(f"[1] Переход на {url}")
+        expected_path = url.split("#")[1] if "#" in url else ""
+        tab_text = TAB_LABELS.get(category_key, step_label)
+        tab_selector = f'a:has-text("{tab_text}"):visible'
+        count = api_count
+
+        if api_count == 0:
+            print("    [SKIP] Товаров 0 (по данным API) — пропускаем скачивание")
+            return None, 0
 
         # Сначала переходим на страницу нераспознанных товаров
         if "products/pending" not in page.url:
-            target_hash = url.split("#")[1] if "#" in url else ""
-            await page.evaluate(f'window.location.hash = "{target_hash}"')
-            await asyncio.sleep(3)
+            await page.evaluate(f'window.location.hash = "{expected_path}"')
+            await wait_for_selector(page, tab_selector, "download: вкладки категорий", fallback_sleep=3)
 
         # Кликаем по нужной вкладке на странице
-        tab_text = TAB_LABELS.get(category_key, step_label)
         print(f"[2] Клик по вкладке '{tab_text}'...")
 
         # Ждём networkidle перед чтением счётчика вкладок
         # (Каспи рендерит вкладку с "(0)" до подгрузки реальных данных)
-        try:
-            await page.wait_for_load_state('networkidle', timeout=15000)
-        except Exception:
-            pass
+        if api_count is None:
+            await wait_for_network_idle(page, "download: networkidle")
 
         # Ищем вкладку по тексту (текст содержит число в скобках, напр. "Требуют доработок (2)")
         import re
-        tab = await page.query_selector(f'a:has-text("{tab_text}"):visible')
+        tab = await wait_for_selector(page, tab_selector, "download: вкладка", timeout=10000)
 
         if tab:
-            # Читаем счётчик; если "(0)" — ждём и перечитываем (lazy-loading)
-            async def read_count():
-                t = await tab.inner_text()
-                m = re.search(r'\((\d+)\)', t)
-                return (int(m.group(1)) if m else None), t.strip()
-
-            count, tab_full_text = await read_count()
-            print(f"    Вкладка: '{tab_full_text}' (count={count})")
-
-            # Если счётчик пустой или 0 — это может быть незагруженная вкладка.
-            # Делаем до 3 повторных проверок с паузой, прежде чем поверить в "0"
-            if count == 0 or count is None:
-                for attempt in range(3):
-                    await asyncio.sleep(3)
-                    new_count, tab_full_text = await read_count()
-                    print(f"    Перечитываем счётчик (попытка {attempt + 1}): '{tab_full_text}' (count={new_count})")
-                    if new_count is not None and new_count > 0:
-                        count = new_count
-                        break
-                    count = new_count if new_count is not None else count
+            if api_count is not None:
+                count = api_count
+                print(f"    Счётчик из API: {count}")
+            else:
+                # Если счётчик пустой или "(0)" — это может быть незагруженная вкладка:
+                # ждём, пока Kaspi подставит реальное число, прежде чем поверить в "0"
+                await wait_for_tab_count(tab, "download: счётчик вкладки")
+                tab_full_text = (await tab.inner_text()).strip()
+                m = re.search(r'\((\d+)\)', tab_full_text)
+                count = int(m.group(1)) if m else None
+                print(f"    Вкладка: '{tab_full_text}' (count={count})")
 
             if count == 0:
                 print(f"    [SKIP] Товаров 0 — пропускаем скачивание")
-                return None
+                return None, 0
+
+            if count is not None and count == cached_count:
+                print(f"    [CACHE] Счётчик не изменился ({count}) — берём прошлую выгрузку")
+                return None, count
 
             await tab.click()
-            await asyncio.sleep(5)
+            await wait_for_url(page, expected_path, "download: смена вкладки", fallback_sleep=2)
             print(f"    Текущий URL: {page.url}")
         else:
             # Fallback: прямой переход по hash
             print(f"    [!] Вкладка '{tab_text}' не найдена, переходим по URL...")
-            target_hash = url.split("#")[1] if "#" in url else ""
-            await page.evaluate(f'window.location.hash = "{target_hash}"')
-            await asyncio.sleep(5)
+            await page.evaluate(f'window.location.hash = "{expected_path}"')
+            await wait_for_url(page, expected_path, "download: переход по hash", fallback_sleep=2)
             print(f"    Текущий URL: {page.url}")
 
         # Проверяем что URL сменился на нужную категорию
-        expected_path = url.split("#")[1] if "#" in url else ""
         if expected_path and expected_path not in page.url:
             print(f"    [!] URL не сменился! Пробуем page.goto...")
             await page.goto(url, timeout=60000)
-            await asyncio.sleep(5)
+            await wait_for_network_idle(page, "download: goto категории")
             print(f"    Текущий URL после goto: {page.url}")
 
-        # Ждём загрузки таблицы
+        # Ждём загрузки таблицы — появления кнопки выгрузки
         print("[3] Ожидание загрузки страницы...")
-        await asyncio.sleep(3)
+        await wait_for_selector(
+            page,
+            'button:has-text("Выгрузить"), button:has-text("EXCEL"), a:has-text("EXCEL"), '
+            'button:has-text("Скачать"), a:has-text("Скачать")',
+            "download: кнопка EXCEL",
+            fallback_sleep=3,
+        )
 
         # Ищем кнопку скачивания (только видимую!)
         print("[4] Поиск видимой кнопки скачивания...")
@@ -396,7 +472,7 @@ async def navigate_and_download(page, category_key, step_label="", merchant_name
         if not button:
             print("\n[FAIL] ЭТАП 2 ПРОВАЛЕН: Кнопка Excel не найдена")
             print("   Проверьте браузер - есть ли там товары и кнопка?")
-            return None
+            return None, count
 
         print("[5] Кнопка найдена, скачиваем...")
 
@@ -405,12 +481,9 @@ async def navigate_and_download(page, category_key, step_label="", merchant_name
             await button.click()
 
         download = await download_info.value
-        orig_name = download.suggested_filename or "kaspi_export.xlsx"
         # Добавляем timestamp и название мерчанта
-        name_base, name_ext = os.path.splitext(orig_name)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_name = f"{name_base}_{merchant_name}_{timestamp}{name_ext}"
-        file_path = os.path.join(DOWNLOADS_PATH, file_name)
+        file_path = download_file_path(download.suggested_filename, merchant_name)
+        file_name = os.path.basename(file_path)
         await download.save_as(file_path)
 
         print(f"    Имя файла: {file_name}")
@@ -418,72 +491,56 @@ async def navigate_and_download(page, category_key, step_label="", merchant_name
             print("    [!] ВНИМАНИЕ: Скачан файл заказов, а не товаров!")
             print("        Возможно, навигация на страницу товаров не сработала.")
         print(f"\n[OK] ЭТАП 2 УСПЕШЕН: Файл сохранён: {file_path}")
-        return file_path
+        return file_path, count
 
     except Exception as e:
         err_msg = str(e).encode('ascii', errors='replace').decode('ascii')
         print(f"\n[FAIL] ОШИБКА: {err_msg}")
-        return None
+        return None, None
 
 
-async def test_step3_parse_excel(file_path):
-    """ЭТАП 3: Обработка Excel файла и подсчёт артикулов"""
+async def test_step3_parse_excel(file_path, stats_only=False):
+    """ЭТАП 3: Обработка Excel файла и подсчёт артикулов.
+
+    Файл разбирается один раз (excel_export.load) — тот же объект потом
+    использует обработка Google Sheets. stats_only=True — только счётчики,
+    потоково и без названий (для категорий, которые в Sheets не идут).
+    """
     print("\n" + "="*50)
     print("ЭТАП 3: ОБРАБОТКА EXCEL")
     print("="*50)
 
     try:
-        import pandas as pd
-
         print(f"[1] Открываем файл: {file_path}")
-        df = pd.read_excel(file_path)
+        if stats_only:
+            stats = excel_export.read_stats(file_path)
+            print(f"[2] Общее количество артикулов: {stats['total']}")
+            print(f"[3] Артикулов на 30000*: {stats['count_30000']}")
+            print(f"\n[OK] ЭТАП 3 УСПЕШЕН: Обработано {stats['total']} товаров")
+            return stats
 
-        print(f"[2] Количество строк: {len(df)}")
-        print(f"[3] Колонки: {list(df.columns)}")
+        parsed = excel_export.load(file_path)
 
-        # Находим колонку с артикулами
-        sku_col = None
-        for col in df.columns:
-            if 'артикул' in col.lower() or 'sku' in col.lower():
-                sku_col = col
-                break
-
-        if not sku_col:
-            print("[!] Колонка с артикулами не найдена!")
-            return None
-
-        print(f"[4] Колонка артикулов: '{sku_col}'")
-
-        # Приводим артикулы к строкам
-        skus = df[sku_col].astype(str)
-
-        # Общее количество артикулов
-        total_count = len(skus)
-
-        # Артикулы начинающиеся на 30000
-        skus_30000 = skus[skus.str.startswith("30000")]
-        count_30000 = len(skus_30000)
+        print(f"[2] Количество строк: {len(parsed)}")
+        print(f"[3] Колонки: {parsed.columns}")
 
-        print(f"[5] Общее количество артикулов: {total_count}")
-        print(f"[6] Артикулов на 30000*: {count_30000}")
+        stats = parsed.stats
+        print(f"[4] Общее количество артикулов: {stats['total']}")
+        print(f"[5] Артикулов на 30000*: {stats['count_30000']}")
 
         # Показываем первые 5 строк
-        print("\n[7] Первые 5 товаров:")
+        print("\n[6] Первые 5 товаров:")
         print("-" * 80)
-        name_col = None
-        for col in df.columns:
-            if 'название' in col.lower() or 'наименование' in col.lower():
-                name_col = col
-                break
-        for i, row in df.head(5).iterrows():
-            sku = str(row[sku_col])
-            name = str(row[name_col])[:50] if name_col else ""
-            print(f"   {sku} | {name}")
+        for sku, name in parsed.head(5):
+            print(f"   {sku} | {name[:50]}")
         print("-" * 80)
 
-        print(f"\n[OK] ЭТАП 3 УСПЕШЕН: Обработано {total_count} товаров")
-        return {"total": total_count, "count_30000": count_30000}
+        print(f"\n[OK] ЭТАП 3 УСПЕШЕН: Обработано {stats['total']} товаров")
+        return dict(stats)
 
+    except ValueError as e:
+        print(f"[!] {e}")
+        return None
     except Exception as e:
         print(f"\n[FAIL] ОШИБКА: {e}")
         return None
@@ -596,25 +653,76 @@ async def send_telegram_file(file_path, caption=""):
         return False
 
 
-async def process_category(page, category_key, step_label, merchant_name=""):
-    """Обработка одной категории: скачивание и анализ. Возвращает (stats, file_path) или (None, None)."""
+async def process_category(page, category_key, step_label, merchant_name="", api_count=None,
+                           force_refresh=False):
+    """Обработка одной категории: скачивание и анализ. Возвращает (stats, file_path) или (None, None).
+
+    Если счётчик товаров совпадает с прошлой выгрузкой (export_cache),
+    скачивание и разбор пропускаются — берутся сохранённые файл и статистика
+    ("Без привязки" скачивается всегда, см. export_cache.ALWAYS_DOWNLOAD).
+    force_refresh — не смотреть в кэш (--refresh).
+    """
+    cached = None if force_refresh else export_cache.lookup(merchant_name, category_key)
+    if cached and api_count and api_count == cached["count"]:
+        print(f"\n[CACHE] {merchant_name}/{step_label}: счётчик не изменился ({api_count}), "
+              f"используем {cached['file']}")
+        return cached["stats"], cached["file"]
+
     # Скачивание Excel (возвращает None если товаров 0)
-    file_path = await navigate_and_download(page, category_key, step_label, merchant_name)
+    file_path, count = await navigate_and_download(
+        page, category_key, step_label, merchant_name, api_count,
+        cached_count=cached["count"] if cached else None,
+    )
     if not file_path:
+        if cached and count and count == cached["count"]:
+            return cached["stats"], cached["file"]
         # Возвращаем статистику с 0 если скачивание пропущено (0 товаров)
         return {"total": 0, "count_30000": 0}, None
 
-    await asyncio.sleep(2)
+    # Тот же файл, что и в прошлый раз (по хэшу) — повторно не разбираем
+    stats = export_cache.stats_if_unchanged(merchant_name, category_key, file_path)
+    if stats:
+        print(f"[CACHE] {merchant_name}/{step_label}: содержимое не изменилось, разбор пропущен")
+        return stats, file_path
 
     # Обработка Excel
-    stats = await test_step3_parse_excel(file_path)
+    # Разобранный файл в памяти нужен только для "Без привязки" (Google Sheets)
+    stats = await test_step3_parse_excel(file_path, stats_only=category_key != "без_привязки")
     if not stats:
         print(f"\n[STOP] Не удалось обработать Excel для '{step_label}'")
         return None, file_path
 
+    export_cache.store(merchant_name, category_key, count, file_path, stats)
     return stats, file_path
 
 
+async def process_category_in_new_page(context, category_key, step_label, merchant_name="", api_count=None,
+                                       force_refresh=False):
+    """Обработка категории в отдельной вкладке уже переключённого контекста.
+
+    Кабинет хранится в сессии контекста, поэтому новая вкладка открывается
+    сразу на нужном мерчанте. Вкладка закрывается после скачивания.
+    """
+    if api_count == 0:
+        print(f"    [SKIP] {merchant_name}/{step_label}: товаров 0 (по данным API)")
+        return {"total": 0, "count_30000": 0}, None
+
+    page = await context.new_page()
+    page.set_default_timeout(60000)
+    try:
+        await page.goto(CATEGORY_URLS[category_key], timeout=60000)
+        await wait_for_selector(page, f'a:has-text("{step_label}"):visible', "category: вкладка в новой странице",
+                                fallback_sleep=3)
+        return await process_category(page, category_key, step_label, merchant_name, api_count,
+                                      force_refresh)
+    except Exception as e:
+        err_msg = str(e).encode('ascii', errors='replace').decode('ascii')
+        print(f"[FAIL] {merchant_name}/{step_label}: {err_msg}")
+        return None, None
+    finally:
+        await page.close()
+
+
 def build_report_message(all_results):
     """Формирует сводное сообщение-таблицу для Telegram — одна таблица с колонкой Кабинет"""
     today = datetime.now().strftime("%d.%m.%Y")
@@ -691,69 +799,250 @@ def build_report_message(all_results):
     return f"<pre>{table}</pre>\n\n<a href=\"{sheets_url}\">Задачи контент-менеджерам</a>"
 
 
-async def process_merchant(page, merchant, categories):
+async def process_merchant(page, merchant, categories, force_refresh=False):
     """Обработка одного мерчанта: переключение и сбор данных по всем категориям"""
     merchant_id = merchant["id"]
     merchant_name = merchant["name"]
 
-    # Всегда переключаемся на нужного мерчанта (даже для первого, т.к. браузер может помнить предыдущего)
-    switched = await switch_merchant(page, merchant_id, merchant_name)
-    if not switched:
-        print(f"[WARN] Не удалось переключиться на {merchant_name}, пробуем продолжить...")
+    # Слушаем ответы API со счётчиками категорий. Ответы другого кабинета
+    # (если кабинет в них указан) перехватчик пропускает сам.
+    interceptor = PendingCountsInterceptor(page, merchant_id)
+
+    try:
+        # Всегда переключаемся на нужного мерчанта (даже для первого, т.к. браузер может помнить предыдущего)
+        switched = await switch_merchant(page, merchant_id, merchant_name)
+        if not switched:
+            print(f"[WARN] Не удалось переключиться на {merchant_name}, пробуем продолжить...")
+        else:
+            # Счётчики, пойманные до переключения, относятся к прежнему кабинету
+            interceptor.reset()
+
+        # Переходим на страницу нераспознанных товаров
+        await page.goto(CATEGORY_URLS["без_привязки"], timeout=60000)
+        await wait_for_selector(page, 'a:has-text("Без привязки"):visible', "merchant: страница товаров",
+                                fallback_sleep=3)
 
-    # Переходим на страницу нераспознанных товаров
-    await page.goto(CATEGORY_URLS["без_привязки"], timeout=60000)
-    await asyncio.sleep(3)
+        api_counts = await interceptor.wait()
+        if api_counts:
+            print(f"[INFO] Счётчики из API ({merchant_name}): {api_counts}")
+        else:
+            print("[INFO] Ответ API со счётчиками не найден — читаем вкладки")
+    finally:
+        interceptor.detach()
 
     # Собираем статистику и пути к файлам по всем категориям
     results = {}
     files = {}
-    for category_key, step_label in categories:
-        stats, file_path = await process_category(page, category_key, step_label, merchant_name)
-        results[category_key] = stats
-        files[category_key] = file_path
-        await asyncio.sleep(2)
+    if PARALLEL_CATEGORIES:
+        # Все категории одновременно, каждая в своей вкладке того же контекста
+        outcomes = await asyncio.gather(*(
+            process_category_in_new_page(
+                page.context, category_key, step_label, merchant_name, api_counts.get(category_key),
+                force_refresh,
+            )
+            for category_key, step_label in categories
+        ))
+        for (category_key, _), (stats, file_path) in zip(categories, outcomes):
+            results[category_key] = stats
+            files[category_key] = file_path
+    else:
+        for category_key, step_label in categories:
+            stats, file_path = await process_category(
+                page, category_key, step_label, merchant_name, api_counts.get(category_key),
+                force_refresh,
+            )
+            results[category_key] = stats
+            files[category_key] = file_path
 
     return results, files
 
 
-async def main():
-    """Главная функция - запуск всех этапов"""
+async def process_merchant_isolated(browser, storage_state, merchant, categories, semaphore,
+                                   on_merchant_done=None, force_refresh=False):
+    """Обработка мерчанта в отдельном контексте браузера.
+
+    У каждого контекста свои cookies/localStorage, поэтому переключение
+    кабинета здесь не влияет на параллельно работающие контексты.
+    """
+    async with semaphore:
+        context = await new_browser_context(browser, storage_state)
+        try:
+            page = await context.new_page()
+            page.set_default_timeout(60000)
+            results, files = await process_merchant(page, merchant, categories, force_refresh)
+        finally:
+            await context.close()
+    if on_merchant_done:
+        on_merchant_done(merchant["name"], files)
+    return results, files
+
+
+async def process_merchants_concurrently(browser, context, merchants, categories, concurrency,
+                                         on_merchant_done=None, force_refresh=False):
+    """Параллельная обработка мерчантов: логин один раз, дальше — клоны сессии.
+
+    Возвращает (all_results, all_files) в том же формате, что и
+    последовательный обход в main().
+    """
+    print(f"\n[INFO] Параллельная обработка мерчантов: {len(merchants)} шт., "
+          f"одновременно до {concurrency}")
+
+    storage_state = await context.storage_state()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    outcomes = await asyncio.gather(
+        *(process_merchant_isolated(browser, storage_state, merchant, categories, semaphore,
+                                    on_merchant_done, force_refresh)
+          for merchant in merchants),
+        return_exceptions=True,
+    )
+
+    all_results = {}
+    all_files = {}
+    for merchant, outcome in zip(merchants, outcomes):
+        merchant_name = merchant["name"]
+        if isinstance(outcome, Exception):
+            err_msg = str(outcome).encode('ascii', errors='replace').decode('ascii')
+            print(f"[WARN] Ошибка обработки {merchant_name}: {err_msg}")
+            all_results[merchant_name] = {}
+            all_files[merchant_name] = {}
+            continue
+        all_results[merchant_name], all_files[merchant_name] = outcome
+
+    return all_results, all_files
+
+
+async def process_merchants_http(context, merchants, categories, on_merchant_done=None):
+    """Выгрузка всех мерчантов по HTTP (без браузера) и разбор файлов.
+
+    Возвращает (all_results, all_files, fallback) — fallback: мерчанты,
+    у которых хотя бы одна категория не выгрузилась, их нужно пройти
+    через браузер.
+    """
     print("\n" + "="*50)
-    print("KASPI REPORTER")
+    print("HTTP-ВЫГРУЗКА (БЕЗ БРАУЗЕРА)")
     print("="*50)
 
-    # ЭТАП 1: Авторизация
-    browser, context, page = await test_step1_login()
+    exported, api_counts = await export_all(context, merchants, [key for key, _ in categories])
 
-    if not page:
-        print("\n[STOP] Тестирование прервано на этапе 1")
-        return
+    all_results = {}
+    all_files = {}
+    fallback = []
+    for merchant in merchants:
+        merchant_name = merchant["name"]
+        files = exported[merchant_name]
+        if not all(files.values()):
+            print(f"[WARN] {merchant_name}: HTTP-выгрузка неполная, переходим на браузер")
+            fallback.append(merchant)
+            continue
+
+        results = {}
+        for category_key, _ in categories:
+            file_path = files[category_key]
+            stats = export_cache.stats_if_unchanged(merchant_name, category_key, file_path)
+            if not stats:
+                stats = await test_step3_parse_excel(
+                    file_path, stats_only=category_key != "без_привязки"
+                )
+                if stats:
+                    # В кэш — счётчик вкладки из API, как в браузерном режиме (не строки файла)
+                    count = api_counts[merchant_name].get(category_key)
+                    export_cache.store(merchant_name, category_key, count, file_path, stats)
+                else:
+                    print(f"\n[STOP] Не удалось обработать Excel для '{category_key}'")
+            results[category_key] = stats
+        all_results[merchant_name] = results
+        all_files[merchant_name] = files
+        if on_merchant_done:
+            on_merchant_done(merchant_name, files)
 
-    await asyncio.sleep(2)
+    return all_results, all_files, fallback
 
-    # Список категорий для обработки
-    categories = [
-        ("без_привязки", "Без привязки"),
-        ("требуют_доработок", "Требуют доработок"),
-        ("на_проверке", "На проверке"),
-        ("отклонены", "Отклонены"),
-    ]
 
+# Список категорий для обработки
+CATEGORIES = [
+    ("без_привязки", "Без привязки"),
+    ("требуют_доработок", "Требуют доработок"),
+    ("на_проверке", "На проверке"),
+    ("отклонены", "Отклонены"),
+]
+
+
+async def collect_merchant_data(browser, context, page, merchants, categories, concurrency=1,
+                                on_merchant_done=None, force_refresh=False):
+    """Сбор выгрузок и статистики по всем мерчантам.
+
+    HTTP-выгрузка (если включена), затем браузер — параллельно в отдельных
+    контекстах или по очереди на одной странице.
+    on_merchant_done(merchant_name, files) вызывается сразу после выгрузки
+    каждого мерчанта (например, чтобы начать синхронизацию с Google Sheets).
+    force_refresh — скачать всё заново, без кэша выгрузок (--refresh).
+    Возвращает (all_results, all_files) в порядке merchants.
+    """
     # Словари для хранения данных по всем мерчантам
     all_results = {}  # {merchant_name: {category: stats}}
     all_files = {}    # {merchant_name: {category: file_path}}
 
-    # Обрабатываем каждого мерчанта
-    for merchant in MERCHANTS:
-        merchant_name = merchant["name"]
-        print(f"\n{'='*50}")
-        print(f"ОБРАБОТКА МЕРЧАНТА: {merchant_name}")
-        print(f"{'='*50}")
+    # Мерчанты, которых нужно пройти через браузер
+    browser_merchants = merchants
 
-        results, files = await process_merchant(page, merchant, categories)
-        all_results[merchant_name] = results
-        all_files[merchant_name] = files
+    if HTTP_EXPORT_URL:
+        # Прямые HTTP-выгрузки; браузер — только для тех, у кого не получилось
+        all_results, all_files, browser_merchants = await process_merchants_http(
+            context, merchants, categories, on_merchant_done
+        )
+
+    if concurrency > 1 and browser_merchants:
+        # Каждый мерчант — в своём контексте с копией авторизованной сессии
+        results, files = await process_merchants_concurrently(
+            browser, context, browser_merchants, categories, concurrency, on_merchant_done,
+            force_refresh,
+        )
+        all_results.update(results)
+        all_files.update(files)
+    else:
+        # Обрабатываем каждого мерчанта по очереди на одной странице
+        for merchant in browser_merchants:
+            merchant_name = merchant["name"]
+            print(f"\n{'='*50}")
+            print(f"ОБРАБОТКА МЕРЧАНТА: {merchant_name}")
+            print(f"{'='*50}")
+
+            results, files = await process_merchant(page, merchant, categories, force_refresh)
+            all_results[merchant_name] = results
+            all_files[merchant_name] = files
+            if on_merchant_done:
+                on_merchant_done(merchant_name, files)
+
+    # Порядок строк отчёта — как в merchants
+    all_results = {m["name"]: all_results.get(m["name"], {}) for m in merchants}
+    return all_results, all_files
+
+
+async def main(concurrency=MERCHANT_CONCURRENCY, force_refresh=FORCE_REFRESH, plan=False):
+    """Главная функция - запуск всех этапов
+
+    force_refresh — игнорировать кэш выгрузок (--refresh)
+    plan — Google Sheets: только показать изменения и число вызовов API (--plan)
+    """
+    print("\n" + "="*50)
+    print("KASPI REPORTER")
+    print("="*50)
+
+    # ЭТАП 1: Авторизация
+    browser, context, page = await test_step1_login()
+
+    if not page:
+        print("\n[STOP] Тестирование прервано на этапе 1")
+        return
+
+    # Сбор данных по всем мерчантам. Google Sheets ("Без привязки") обрабатывается
+    # в фоновом потоке сразу после выгрузки мерчанта — параллельно со следующими
+    sheets_sync = SheetsSync(plan=plan)
+    all_results, all_files = await collect_merchant_data(
+        browser, context, page, MERCHANTS, CATEGORIES, concurrency,
+        on_merchant_done=sheets_sync.submit, force_refresh=force_refresh,
+    )
 
     # Формируем и отправляем сводный отчёт
     print("\n" + "="*50)
@@ -761,44 +1050,46 @@ async def main():
     print("="*50)
 
     message = build_report_message(all_results)
-    message_id = await send_telegram(message, parse_mode="HTML")
+    if plan:
+        # Пробный запуск ничего не публикует — отчёт только в лог
+        print("[PLAN] Отчёт не отправляется (--plan):")
+        print(message)
+        message_id = None
+    else:
+        message_id = await send_telegram(message, parse_mode="HTML")
 
     # Закрепляем сообщение в группе (бот должен быть админом)
     if message_id:
         await pin_telegram_message(message_id)
 
-    # Обработка Google Sheets (для "Без привязки" всех мерчантов)
+    # Дожидаемся синхронизации Google Sheets (для "Без привязки" всех мерчантов)
     print("\n" + "="*50)
-    print("ОБРАБОТКА GOOGLE SHEETS")
+    print("ОЖИДАНИЕ GOOGLE SHEETS")
     print("="*50)
+    sheets_results = await sheets_sync.wait()
+    if plan:
+        plans = [r["plan"] for r in sheets_results.values() if r and "plan" in r]
+        calls = sum(p["calls"] for p in plans)
+        size = sum(p["bytes"] for p in plans)
+        print(f"\n[PLAN] Мерчантов: {len(plans)}, вызовов API на запись: {calls}, "
+              f"тело запросов: {size / 1024:.1f} КБ (каждый мерчант — против текущего листа)")
 
-    for idx, merchant in enumerate(MERCHANTS):
-        merchant_name = merchant["name"]
-        files = all_files.get(merchant_name, {})
-        bez_privyazki_file = files.get("без_привязки")
-
-        if bez_privyazki_file and os.path.exists(bez_privyazki_file):
-            # Пауза между мерчантами (лимит Google API — 60 запросов/мин)
-            if idx > 0:
-                print("\n  [WAIT] Пауза 5 сек (лимит Google API)...")
-                await asyncio.sleep(5)
-            try:
-                from google_sheets import process_products_file
-                print(f"\n[Google Sheets] Обработка {merchant_name}...")
-                process_products_file(bez_privyazki_file, merchant_name=merchant_name)
-            except Exception as e:
-                err_msg = str(e).encode('ascii', errors='replace').decode('ascii')
-                print(f"[WARN] Ошибка Google Sheets для {merchant_name}: {err_msg}")
+    try:
+        from sheets_client import print_sheets_stats
+        print_sheets_stats()
+    except ImportError:
+        pass
 
     print("\n" + "="*50)
     print("ВСЕ МЕРЧАНТЫ ОБРАБОТАНЫ!")
     print("="*50)
 
-    await asyncio.sleep(2)
+    print_wait_stats()
+    REQUEST_FILTER.print_stats()
     await browser.close()
 
 
-async def run_scheduled():
+async def run_scheduled(concurrency=MERCHANT_CONCURRENCY, force_refresh=FORCE_REFRESH, plan=False):
     """Запуск по расписанию: каждый день в 9:00"""
     print("[SCHEDULER] Kaspi Reporter запущен в режиме расписания")
     print("[SCHEDULER] Отчёт будет отправляться каждый день в 09:00")
@@ -822,7 +1113,7 @@ async def run_scheduled():
 
         print(f"\n[SCHEDULER] === Запуск отчёта {datetime.now().strftime('%d.%m.%Y %H:%M')} ===")
         try:
-            await main()
+            await main(concurrency=concurrency, force_refresh=force_refresh, plan=plan)
         except Exception as e:
             err_msg = str(e).encode('ascii', errors='replace').decode('ascii')
             print(f"[SCHEDULER] ОШИБКА: {err_msg}")
@@ -830,8 +1121,25 @@ async def run_scheduled():
             await send_telegram(f"Kaspi Reporter: ОШИБКА при запуске\n{err_msg}")
 
 
+def parse_concurrency(argv):
+    """--concurrency N из командной строки (по умолчанию — из config)"""
+    if "--concurrency" in argv:
+        idx = argv.index("--concurrency")
+        if idx + 1 < len(argv):
+            return max(1, int(argv[idx + 1]))
+    return max(1, MERCHANT_CONCURRENCY)
+
+
 if __name__ == "__main__":
+    options = {
+        "concurrency": parse_concurrency(sys.argv),
+        # --refresh — игнорировать кэш выгрузок и скачать всё заново
+        "force_refresh": FORCE_REFRESH or "--refresh" in sys.argv,
+        # --plan — Google Sheets: только показать изменения и число вызовов API
+        "plan": "--plan" in sys.argv,
+    }
+
     if "--schedule" in sys.argv:
-        asyncio.run(run_scheduled())
+        asyncio.run(run_scheduled(**options))
     else:
-        asyncio.run(main())
+        asyncio.run(main(**options))